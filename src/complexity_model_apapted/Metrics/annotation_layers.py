@@ -0,0 +1,95 @@
+"""
+Annotation layers read by each ``features.txt`` metric.
+
+``extract_characteristics.py`` fills the ``word``, ``lemma``, ``pos``, ``morph``
+and ``dep`` columns. The words (and sentences) come from natasha segmentation,
+``lemma``, ``pos`` and ``morph`` from pymorphy2, and ``dep`` from the natasha
+syntax parser, by far the slowest step. ``required_layers`` tells which of
+those a set of metrics actually reads, so the annotation can skip the rest.
+
+    >>> sorted(required_layers(['ASL', 'FRE_GL', 'SMOG']))
+    []
+    >>> sorted(required_layers(['TTR_lemma', 'Nsubj_pr']))
+    ['dep', 'lemma']
+"""
+
+LAYERS = ('lemma', 'pos', 'morph', 'dep')
+
+# Metrics that read nothing but the words and sentences
+SURFACE_METRICS = (
+    'N_word', 'V_word', 'C', 'punct', 'let', 'N', 'syl', 'sent', 'word_long', 'word_long_pr',
+    'comma_pr', 'ASL', 'ASS', 'ASW', 'ACW', 'L', 'S', 'TTR_word', 'YulesK_word', 'YulesI_word',
+    'FRE_GL', 'SMOG', 'ARI', 'DCI', 'CLI', 'Textdeixis_pr', 'Sokr_pr', 'Abbr_pr', 'FZ_pr',
+    'Prep_mw_pr', 'Conj_mw_pr',
+)
+
+# layer -> metrics that read it
+LAYER_METRICS = {
+    'lemma': (
+        'N_lemma', 'V_lemma', 'lemma_long', 'lemma_long_pr', 'TTR_lemma', 'YulesK_lemma',
+        'YulesI_lemma', 'hapax1_pr', 'hapax2_pr', 'Zipf_0_pr', 'Zipf_1_pr', 'Zipf_2_pr',
+        'Zipf_3_pr', 'Zipf_4_pr', 'Zipf_5_pr', 'Zipf_6_pr', 'Zipf_7_pr', 'Zipf_8_pr', 'Word_form',
+        'Yavl_pr', 'Term_pr', 'Abstr_pr', 'Deont_pr', 'LVC_pr', 'Arch_pr', 'Cohes_1',
+        'LM_lemma_ppl', 'LM_lemma_surprisal_mean', 'LM_lemma_surprisal_sd', 'LM_lemma_surprisal_p90',
+        'LM_lemma_oov_pr',
+    ),
+    'pos': (
+        'Func_word_pr', 'Verb_pr', 'Noun_pr', 'Adj_pr', 'Prop_pr', 'Autosem_pr', 'Nouns_pr', 'NVR',
+        'Cconj_pr', 'Sconj_pr', 'Cohes_1', 'LM_pos_ppl', 'LM_pos_surprisal_mean', 'LM_pos_surprisal_sd',
+        'LM_pos_surprisal_p90', 'LM_pos_oov_pr',
+    ),
+    'morph': (
+        'Adjs_pr', 'Prtf_pr', 'Prts_pr', 'Npro_pr', 'Pred_pr', 'Grnd_pr', 'Infn_pr', 'Numr_pr',
+        'Prcl_pr', 'Prep_pr', 'Comp_pr', 'Pos_ngrams_1_pr', 'Pos_ngrams_2_pr', 'Pos_ngrams_3_pr',
+        'Pos_ngrams_4_pr', 'Pos_ngrams_5_pr', 'Pos_ngrams_6_pr', 'Pos_ngrams_7_pr',
+        'Pos_ngrams_8_pr', 'Pos_ngrams_9_pr', 'Pos_ngrams_10_pr', 'Pos_ngrams_11_pr',
+        'Pos_ngrams_12_pr', 'Dyn_Stat', 'Gen_pr', 'Ablt_pr', 'datv', 'nomn', 'loct', 'Adjif_pr',
+        'Neut_pr', 'Inan_pr', 'P1_pr', 'P3_pr', 'Pres_pr', 'Futr_pr', 'Past_pr', 'Impf_pr',
+        'Perf_pr', 'Pssv_prtf_pr', 'Pssv_prts_pr', 'Sja_verb_pr', 'Cohes_2',
+    ),
+    'dep': (
+        'Acl_pr', 'Aclrelcl_pr', 'Advcl_pr', 'Advmod_pr', 'Amod_pr', 'Appos_pr', 'Auxpass_pr',
+        'Cc_pr', 'Ccomp_pr', 'Compound_pr', 'Conj_pr', 'Cop_pr', 'Csubj_pr', 'Csubjpass_pr',
+        'Discourse_pr', 'Mark_pr', 'Nsubj_pr', 'Nsubjpass_pr', 'Nummod_pr', 'Orphan_pr',
+        'Parataxis_pr', 'Xcomp_pr',
+    ),
+}
+
+METRIC_LAYERS = {
+    name: frozenset(layer for layer, names in LAYER_METRICS.items() if name in names)
+    for name in SURFACE_METRICS + tuple(name for names in LAYER_METRICS.values() for name in names)
+}
+
+
+def register_metric_layers(name, layers):
+    """Declare the layers read by a metric defined outside ``features.txt`` (``batch_metrics`` plugins)."""
+    unknown = set(layers) - set(LAYERS)
+    if unknown:
+        raise ValueError(f'{name}: unknown annotation layers: {", ".join(sorted(unknown))}')
+    METRIC_LAYERS[name] = frozenset(layers)
+
+
+def metric_layers(name):
+    # A metric missing from the table may read anything
+    return METRIC_LAYERS.get(name, frozenset(LAYERS))
+
+
+def required_layers(names):
+    layers = set()
+    for name in names:
+        layers |= metric_layers(name)
+    return frozenset(layers)
+
+
+def feature_names(path='features.txt'):
+    """Metric names of a ``features.txt`` style file (``name(args)`` per line)."""
+    with open(path, encoding='utf-8') as file:
+        return [line.split('(')[0] for line in (line.strip() for line in file) if line]
+
+
+def parse_layers(text):
+    layers = frozenset(layer.strip() for layer in text.split(',') if layer.strip())
+    unknown = layers - set(LAYERS)
+    if unknown:
+        raise ValueError(f'unknown annotation layers: {", ".join(sorted(unknown))} (known: {", ".join(LAYERS)})')
+    return layers
@@ -0,0 +1,101 @@
+"""
+Single-file container for named numpy arrays that can be memory-mapped.
+
+Layout: an 8-byte magic, a little-endian uint64 header length, a JSON header
+describing every array (dtype, shape, byte offset) and free-form metadata,
+then the raw array data, each array aligned to ``ALIGNMENT`` bytes.
+Mapping a file is cheap and the pages are shared read-only between all
+processes that open it, which is what the frozen lexicons rely on.
+"""
+
+import json
+import os
+import shutil
+import struct
+
+import numpy as np
+
+
+ALIGNMENT = 64
+LENGTH = struct.Struct('<Q')
+COPY_CHUNK = 1 << 24
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _write(path, magic, specs, meta, write_data):
+    # ``specs``: name -> (dtype, shape, nbytes); ``write_data(fp, name)`` writes one array at the file position
+    # Offsets are relative to the data section so that they do not depend on
+    # the length of the header they are stored in.
+    layout = {}
+    offset = 0
+    for name, (dtype, shape, nbytes) in specs.items():
+        layout[name] = {'dtype': dtype.str, 'shape': list(shape), 'offset': offset}
+        offset = _align(offset + nbytes)
+    header = {'arrays': layout, 'meta': meta or {}}
+    encoded = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    data_start = _align(len(magic) + LENGTH.size + len(encoded))
+
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    try:
+        with open(tmp_path, 'wb') as fp:
+            fp.write(magic)
+            fp.write(LENGTH.pack(len(encoded)))
+            fp.write(encoded)
+            for name in specs:
+                fp.seek(data_start + layout[name]['offset'])
+                write_data(fp, name)
+            fp.truncate(data_start + offset)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def write_arrays(path, magic, arrays, meta=None):
+    """Write ``arrays`` (a name -> ndarray mapping) atomically to ``path``."""
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    # Written straight from the buffer, so mapped arrays are not copied
+    _write(path, magic, {name: (array.dtype, array.shape, array.nbytes) for name, array in arrays.items()}, meta,
+           lambda fp, name: arrays[name].tofile(fp))
+
+
+def write_array_files(path, magic, files, meta=None):
+    """Like ``write_arrays``, for one-dimensional arrays held in raw files: name -> ``(file path, dtype)``.
+
+    The files are copied in chunks, so the arrays need not fit into memory.
+    """
+    specs = {}
+    for name, (file_path, dtype) in files.items():
+        dtype = np.dtype(dtype)
+        nbytes = os.path.getsize(file_path)
+        specs[name] = (dtype, (nbytes // dtype.itemsize,), nbytes)
+
+    def copy(fp, name):
+        with open(files[name][0], 'rb') as source:
+            shutil.copyfileobj(source, fp, COPY_CHUNK)
+
+    _write(path, magic, specs, meta, copy)
+
+
+def map_arrays(path, magic):
+    """Map every array of a file written by ``write_arrays`` read-only."""
+    with open(path, 'rb') as fp:
+        if fp.read(len(magic)) != magic:
+            raise ValueError(f'{path} is not a {magic.decode()} file')
+        (length,) = LENGTH.unpack(fp.read(LENGTH.size))
+        header = json.loads(fp.read(length).decode('utf-8'))
+    data_start = _align(len(magic) + LENGTH.size + length)
+
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        shape = tuple(spec['shape'])
+        if int(np.prod(shape)) * dtype.itemsize == 0:
+            arrays[name] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=data_start + spec['offset'], shape=shape)
+    return arrays, header['meta']
@@ -0,0 +1,345 @@
+"""
+Batch metric plugins: metrics that score many documents in one call.
+
+A ``DocumentBatch`` holds documents in columnar form, the layout of
+``token_store``: one ``uint32`` string-id column per token field
+(``word``, ``lemma``, ``pos``, ``morph``, ``dep``), the tokens of all
+documents one after the other, and offset arrays for sentences and
+documents. A ``BatchMetric`` returns one value per document. It also
+declares the annotation layers it reads (for ``annotation_layers``) and
+the dtype of its values.
+
+Plugins are registered with a decorator, in a module loaded with
+``--plugins=my_metrics``, and listed in a features file with the ``batch``
+argument, e.g. ``Long_word_pr(batch)``:
+
+    @batch_metric('Long_word_pr', layers=(), dtype=np.float64)
+    def long_word_share(batch):
+        return batch.count('word', lambda word: len(word) > 12) / batch.tokens
+
+A predicate on a field is evaluated once per distinct string of the batch
+and then indexed by the id column, so a plugin costs a few array operations
+per batch rather than a Python call per token.
+
+The legacy ``(words)``/``(sents)``/``(words, sents)`` functions take part
+through ``LegacyMetric``, which calls them per document. The per-token
+count and share metrics of ``features.txt`` are also ported natively below,
+with the same values. ``feature_extractor.py --batch-size`` evaluates
+features files this way. A document without tokens gets ``nan`` from a
+native ratio metric in a batch. Such values, and legacy metrics that
+raise, ``ZeroDivisionError`` included, are reported through the ``errors``
+of ``evaluate_batch``.
+"""
+
+import importlib
+import time
+
+import numpy as np
+
+from annotation_layers import LAYERS, metric_layers, register_metric_layers
+from token_store import FIELDS, encode_documents
+
+
+class DocumentBatch:
+    """Documents in columnar form; see ``token_store`` for the arrays."""
+
+    def __init__(self, names, arrays, string, documents=None):
+        self.names = names
+        self.columns = {field: arrays[field] for field in FIELDS}
+        self.sents = arrays['sents']
+        self.sentence_offsets = arrays['sentence_offsets']
+        self.document_sentences = arrays['document_sentences']
+        self.document_sents = arrays['document_sents']
+        # Token offset of every document
+        self.token_offsets = self.sentence_offsets[self.document_sentences]
+        self.tokens = np.diff(self.token_offsets)
+        self.string = string
+        self._documents = documents
+        self._distinct = {}
+        self._values = {}
+
+    @classmethod
+    def from_documents(cls, documents):
+        """A batch of ``(name, words, sents)`` documents, as ``FeatureExtractor.parse_csv`` returns them."""
+        documents = list(documents)
+        names, strings, arrays = encode_documents(documents)
+        return cls(names, arrays, strings.__getitem__, [(words, sents) for _, words, sents in documents])
+
+    @classmethod
+    def from_store(cls, store, documents, token):
+        """A batch of store documents (names or positions); ``token`` builds tokens for legacy metrics."""
+        positions = [store._position(document) for document in documents]
+        parts = [store.columns(position) for position in positions]
+        sentence_offsets, document_sentences, document_sents = [0], [0], [0]
+        for columns, offsets, sents in parts:
+            sentence_offsets.extend((offsets[1:] + sentence_offsets[-1]).tolist())
+            document_sentences.append(len(sentence_offsets) - 1)
+            document_sents.append(document_sents[-1] + len(sents))
+        arrays = {
+            **{field: np.concatenate([columns[field] for columns, _, _ in parts] or [np.zeros(0, np.uint32)]) for field in FIELDS},
+            'sents': np.concatenate([sents for _, _, sents in parts] or [np.zeros(0, np.uint32)]),
+            'sentence_offsets': np.array(sentence_offsets, dtype=np.int64),
+            'document_sentences': np.array(document_sentences, dtype=np.int64),
+            'document_sents': np.array(document_sents, dtype=np.int64),
+        }
+        return cls([store.names[position] for position in positions], arrays, store.string, _StoreDocuments(store, positions, token))
+
+    def __len__(self):
+        return len(self.names)
+
+    def document(self, i):
+        """``(words, sents)`` of document ``i``, for per-document metrics."""
+        return self._documents[i]
+
+    def _distinct_ids(self, field):
+        # Distinct ids of a column and the position of every token among them
+        if field not in self._distinct:
+            self._distinct[field] = np.unique(self.columns[field], return_inverse=True)
+        return self._distinct[field]
+
+    def values(self, field, function, dtype=bool):
+        """``function`` of every token's ``field`` string, computed once per distinct string."""
+        key = (field, function, np.dtype(dtype))
+        if key not in self._values:
+            ids, inverse = self._distinct_ids(field)
+            table = np.array([function(self.string(int(i))) for i in ids], dtype=dtype)
+            self._values[key] = table[inverse.reshape(-1)]
+        return self._values[key]
+
+    def per_document(self, values):
+        """Sum of token ``values`` per document."""
+        totals = np.zeros(len(values) + 1, dtype=np.result_type(values.dtype, np.int64))
+        np.cumsum(values, out=totals[1:])
+        return totals[self.token_offsets[1:]] - totals[self.token_offsets[:-1]]
+
+    def count(self, field, predicate):
+        """Number of tokens per document whose ``field`` satisfies ``predicate``."""
+        return self.per_document(self.values(field, predicate).astype(np.int64))
+
+    def distinct(self, field, weights=None):
+        """Number of distinct ``field`` strings per document, or the sum of their ``weights``."""
+        ids, inverse = self._distinct_ids(field)
+        if not len(ids):
+            return np.zeros(len(self), dtype=np.int64)
+        document = np.repeat(np.arange(len(self)), self.tokens)
+        pairs = np.unique(document * len(ids) + inverse.reshape(-1))
+        if weights is None:
+            return np.bincount(pairs // len(ids), minlength=len(self)).astype(np.int64)
+        return np.bincount(pairs // len(ids), weights=weights[pairs % len(ids)], minlength=len(self)).astype(np.int64)
+
+
+class _StoreDocuments:
+
+    def __init__(self, store, positions, token):
+        self.store = store
+        self.positions = positions
+        self.token = token
+
+    def __getitem__(self, i):
+        return self.store.document(self.positions[i], self.token)
+
+
+class BatchMetric:
+    """A metric over a ``DocumentBatch``: ``compute`` returns one value per document."""
+
+    name = None
+    # Annotation layers the metric reads, and the dtype of its values
+    layers = frozenset(LAYERS)
+    dtype = np.dtype(np.float64)
+
+    def compute(self, batch):
+        raise NotImplementedError
+
+
+class FunctionMetric(BatchMetric):
+
+    def __init__(self, name, function, layers, dtype):
+        self.name = name
+        self.function = function
+        self.layers = frozenset(layers)
+        self.dtype = np.dtype(dtype)
+
+    def compute(self, batch):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.asarray(self.function(batch), dtype=self.dtype)
+
+
+class LegacyMetric(BatchMetric):
+    """A ``(words)``, ``(sents)`` or ``(words, sents)`` function, called per document."""
+
+    dtype = np.dtype(object)
+
+    def __init__(self, name, function, arg):
+        self.name = name
+        self.function = function
+        self.arg = arg
+        self.layers = metric_layers(name)
+
+    def compute(self, batch, errors=None):
+        """Values per document; with ``errors``, a document that raises gets ``nan`` and ``(document, exception)`` is appended."""
+        values = np.empty(len(batch), dtype=object)
+        for i in range(len(batch)):
+            words, sents = batch.document(i)
+            try:
+                values[i] = self.function(words) if self.arg == 'words' else self.function(sents) if self.arg == 'sents' else self.function(words, sents)
+            except Exception as error:
+                if errors is None:
+                    raise
+                values[i] = np.nan
+                errors.append((i, error))
+        return values
+
+
+BATCH_METRICS = {}
+
+
+def batch_metric(name=None, layers=LAYERS, dtype=np.float64):
+    """Register a function of a ``DocumentBatch`` as the batch metric ``name``."""
+    def register(function):
+        metric = FunctionMetric(name or function.__name__, function, layers, dtype)
+        BATCH_METRICS[metric.name] = metric
+        register_metric_layers(metric.name, metric.layers)
+        return function
+    return register
+
+
+def load_plugins(modules):
+    """Import plugin modules (names, e.g. ``my_metrics``); they register their metrics on import."""
+    for module in modules:
+        importlib.import_module(module)
+
+
+def resolve(function_list, arglist, legacy_function, keep_legacy=()):
+    """A ``BatchMetric`` for every features file entry: the batch version if there is one, the adapter otherwise.
+
+    Metrics in ``keep_legacy`` always go through the adapter.
+    """
+    metrics = []
+    for name, arg in zip(function_list, arglist):
+        if name in BATCH_METRICS and name not in keep_legacy:
+            metrics.append(BATCH_METRICS[name])
+        elif arg == 'batch':
+            raise KeyError(f'{name}: no batch metric of this name is registered')
+        else:
+            metrics.append(LegacyMetric(name, legacy_function(name), arg))
+    return metrics
+
+
+def evaluate_batch(batch, metrics, timings=None, errors=None):
+    """Values of every metric as one list per document; seconds per metric are appended to ``timings``.
+
+    With ``errors``, a legacy metric that raises on a document gets ``nan``
+    there and ``(document, metric position, exception)`` is appended, like
+    ``feature_extractor.evaluate_metrics`` does for one document. A ``nan``
+    of a batch metric (a ratio of a document without tokens, where the
+    legacy function raises ``ZeroDivisionError``) is appended as a
+    ``FloatingPointError``.
+    """
+    columns = []
+    for position, metric in enumerate(metrics):
+        start = time.perf_counter()
+        if errors is not None and isinstance(metric, LegacyMetric):
+            failures = []
+            columns.append(metric.compute(batch, failures).tolist())
+            errors.extend((document, position, error) for document, error in failures)
+        else:
+            values = metric.compute(batch)
+            if errors is not None and values.dtype.kind == 'f':
+                errors.extend((int(document), position, FloatingPointError('undefined value (nan)'))
+                              for document in np.flatnonzero(np.isnan(values)))
+            columns.append(values.tolist())
+        if timings is not None:
+            timings.append(time.perf_counter() - start)
+    return [list(row) for row in zip(*columns)] if columns else [[] for _ in range(len(batch))]
+
+
+def single_document(metric):
+    """A ``(words, sents)`` function that evaluates a batch metric on one document."""
+    def evaluate(words, sents):
+        return metric.compute(DocumentBatch.from_documents([(None, words, sents)])).tolist()[0]
+    return evaluate
+
+
+# Ports of the per-token legacy metrics. Predicates see the field strings
+# exactly as the legacy functions do (``morph`` split on ',' only).
+
+def _tags(tag):
+    return lambda morph: tag in morph.split(',')
+
+
+def _share(name, field, predicate):
+    batch_metric(name, layers=metric_layers(name))(lambda batch: batch.count(field, predicate) / batch.tokens)
+
+
+batch_metric('N_word', layers=metric_layers('N_word'), dtype=np.int64)(lambda batch: batch.tokens)
+batch_metric('V_word', layers=metric_layers('V_word'), dtype=np.int64)(lambda batch: batch.distinct('word'))
+batch_metric('V_lemma', layers=metric_layers('V_lemma'), dtype=np.int64)(lambda batch: batch.distinct('lemma'))
+
+
+def _lemma_lengths(batch):
+    ids, _ = batch._distinct_ids('lemma')
+    return np.array([len(batch.string(int(i))) for i in ids], dtype=np.int64)
+
+
+batch_metric('N_lemma', layers=metric_layers('N_lemma'), dtype=np.int64)(lambda batch: batch.distinct('lemma', _lemma_lengths(batch)))
+batch_metric('TTR_word', layers=metric_layers('TTR_word'))(lambda batch: batch.distinct('word') / batch.tokens)
+batch_metric('TTR_lemma', layers=metric_layers('TTR_lemma'))(
+    lambda batch: batch.distinct('lemma') / batch.distinct('lemma', _lemma_lengths(batch))
+)
+
+POS_SHARES = {
+    'Func_word_pr': ('ADP', 'AUX', 'CCONJ', 'PART', 'SCONJ'),
+    'Verb_pr': ('VERB', 'AUX'),
+    'Noun_pr': ('NOUN', 'PROPN'),
+    'Adj_pr': ('ADJ',),
+    'Prop_pr': ('DET', 'PRON'),
+    'Autosem_pr': ('ADJ', 'ADV', 'NOUN', 'NUM', 'PROPN', 'VERB'),
+    'Nouns_pr': ('ADJ', 'NOUN', 'PROPN'),
+    'Cconj_pr': ('CCONJ',),
+    'Sconj_pr': ('SCONJ',),
+}
+for _name, _tags_set in POS_SHARES.items():
+    _share(_name, 'pos', lambda pos, tags=frozenset(_tags_set): pos in tags)
+
+
+def _nvr(batch):
+    nouns = batch.count('pos', lambda pos: pos in ('NOUN', 'PROPN'))
+    verbs = batch.count('pos', lambda pos: pos in ('VERB', 'AUX'))
+    # The legacy function returns the integer 0 without verbs
+    values = (nouns / np.maximum(verbs, 1)).astype(object)
+    values[verbs == 0] = 0
+    return values
+
+
+batch_metric('NVR', layers=metric_layers('NVR'), dtype=object)(_nvr)
+
+MORPH_SHARES = {
+    'Adjs_pr': 'ADJS', 'Prtf_pr': 'PRTF', 'Prts_pr': 'PRTS', 'Npro_pr': 'NPRO', 'Pred_pr': 'PRED',
+    'Grnd_pr': 'GRND', 'Infn_pr': 'INFN', 'Numr_pr': 'NUMR', 'Prcl_pr': 'PRCL', 'Prep_pr': 'PREP',
+    'Comp_pr': 'COMP', 'Gen_pr': 'gent', 'Ablt_pr': 'ablt', 'datv': 'datv', 'nomn': 'nomn', 'loct': 'loct',
+    'Neut_pr': 'neut', 'Inan_pr': 'inan', 'P1_pr': '1per', 'P3_pr': '3per', 'Pres_pr': 'pres',
+    'Futr_pr': 'futr', 'Past_pr': 'past', 'Impf_pr': 'impf', 'Perf_pr': 'perf',
+}
+for _name, _tag in MORPH_SHARES.items():
+    _share(_name, 'morph', _tags(_tag))
+_share('Pssv_prtf_pr', 'morph', lambda morph: 'pssv' in morph.split(',') and 'PRTF' in morph.split(','))
+_share('Pssv_prts_pr', 'morph', lambda morph: 'pssv' in morph.split(',') and 'PRTS' in morph.split(','))
+_share('Yavl_pr', 'lemma', lambda lemma: lemma == 'являться')
+_share('Word_form', 'lemma', lambda lemma: lemma.endswith((
+    'ция', 'ние', 'вие', 'тие', 'ист', 'изм', 'ура', 'ище', 'ство', 'ость', 'овка', 'атор', 'итор', 'тель', 'льный', 'овать',
+)))
+
+
+def _adjf(batch):
+    # ' '.join(morphs).count('ADJF'): no occurrence spans two tokens
+    return batch.per_document(batch.values('morph', lambda morph: morph.count('ADJF'), np.int64)) / batch.tokens
+
+
+def _sja_verbs(batch):
+    verbs = batch.values('morph', lambda morph: morph.split(',')[0] == 'VERB')
+    reflexive = batch.values('word', lambda word: word.endswith('ся'))
+    return batch.per_document((verbs & reflexive).astype(np.int64)) / batch.tokens
+
+
+batch_metric('Adjif_pr', layers=metric_layers('Adjif_pr'))(_adjf)
+batch_metric('Sja_verb_pr', layers=metric_layers('Sja_verb_pr'))(_sja_verbs)
@@ -0,0 +1,212 @@
+"""
+Per-metric and per-stage timings on a synthetic corpus.
+
+Every ``features.txt`` metric is timed on every document of a corpus made by
+``synthetic_corpus.py`` (10 to 100k tokens by default), in the order
+``feature_extractor.py`` evaluates them, so the per-document caches (Zipf
+bands, ...) behave as in production. Stages are timed too: ``parse_csv``,
+metric evaluation, the ``FeatureExtractor.write_table`` write and, when
+natasha and pymorphy2 are installed, ``extract_characteristics.process_review``
+and ``convert_to_csv_format``. Each timing is the minimum over ``--repeat``
+runs and is written to a JSON file.
+
+    python benchmark.py run --corpus=bench_corpus --output=bench.json
+    python benchmark.py compare --baseline=baseline.json --current=bench.json --threshold=0.2
+
+``compare`` (or ``run --baseline``) exits with status 1 when any timing is
+more than ``threshold`` slower than in the baseline. Timings below
+``--min-seconds`` in both files are too noisy to compare and are skipped.
+"""
+
+import argparse
+import csv
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from feature_extractor import FeatureExtractor, N_word, metric_function, prepare_lexicons, read_feature_list
+from synthetic_corpus import DEFAULT_SIZES, generate_corpus
+
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def _best(timings, key, seconds):
+    timings[key] = min(timings.get(key, seconds), seconds)
+
+
+def time_metrics(path, function_list, arglist, repeat):
+    """``({metric: seconds}, {stage: seconds}, tokens, values)`` for one document."""
+    metrics = {}
+    stages = {}
+    functions = [metric_function(name) for name in function_list]
+    for _ in range(repeat):
+        # A fresh parse per round, so that identity caches start cold.
+        seconds, (words, sents) = _timed(FeatureExtractor.parse_csv, path)
+        _best(stages, 'parse_csv', seconds)
+        total = 0.0
+        values = []
+        for name, function, arg in zip(function_list, functions, arglist):
+            args = (words,) if arg == 'words' else (sents,) if arg == 'sents' else (words, sents)
+            start = time.perf_counter()
+            try:
+                values.append(function(*args))
+            except ZeroDivisionError:
+                values.append(None)
+            seconds = time.perf_counter() - start
+            total += seconds
+            _best(metrics, name, seconds)
+        _best(stages, 'evaluate', total)
+    return metrics, stages, N_word(words), values
+
+
+def time_write(rows, function_list, repeat):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        extractor = FeatureExtractor.__new__(FeatureExtractor)
+        extractor.output_path = os.path.join(tmp_dir, 'metrics.csv')
+        extractor.function_list = function_list
+        return min(_timed(extractor.write_table, rows)[0] for _ in range(repeat))
+
+
+def time_annotation(corpus, repeat):
+    """Annotation stage timings per document, or ``None`` if natasha is unavailable."""
+    sys.path.insert(0, SRC_DIR)
+    try:
+        import extract_characteristics
+    except ImportError as error:
+        print(f'skipping annotation stages: {error}', file=sys.stderr)
+        return None
+    finally:
+        sys.path.remove(SRC_DIR)
+
+    components = extract_characteristics.initialize_analysis_components()
+    timings = {}
+    with open(os.path.join(corpus, 'reviews.csv'), newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            stages = {}
+            for _ in range(repeat):
+                seconds, processed = _timed(extract_characteristics.process_review, row['review'], *components)
+                _best(stages, 'process_review', seconds)
+                seconds, _ = _timed(extract_characteristics.convert_to_csv_format, [processed])
+                _best(stages, 'convert_to_csv_format', seconds)
+            timings[row['fname']] = stages
+    return timings
+
+
+def run(corpus, repeat=3, annotate=True):
+    prepare_lexicons()
+    function_list, arglist = read_feature_list()
+    docs_dir = os.path.join(corpus, 'docs')
+    names = sorted(name for name in os.listdir(docs_dir) if name.endswith('.csv'))
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'corpus': os.path.abspath(corpus),
+            'repeat': repeat,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'documents': {},
+        'metrics': {name: {} for name in function_list},
+        'stages': {},
+    }
+    rows = []
+    for name in names:
+        metrics, stages, tokens, values = time_metrics(os.path.join(docs_dir, name), function_list, arglist, repeat)
+        results['documents'][name] = {'tokens': tokens}
+        for metric, seconds in metrics.items():
+            results['metrics'][metric][name] = seconds
+        for stage, seconds in stages.items():
+            results['stages'].setdefault(stage, {})[name] = seconds
+        rows.append([name] + values)
+
+    results['stages']['write_table'] = {'all': time_write(rows, function_list, repeat)}
+    if annotate:
+        annotation = time_annotation(corpus, repeat)
+        for name, stages in (annotation or {}).items():
+            for stage, seconds in stages.items():
+                results['stages'].setdefault(stage, {})[name] = seconds
+    return results
+
+
+def _flatten(results):
+    flat = {}
+    for section in ('metrics', 'stages'):
+        for name, timings in results.get(section, {}).items():
+            for document, seconds in timings.items():
+                flat[(section, name, document)] = seconds
+    return flat
+
+
+def compare(baseline, current, threshold, min_seconds):
+    """Timings of ``current`` that are more than ``threshold`` slower than ``baseline``."""
+    old, new = _flatten(baseline), _flatten(current)
+    regressions = []
+    for key in sorted(old.keys() & new.keys()):
+        if max(old[key], new[key]) < min_seconds:
+            continue
+        if new[key] > old[key] * (1 + threshold):
+            regressions.append((*key, old[key], new[key]))
+    return regressions
+
+
+def report(regressions, threshold):
+    for section, name, document, old, new in regressions:
+        print(f'{section} {name} on {document}: {old:.6f}s -> {new:.6f}s (+{new / old - 1 if old else float("inf"):.0%})')
+    if regressions:
+        sys.exit(f'{len(regressions)} timings regressed by more than {threshold:.0%}')
+    print('no regressions')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark feature_extractor.py metrics and stages")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="time every metric and stage on a synthetic corpus")
+    run_parser.add_argument("--corpus", default="bench_corpus", help="corpus folder (generated if missing)")
+    run_parser.add_argument("--sizes", default=','.join(map(str, DEFAULT_SIZES)), help="document sizes for a generated corpus")
+    run_parser.add_argument("--output", default="bench.json", help="results file")
+    run_parser.add_argument("--repeat", default=3, type=int, help="runs per timing, the fastest is kept")
+    run_parser.add_argument("--no-annotate", action="store_true", help="skip the natasha/pymorphy2 annotation stages")
+    run_parser.add_argument("--baseline", default=None, help="compare against this results file")
+
+    compare_parser = subparsers.add_parser('compare', help="compare two results files")
+    compare_parser.add_argument("--baseline", required=True, help="baseline results file")
+    compare_parser.add_argument("--current", required=True, help="current results file")
+
+    for sub in (run_parser, compare_parser):
+        sub.add_argument("--threshold", default=0.2, type=float, help="allowed slowdown, 0.2 means 20%%")
+        sub.add_argument("--min-seconds", default=0.001, type=float, help="ignore timings below this in both files")
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        if not os.path.isdir(os.path.join(args.corpus, 'docs')):
+            generate_corpus(args.corpus, tuple(int(size) for size in args.sizes.split(',')))
+        results = run(args.corpus, args.repeat, not args.no_annotate)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1)
+        print(f'{args.output}: {len(results["documents"])} documents, {len(results["metrics"])} metrics')
+        current = results
+    else:
+        with open(args.current, encoding='utf-8') as f:
+            current = json.load(f)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        report(compare(baseline, current, args.threshold, args.min_seconds), args.threshold)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+Cohesion between every sentence and the ``k`` sentences before it.
+
+``Cohes_1`` and ``Cohes_2`` look at adjacent sentences only. These measures
+take a window of ``k`` preceding sentences (``k = 1`` gives the two legacy
+values exactly):
+
+* ``noun_overlap``: shared NOUN lemmas, summed over all sentence pairs at
+  most ``k`` apart (``Cohes_1`` for ``k = 1``).
+* ``lemma_overlap_pr``: share of the content lemmas of a sentence (nouns,
+  verbs, adjectives, adverbs, participles; each lemma once per sentence)
+  that occur in one of the ``k`` preceding sentences. The first sentence is
+  not counted.
+* ``aspect_pairs``: verb aspect/tense combinations (``_aspect_tense`` of
+  ``metric_state``) of both sentences, summed over all sentence pairs at
+  most ``k`` apart (``Cohes_2`` for ``k = 1``).
+* ``tense_continuity_pr``: share of the sentences with a finite verb whose
+  aspect/tense combinations share one with the ``k`` preceding sentences.
+* ``pronoun_reference_pr``: share of third-person pronouns that have a noun
+  of matching gender and number in the ``k`` preceding sentences, a proxy
+  for resolvable reference.
+
+Every sentence is reduced to a set of lemma ids and to bitmasks of its
+aspect/tense combinations and noun gender/number. All windows of a document
+are then computed with a few array operations, in ``O(n log n)`` in the
+number of lemma entries and ``O(n k)`` for the bitmasks. The legacy
+functions stay as they are; for reviews of a few sentences they are faster
+than setting up the arrays.
+
+    python cohesion.py --input-path=data --output-path=cohesion.csv --windows=1,3,5
+"""
+
+import argparse
+import csv
+import glob
+import os
+import re
+
+import numpy as np
+
+from feature_extractor import FeatureExtractor
+
+
+WINDOWS = (1, 3)
+CONTENT_POS = frozenset(('NOUN', 'VERB', 'INFN', 'ADJF', 'ADJS', 'COMP', 'ADVB', 'PRTF', 'PRTS', 'GRND'))
+MEASURES = ('noun_overlap', 'lemma_overlap_pr', 'aspect_pairs', 'tense_continuity_pr', 'pronoun_reference_pr')
+
+ASPECTS = ('impf', 'perf')
+TENSES = ('pres', 'past', 'futr')
+# Gender and number of nouns and pronouns: one bit each for masculine,
+# feminine and neuter singular, and one for plural
+AGREEMENT_BITS = {'masc': 1, 'femn': 2, 'neut': 4, 'Ms-f': 3}
+PLURAL = 8
+ANY_AGREEMENT = 15
+
+_GRAMMEMES = re.compile('[, ]')
+
+
+def aspect_tense_mask(tags):
+    """Bit ``3 * aspect + tense`` for every aspect/tense combination of a verb (``morph`` split on ',')."""
+    if 'VERB' not in tags:
+        return 0
+    mask = 0
+    for a, aspect in enumerate(ASPECTS):
+        if aspect in tags:
+            for t, tense in enumerate(TENSES):
+                if tense in tags:
+                    mask |= 1 << (3 * a + t)
+    return mask
+
+
+def agreement_mask(grammemes):
+    if 'plur' in grammemes:
+        return PLURAL
+    mask = 0
+    for grammeme, bit in AGREEMENT_BITS.items():
+        if grammeme in grammemes:
+            mask |= bit
+    return mask
+
+
+def _preceding(masks, k):
+    # OR of the masks of the k sentences before each sentence
+    result = np.zeros_like(masks)
+    for d in range(1, min(k, len(masks) - 1) + 1):
+        result[d:] |= masks[:-d]
+    return result
+
+
+class DocumentCohesion:
+    """Per-sentence lemma sets and bitmasks of a document (``parse_csv`` words)."""
+
+    def __init__(self, words):
+        self.sentences = len(words)
+        lemma_ids = {}
+        noun_keys, content_keys = [], []
+        aspect_masks, aspect_tokens, noun_masks = [], [], []
+        pronoun_sentences, pronoun_masks = [], []
+        for s, sentence in enumerate(words):
+            aspect_mask = noun_mask = tokens = 0
+            for item in sentence:
+                lemma, pos, morph = item['lemma'], item['pos'], item['morph']
+                if pos in CONTENT_POS:
+                    lemma_id = lemma_ids.setdefault(lemma, len(lemma_ids))
+                    content_keys.append((lemma_id, s))
+                    if pos == 'NOUN':
+                        noun_keys.append((lemma_id, s))
+                tags = morph.split(',')
+                token_mask = aspect_tense_mask(tags)
+                if token_mask:
+                    aspect_mask |= token_mask
+                    tokens += bin(token_mask).count('1')
+                if tags[0] == 'NOUN':
+                    noun_mask |= agreement_mask(_GRAMMEMES.split(morph))
+                elif tags[0] == 'NPRO':
+                    grammemes = _GRAMMEMES.split(morph)
+                    if '3per' in grammemes:
+                        pronoun_sentences.append(s)
+                        pronoun_masks.append(agreement_mask(grammemes) or ANY_AGREEMENT)
+            aspect_masks.append(aspect_mask)
+            # Cohes_2 counts the combinations of every verb token
+            aspect_tokens.append(tokens)
+            noun_masks.append(noun_mask)
+        self.nouns = self._entries(noun_keys)
+        self.content = self._entries(content_keys)
+        self.aspect_masks = np.array(aspect_masks, dtype=np.int64)
+        self.aspect_tokens = np.array(aspect_tokens, dtype=np.int64)
+        self.noun_masks = np.array(noun_masks, dtype=np.int64)
+        self.pronoun_sentences = np.array(pronoun_sentences, dtype=np.int64)
+        self.pronoun_masks = np.array(pronoun_masks, dtype=np.int64)
+
+    def _entries(self, keys):
+        # Distinct (lemma, sentence) entries as lemma * sentences + sentence, sorted
+        if not keys:
+            return np.zeros(0, dtype=np.int64)
+        keys = np.array(keys, dtype=np.int64)
+        return np.unique(keys[:, 0] * self.sentences + keys[:, 1])
+
+    def overlap_pairs(self, entries, k):
+        """Shared lemmas summed over all sentence pairs at most ``k`` apart."""
+        if not len(entries):
+            return 0
+        sentence = entries % self.sentences
+        # Entries of the same lemma in the k sentences before
+        lower = entries - np.minimum(sentence, k)
+        return int((np.arange(len(entries)) - np.searchsorted(entries, lower)).sum())
+
+    def overlap_share(self, entries, k):
+        sentence = entries % self.sentences
+        counted = sentence > 0
+        if not counted.any():
+            return np.nan
+        lemma = entries // self.sentences
+        seen = np.zeros(len(entries), dtype=bool)
+        seen[1:] = (lemma[1:] == lemma[:-1]) & (sentence[1:] - sentence[:-1] <= k)
+        return seen[counted].mean()
+
+    def aspect_pairs(self, k):
+        # Every sentence is in min(k, i) pairs with earlier and min(k, n - 1 - i) with later sentences
+        i = np.arange(self.sentences)
+        return int((self.aspect_tokens * (np.minimum(k, i) + np.minimum(k, self.sentences - 1 - i))).sum())
+
+    def tense_continuity(self, k):
+        counted = self.aspect_masks[1:] != 0
+        if not counted.any():
+            return np.nan
+        continued = (self.aspect_masks & _preceding(self.aspect_masks, k))[1:] != 0
+        return continued[counted].mean()
+
+    def pronoun_reference(self, k):
+        if not len(self.pronoun_sentences):
+            return np.nan
+        referents = _preceding(self.noun_masks, k)[self.pronoun_sentences]
+        return ((referents & self.pronoun_masks) != 0).mean()
+
+    def measures(self, k):
+        return {
+            'noun_overlap': self.overlap_pairs(self.nouns, k),
+            'lemma_overlap_pr': self.overlap_share(self.content, k),
+            'aspect_pairs': self.aspect_pairs(k),
+            'tense_continuity_pr': self.tense_continuity(k),
+            'pronoun_reference_pr': self.pronoun_reference(k),
+        }
+
+
+def cohesion_metrics(words, windows=WINDOWS):
+    """``{measure_k: value}`` for every measure and window size ``k``."""
+    document = DocumentCohesion(words)
+    return {f'{name}_{k}': value for k in windows for name, value in document.measures(k).items()}
+
+
+def parse_windows(text):
+    windows = tuple(int(k) for k in text.split(',') if k.strip())
+    if not windows or min(windows) < 1:
+        raise ValueError(f'windows must be positive integers: {text!r}')
+    return windows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cohesion of every document over windows of preceding sentences")
+    parser.add_argument("--input-path", default="./data", help="folder of annotated documents")
+    parser.add_argument("--output-path", default="cohesion.csv", help="output file name")
+    parser.add_argument("--windows", default=','.join(map(str, WINDOWS)), help="comma-separated numbers of preceding sentences")
+
+    args = parser.parse_args()
+    try:
+        windows = parse_windows(args.windows)
+    except ValueError as error:
+        parser.error(str(error))
+    if not os.path.isdir(args.input_path):
+        parser.error(f"--input-path: no such folder: {args.input_path}")
+
+    file_list = sorted(glob.glob(args.input_path + "/*.csv"))
+    columns = [f'{name}_{k}' for k in windows for name in MEASURES]
+    with open(args.output_path, "w", newline="", encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['fname'] + columns)
+        for file_path in file_list:
+            words, _ = FeatureExtractor.parse_csv(file_path)
+            values = cohesion_metrics(words, windows)
+            writer.writerow([os.path.basename(file_path)] + [values[name] for name in columns])
+    print(f'{args.output_path}: {len(file_list)} documents')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Exact and near-duplicate reviews, found before annotation.
+
+Exact duplicates (the same text after stripping surrounding whitespace) are
+found by hashing the whole text. Near duplicates are found with MinHash over
+character shingles and LSH banding. Texts are lowercased and runs of
+whitespace collapsed, then cut into ``shingle_size``-character shingles. Each
+text gets a signature of ``num_perm`` minimum hash values, and the share of
+equal signature positions of two texts estimates the Jaccard similarity of
+their shingle sets. Signatures are split into ``bands`` bands. Texts that
+agree on a whole band are candidates, and a candidate counts as a near
+duplicate when its estimated similarity reaches ``threshold``. With the
+defaults (128 values, 16 bands of 8) a pair at similarity 0.8 becomes a
+candidate with probability 0.95, and a pair at 0.5 with 0.06.
+
+Duplicates are grouped into clusters whose representative is their first
+row. ``extract_characteristics.py`` and ``pipeline.py`` annotate every
+distinct text once (``text_key``) and can drop all but the representatives
+(``--drop-duplicates``). The CLI only writes the report:
+
+    python dedup.py --data-path=reviews.csv --column-name=review --output=duplicates.csv
+"""
+
+import argparse
+import csv
+import hashlib
+import re
+import sys
+import zlib
+
+import numpy as np
+
+
+SHINGLE_SIZE = 5
+NUM_PERM = 128
+BANDS = 16
+THRESHOLD = 0.8
+
+_SPACES = re.compile(r'\s+')
+
+
+def _permutations(num_perm, seed=1):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 1 << 63, size=(num_perm, 1), dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.integers(0, 1 << 63, size=(num_perm, 1), dtype=np.uint64)
+    return a, b
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    text = _SPACES.sub(' ', text.lower()).strip()
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def text_key(text):
+    """Digest of a text without surrounding whitespace; equal texts, and in practice only they, have equal keys."""
+    return hashlib.blake2b(text.strip().encode('utf-8'), digest_size=16).digest()
+
+
+def signature(text, permutations, shingle_size=SHINGLE_SIZE):
+    hashes = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles(text, shingle_size)), dtype=np.uint64)
+    a, b = permutations
+    # Multiply-add-shift: (a * x + b) mod 2**64, high 32 bits
+    return ((a * hashes + b) >> np.uint64(32)).min(axis=1).astype(np.uint32)
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def find_duplicates(texts, threshold=THRESHOLD, shingle_size=SHINGLE_SIZE, num_perm=NUM_PERM, bands=BANDS):
+    """Duplicate rows of ``texts``.
+
+    Returns a list with one ``(representative, kind, similarity)`` tuple per
+    row. ``representative`` is the first row of the row's cluster (the row
+    itself for unique texts and representatives), ``kind`` is ``'unique'``,
+    ``'exact'`` or ``'near'``, and ``similarity`` the estimated Jaccard
+    similarity to the representative.
+    """
+    if num_perm % bands:
+        raise ValueError(f'num_perm ({num_perm}) must be a multiple of bands ({bands})')
+    rows = num_perm // bands
+    permutations = _permutations(num_perm)
+
+    first = {}
+    exact_of = []
+    signatures = []
+    parent = []
+    buckets = [{} for _ in range(bands)]
+    for i, text in enumerate(texts):
+        text = '' if text is None else str(text)
+        parent.append(i)
+        key = text_key(text)
+        if key in first:
+            exact_of.append(first[key])
+            signatures.append(signatures[first[key]])
+            parent[i] = _find(parent, first[key])
+            continue
+        first[key] = i
+        exact_of.append(i)
+        sig = signature(text, permutations, shingle_size)
+        signatures.append(sig)
+
+        candidates = set()
+        for band, bucket in enumerate(buckets):
+            members = bucket.setdefault(sig[band * rows:(band + 1) * rows].tobytes(), [])
+            candidates.update(members)
+            members.append(i)
+        if candidates:
+            candidates = np.fromiter(candidates, dtype=np.int64)
+            similar = (np.stack([signatures[j] for j in candidates]) == sig).mean(axis=1) >= threshold
+            for j in candidates[similar]:
+                root_i, root_j = _find(parent, i), _find(parent, int(j))
+                if root_i != root_j:
+                    parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    result = []
+    for i in range(len(parent)):
+        representative = _find(parent, i)
+        if representative == i:
+            result.append((i, 'unique', 1.0))
+        elif exact_of[i] == exact_of[representative]:
+            result.append((representative, 'exact', 1.0))
+        else:
+            result.append((representative, 'near', float((signatures[i] == signatures[representative]).mean())))
+    return result
+
+
+def summary(duplicates):
+    exact = sum(kind == 'exact' for _, kind, _ in duplicates)
+    near = sum(kind == 'near' for _, kind, _ in duplicates)
+    clusters = len({representative for representative, kind, _ in duplicates if kind != 'unique'})
+    return f'{len(duplicates)} rows: {exact} exact and {near} near duplicates in {clusters} clusters'
+
+
+def write_report(duplicates, path, ids=None):
+    """One CSV row per duplicate: the row, its cluster representative, kind and similarity."""
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['row', 'duplicate_of', 'kind', 'similarity'])
+        for i, (representative, kind, similarity) in enumerate(duplicates):
+            if kind != 'unique':
+                writer.writerow([ids[i] if ids else i, ids[representative] if ids else representative, kind, similarity])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report exact and near-duplicate reviews")
+    parser.add_argument("--data-path", required=True, help="CSV file with one review per row")
+    parser.add_argument("--column-name", required=True, help="review text column")
+    parser.add_argument("--id-column", default=None, help="column identifying a review in the report (default: row number)")
+    parser.add_argument("--output", default="duplicates.csv", help="report file")
+    parser.add_argument("--threshold", default=THRESHOLD, type=float, help="estimated Jaccard similarity of near duplicates")
+    parser.add_argument("--shingle-size", default=SHINGLE_SIZE, type=int, help="characters per shingle")
+
+    args = parser.parse_args()
+
+    csv.field_size_limit(sys.maxsize)
+    with open(args.data_path, newline='', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    duplicates = find_duplicates((row[args.column_name] for row in rows), args.threshold, args.shingle_size)
+    write_report(duplicates, args.output, [row[args.id_column] for row in rows] if args.id_column else None)
+    print(f'{args.output}: {summary(duplicates)}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,483 @@
+"""
+Drift monitor for a stream of per-document metric rows.
+
+Rows (``feature_extractor.py`` or ``pipeline.py`` output, one document per
+row) are consumed as they arrive, from a file that is still being written
+(``--follow``), from standard input or straight from ``pipeline.py
+--monitor-baseline``. Every row is assigned to a time window, by its
+``--time-column`` (epoch seconds or ISO 8601) or by its arrival time.
+
+Per ``--group-column`` group and metric the monitor keeps
+
+* a running count, mean and variance (Welford), mergeable between windows,
+* the running median and 90th percentile (P² estimator, five markers each),
+
+so memory depends on the number of groups, metrics and windows, never on
+the number of rows. A window is ``SECONDS`` (tumbling) or ``SECONDS/STEP``
+(sliding, a new window every ``STEP`` seconds). A sliding window is kept as
+``SECONDS / STEP`` buckets of ``STEP`` seconds, and its statistics are the
+merge of its buckets, so each row only updates its own bucket. Medians and
+percentiles are reported for tumbling windows and for the whole stream; P²
+estimators cannot be merged across buckets.
+
+When a window closes, the mean of every metric is compared with that of a
+baseline of human reviews (``--baseline``, a metrics table) with a Welch
+z-test. The p-values of the metrics of a window and group are adjusted like
+in ``group_compare.py``. A shift is flagged when the adjusted p-value is below
+``--alpha``, the window has at least ``--min-documents`` documents and
+Hedges' g is at least ``--min-effect``. Every window, group and metric is
+written as a row of ``--output`` as soon as the window closes, and flagged
+shifts are also printed. At the end of the stream, the open windows are
+closed and the whole stream is compared as the ``total`` window.
+
+Rows are expected roughly in time order. A row older than the current
+bucket counts towards the current bucket.
+
+    python drift_monitor.py --baseline=human_metrics.csv --metrics-path=generated_metrics.csv --follow --window=3600 --window=86400/3600
+    python drift_monitor.py --baseline=review_complexity.csv --group-column=source --baseline-group=actual --metrics-path=- --time-column=created_at --window=86400 < stream.csv
+"""
+
+import argparse
+import csv
+import math
+import os
+import sys
+import time
+from bisect import bisect_right, insort
+from collections import deque
+from datetime import datetime, timezone
+
+import numpy as np
+
+from annotation_layers import feature_names
+from group_compare import CORRECTIONS, hedges_g
+from review_sources import open_text
+
+
+QUANTILES = (0.5, 0.9)
+MIN_DOCUMENTS = 30
+ALPHA = 0.01
+# Columns that identify a document rather than measure it
+ID_COLUMNS = ('fname', 'review_id')
+# Seconds between reads of a followed file that has no new rows
+POLL_SECONDS = 1.0
+
+OUTPUT_COLUMNS = (
+    'window', 'start', 'end', 'group', 'metric', 'n', 'mean', 'std', 'median', 'p90',
+    'baseline_n', 'baseline_mean', 'difference', 'hedges_g', 'z', 'p_value', 'p_adjusted', 'drift',
+)
+
+
+class RunningStats:
+    """Count, mean and variance of a stream of values (Welford); NaNs are skipped."""
+
+    __slots__ = ('n', 'mean', 'm2')
+
+    def __init__(self, n=0, mean=0.0, m2=0.0):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+
+    def add(self, value):
+        if math.isnan(value):
+            return
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+    def merge(self, other):
+        """Statistics of both streams (Chan et al.)."""
+        n = self.n + other.n
+        if not n:
+            return RunningStats()
+        delta = other.mean - self.mean
+        return RunningStats(n, self.mean + delta * other.n / n, self.m2 + other.m2 + delta * delta * self.n * other.n / n)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else math.nan
+
+
+class P2Quantile:
+    """Running ``p`` quantile of a stream in constant memory (Jain and Chlamtac's P² algorithm)."""
+
+    __slots__ = ('p', 'heights', 'positions', 'desired', 'increments')
+
+    def __init__(self, p):
+        self.p = p
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, value):
+        if math.isnan(value):
+            return
+        h, n = self.heights, self.positions
+        if len(h) < 5:
+            insort(h, value)
+            return
+        if value < h[0]:
+            h[0] = value
+            k = 0
+        elif value >= h[4]:
+            h[4] = value
+            k = 3
+        else:
+            k = bisect_right(h, value) - 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = h[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1])
+                )
+                if not h[i - 1] < height < h[i + 1]:
+                    # Linear instead of parabolic where the parabola leaves the neighbours
+                    height = h[i] + d * (h[i + d] - h[i]) / (n[i + d] - n[i])
+                h[i] = height
+                n[i] += d
+
+    def value(self):
+        if not self.heights:
+            return math.nan
+        if len(self.heights) < 5:
+            return self.heights[round(self.p * (len(self.heights) - 1))]
+        return self.heights[2]
+
+
+class _Aggregate:
+    # Statistics of one group in one bucket, one entry per metric
+    __slots__ = ('stats', 'quantiles')
+
+    def __init__(self, size, with_quantiles):
+        self.stats = [RunningStats() for _ in range(size)]
+        self.quantiles = [[P2Quantile(p) for p in QUANTILES] for _ in range(size)] if with_quantiles else None
+
+    def add(self, values):
+        for stats, value in zip(self.stats, values):
+            stats.add(value)
+        if self.quantiles is not None:
+            for estimators, value in zip(self.quantiles, values):
+                for estimator in estimators:
+                    estimator.add(value)
+
+
+def parse_window(value):
+    """``(seconds, step)`` of ``SECONDS`` or ``SECONDS/STEP``."""
+    try:
+        length, _, step = value.partition('/')
+        length = float(length)
+        step = float(step) if step else length
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected a window like 3600 or 86400/3600, got {value!r}')
+    if length <= 0 or step <= 0 or step > length or abs(length / step - round(length / step)) > 1e-9:
+        raise argparse.ArgumentTypeError(f'window length must be a positive multiple of its step, got {value!r}')
+    return length, step
+
+
+class Window:
+    """Tumbling or sliding time window over ``size`` metrics, kept as buckets of ``step`` seconds."""
+
+    def __init__(self, length, step, size):
+        self.length = length
+        self.step = step
+        self.size = size
+        self.label = f'{length:g}' if step == length else f'{length:g}/{step:g}'
+        self.tumbling = step == length
+        self.buckets = deque([{}], maxlen=round(length / step))
+        self.current = None
+
+    def add(self, timestamp, group, values):
+        """Add a row; returns the windows closed before it, see ``advance``."""
+        closed = self.advance(timestamp)
+        if self.current is None:
+            self.current = math.floor(timestamp / self.step)
+        bucket = self.buckets[-1]
+        aggregate = bucket.get(group)
+        if aggregate is None:
+            aggregate = bucket[group] = _Aggregate(self.size, self.tumbling)
+        aggregate.add(values)
+        return closed
+
+    def advance(self, timestamp):
+        """Close the windows that end at or before ``timestamp``: ``[(start, end, {group: _Aggregate})]``."""
+        closed = []
+        index = math.floor(timestamp / self.step)
+        while self.current is not None and self.current < index:
+            closed.append(self._close())
+            self.current += 1
+            self.buckets.append({})
+            if not any(self.buckets):
+                # Nothing left in the window: skip the empty buckets up to now
+                self.current = index
+        return [window for window in closed if window[2]]
+
+    def close(self):
+        return [window for window in [self._close()] if window[2]] if self.current is not None else []
+
+    def _close(self):
+        end = (self.current + 1) * self.step
+        if self.tumbling:
+            return end - self.length, end, self.buckets[-1]
+        merged = {}
+        for bucket in self.buckets:
+            for group, aggregate in bucket.items():
+                if group not in merged:
+                    merged[group] = _Aggregate(self.size, False)
+                merged[group].stats = [a.merge(b) for a, b in zip(merged[group].stats, aggregate.stats)]
+        return end - self.length, end, merged
+
+
+def timestamp_text(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat(timespec='seconds') if seconds is not None else ''
+
+
+def parse_time(value):
+    """Epoch seconds of a number or an ISO 8601 date; naive dates are UTC."""
+    try:
+        return float(value)
+    except ValueError:
+        moment = datetime.fromisoformat(value)
+        return (moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)).timestamp()
+
+
+def number(value):
+    if isinstance(value, float):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def read_baseline(path, group_column=None, group=None, columns=None):
+    """``{metric: RunningStats}`` of a metrics table, of the rows of ``group`` only if given."""
+    with open_text(path) as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        if group is not None and group_column not in header:
+            raise ValueError(f'{path} has no column {group_column!r} for --baseline-group')
+        skipped = set(ID_COLUMNS) | {group_column}
+        metrics = [name for name in header if name not in skipped and (columns is None or name in columns)]
+        positions = [header.index(name) for name in metrics]
+        group_position = header.index(group_column) if group is not None else None
+        baseline = {name: RunningStats() for name in metrics}
+        stats = [baseline[name] for name in metrics]
+        for row in reader:
+            if group_position is not None and row[group_position] != group:
+                continue
+            for position, entry in zip(positions, stats):
+                entry.add(number(row[position]))
+    if not any(entry.n for entry in baseline.values()):
+        raise ValueError(f'{path} has no baseline values' + (f' in group {group!r}' if group is not None else ''))
+    return baseline
+
+
+class DriftMonitor:
+    """Windowed running statistics of ``metrics`` per group, tested against ``baseline`` as windows close.
+
+    ``add``, ``advance`` and ``close`` return the output rows of the windows
+    they close (``OUTPUT_COLUMNS``) and pass them to ``report`` if given.
+    """
+
+    def __init__(self, metrics, baseline, windows, alpha=ALPHA, correction='bh', min_documents=MIN_DOCUMENTS,
+                 min_effect=0.0, report=None):
+        self.metrics = [name for name in metrics if name in baseline]
+        self.baseline = [baseline[name] for name in self.metrics]
+        self.windows = [Window(length, step, len(self.metrics)) for length, step in windows]
+        self.totals = {}
+        self.first = self.last = None
+        self.documents = 0
+        self.alpha = alpha
+        self.correction = CORRECTIONS[correction]
+        self.min_documents = min_documents
+        self.min_effect = min_effect
+        self.report = report
+
+    def add(self, timestamp, group, values):
+        """Add a row; ``values`` maps the metric names to numbers or strings."""
+        if self.first is None:
+            self.first = self.last = timestamp
+        # Late rows count towards the current bucket
+        timestamp = self.last = max(self.last, timestamp)
+        self.documents += 1
+        row = [number(values.get(name)) for name in self.metrics]
+        total = self.totals.get(group)
+        if total is None:
+            total = self.totals[group] = _Aggregate(len(self.metrics), True)
+        total.add(row)
+        rows = []
+        for window in self.windows:
+            for start, end, aggregates in window.add(timestamp, group, row):
+                rows.extend(self._evaluate(window.label, start, end, aggregates))
+        return self._report(rows)
+
+    def advance(self, timestamp):
+        """Close the windows that have ended by ``timestamp``, also without new rows."""
+        rows = []
+        for window in self.windows:
+            for start, end, aggregates in window.advance(timestamp):
+                rows.extend(self._evaluate(window.label, start, end, aggregates))
+        return self._report(rows)
+
+    def close(self, timestamp=None):
+        """Close the open windows and compare the whole stream (``total``), which ends at ``timestamp`` or the last row."""
+        rows = []
+        for window in self.windows:
+            for start, end, aggregates in window.close():
+                rows.extend(self._evaluate(window.label, start, end, aggregates))
+        rows.extend(self._evaluate('total', self.first, timestamp if timestamp is not None else self.last, self.totals))
+        return self._report(rows)
+
+    def _report(self, rows):
+        if rows and self.report is not None:
+            self.report(rows)
+        return rows
+
+    def _evaluate(self, label, start, end, aggregates):
+        rows = []
+        for group in sorted(aggregates, key=str):
+            aggregate = aggregates[group]
+            n = np.array([stats.n for stats in aggregate.stats], dtype=np.float64)
+            mean = np.array([stats.mean if stats.n else math.nan for stats in aggregate.stats])
+            variance = np.array([stats.variance for stats in aggregate.stats])
+            base_n = np.array([stats.n for stats in self.baseline], dtype=np.float64)
+            base_mean = np.array([stats.mean if stats.n else math.nan for stats in self.baseline])
+            base_variance = np.array([stats.variance for stats in self.baseline])
+            with np.errstate(invalid='ignore', divide='ignore'):
+                z = (mean - base_mean) / np.sqrt(variance / n + base_variance / base_n)
+                z[~np.isfinite(z) | (n < max(2, self.min_documents))] = np.nan
+            p_value = np.array([math.erfc(abs(value) / math.sqrt(2)) for value in z])
+            adjusted = self.correction(p_value)
+            effect = hedges_g(base_n, base_mean, base_variance, n, mean, variance)
+            with np.errstate(invalid='ignore'):
+                drift = (adjusted < self.alpha) & (np.abs(effect) >= self.min_effect)
+            for k, name in enumerate(self.metrics):
+                quantiles = [estimator.value() for estimator in aggregate.quantiles[k]] if aggregate.quantiles else [math.nan] * len(QUANTILES)
+                rows.append([
+                    label, timestamp_text(start), timestamp_text(end), group, name, int(n[k]), mean[k],
+                    math.sqrt(variance[k]) if variance[k] >= 0 else math.nan, *quantiles,
+                    int(base_n[k]), base_mean[k], mean[k] - base_mean[k], float(effect[k]), z[k], p_value[k],
+                    adjusted[k], bool(drift[k]),
+                ])
+        return rows
+
+
+class ReportWriter:
+    """Writes monitor rows to a CSV file as they come and prints the flagged shifts."""
+
+    def __init__(self, path, stream=sys.stderr):
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(OUTPUT_COLUMNS)
+        self.stream = stream
+        self.flagged = 0
+
+    def __call__(self, rows):
+        self.writer.writerows(rows)
+        self.file.flush()
+        for row in rows:
+            if row[-1]:
+                self.flagged += 1
+                label, start, end, group, name, n, mean = row[:7]
+                print(f'drift: {name} in {group} ({label} window {start} - {end}, {n} documents): '
+                      f'mean {mean:.4g} vs baseline {row[11]:.4g}, g {row[13]:.2f}, p {row[16]:.2g}', file=self.stream)
+
+    def close(self):
+        self.file.close()
+
+
+def follow(f, poll=POLL_SECONDS, idle=None):
+    """Lines of a file that is still being written, waiting for new ones; calls ``idle()`` while waiting."""
+    partial = ''
+    while True:
+        line = f.readline()
+        if not line:
+            if idle is not None:
+                idle()
+            time.sleep(poll)
+            continue
+        partial += line
+        # A line is complete once its newline has been written
+        if partial.endswith('\n'):
+            yield partial
+            partial = ''
+
+
+def monitor_rows(monitor, rows, group_column=None, time_column=None):
+    """Feed the dict rows of a metrics table to ``monitor``."""
+    for row in rows:
+        timestamp = parse_time(row[time_column]) if time_column else time.time()
+        monitor.add(timestamp, row[group_column] if group_column else 'all', row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monitor a stream of per-document metrics for shifts against a baseline")
+    parser.add_argument("--baseline", required=True, help="metrics table of human reviews (feature_extractor.py or pipeline.py output)")
+    parser.add_argument("--metrics-path", default="-", help="metrics rows to monitor, - for standard input")
+    parser.add_argument("--follow", action="store_true", help="keep reading --metrics-path as it grows, until interrupted")
+    parser.add_argument("--window", action="append", type=parse_window, default=None,
+                        help="SECONDS for tumbling or SECONDS/STEP for sliding windows; repeat for several (default: 3600)")
+    parser.add_argument("--group-column", default=None, help="monitor every group of this column separately")
+    parser.add_argument("--baseline-group", default=None, help="only the baseline rows of this --group-column group")
+    parser.add_argument("--time-column", default=None, help="column with the time of a row (default: arrival time)")
+    parser.add_argument("--features", default="features.txt", help="metrics to monitor (default: features.txt)")
+    parser.add_argument("--alpha", default=ALPHA, type=float, help="significance level of the adjusted p-values")
+    parser.add_argument("--correction", default="bh", choices=sorted(CORRECTIONS), help="multiple-comparison correction")
+    parser.add_argument("--min-documents", default=MIN_DOCUMENTS, type=int, help="test windows with at least this many documents")
+    parser.add_argument("--min-effect", default=0.0, type=float, help="flag shifts with at least this absolute Hedges' g")
+    parser.add_argument("--output", default="drift.csv", help="statistics of every closed window, group and metric")
+
+    args = parser.parse_args()
+    if args.baseline_group is not None and args.group_column is None:
+        parser.error("--baseline-group needs --group-column")
+    if args.follow and args.metrics_path == '-':
+        parser.error("--follow needs a --metrics-path file")
+
+    columns = set(feature_names(args.features)) if os.path.exists(args.features) else None
+    try:
+        baseline = read_baseline(args.baseline, args.group_column, args.baseline_group, columns)
+    except ValueError as error:
+        sys.exit(str(error))
+
+    csv.field_size_limit(sys.maxsize)
+    f = sys.stdin if args.metrics_path == '-' else open_text(args.metrics_path)
+    monitor = None
+
+    def idle():
+        # Without row times, windows also close while no rows come
+        if monitor is not None and not args.time_column:
+            monitor.advance(time.time())
+
+    lines = follow(f, idle=idle) if args.follow else f
+    reader = csv.DictReader(lines)
+    header = reader.fieldnames or []
+    for name in (args.group_column, args.time_column):
+        if name and name not in header:
+            sys.exit(f"{args.metrics_path} has no column {name!r}")
+    metrics = [name for name in header if name in baseline]
+    if not metrics:
+        sys.exit(f"{args.metrics_path} has none of the baseline metrics")
+
+    report = ReportWriter(args.output)
+    monitor = DriftMonitor(metrics, baseline, args.window or [(3600.0, 3600.0)], args.alpha, args.correction,
+                           args.min_documents, args.min_effect, report)
+    try:
+        monitor_rows(monitor, reader, args.group_column, args.time_column)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.close(None if args.time_column else time.time())
+        report.close()
+    print(f'{args.output}: {monitor.documents} documents, {report.flagged} shifts flagged')
+
+
+if __name__ == "__main__":
+    main()
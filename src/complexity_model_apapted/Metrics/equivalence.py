@@ -0,0 +1,333 @@
+"""
+Reference-vs-candidate equivalence check for metric engines.
+
+The reference is a golden table of the ``feature_extractor.py`` of
+``BASELINE_REVISION``, the commit before any engine was added. It is
+evaluated from git on the input folder, or read from ``--golden``; a
+``--golden`` file that does not exist yet is written from the baseline first,
+so later checks reuse it. ``--reference=legacy`` evaluates the current
+per-function metrics live instead. The candidate is one of ``ENGINES``:
+
+* ``state``: ``metric_state.DocumentState`` and ``finalize``,
+* ``approximate``: the same with the sketch-based vocabulary metrics,
+* ``batch``: the batch metric API (``feature_extractor.py --batch-size``),
+* ``store``: the legacy functions on documents read back from a token store
+  (``feature_extractor.py --store``).
+
+Both are evaluated on every document of the input folder, ``--batch-size``
+documents at a time, and the report gives the maximum absolute and relative
+difference per column, the number of documents that differ, and the worst
+document.
+
+Differences that are known and accepted are listed in ``ALLOWED_DIFFERENCES``
+with their reason, for one reference and one engine or all engines. They are
+reported but do not fail the check unless ``--strict`` is given. Columns
+that an engine only estimates have their own relative tolerance in
+``ENGINE_TOLERANCES``. Any other column that differs beyond the tolerance
+fails it (exit status 1).
+
+    python equivalence.py --input-path=data --engine=state
+    python equivalence.py --input-path=data --engine=state --golden=golden_metrics.csv --output=report.csv
+    python equivalence.py --input-path=data --engine=state --reference=legacy
+
+The baseline reads ``Dictionaries/zipf_dict.csv``, the source of
+``zipf_dict.lex``, so it has to be in the ``Dictionaries`` folder.
+"""
+
+import argparse
+import csv
+import importlib.util
+import math
+import os
+import subprocess
+import sys
+import tempfile
+
+from tqdm import tqdm
+
+from batch_metrics import DocumentBatch, evaluate_batch
+from feature_extractor import (
+    FeatureExtractor, Token, evaluate_metrics, lexicons, metric_function, prepare_lexicons, read_feature_list,
+    resolve_batch_metrics,
+)
+from metric_state import DocumentState, finalize
+from review_sources import annotated_documents
+from token_store import TokenStore, build_store
+
+
+# Legacy metrics split pymorphy2 tags on ',' only, so grammemes after the
+# space ('NOUN,inan,masc sing,gent' -> [..., 'masc sing', 'gent']) are not
+# seen on their own. An engine that also splits on spaces counts more.
+MORPH_SPLIT_COLUMNS = (
+    'Gen_pr', 'Ablt_pr', 'datv', 'nomn', 'loct', 'Neut_pr', 'Inan_pr', 'P1_pr', 'P3_pr',
+    'Pres_pr', 'Futr_pr', 'Past_pr', 'Pos_ngrams_7_pr', 'Cohes_2',
+)
+
+# Legacy quirks that an engine may fix: column -> reason
+_LEGACY_QUIRKS = {
+    'punct': 'parse_csv drops tokens that are neither alphabetic nor contain "-" before punct counts punctuation',
+    'comma_pr': 'parse_csv drops "," tokens before comma_pr counts them',
+    **{column: 'legacy morph tags are split on "," only' for column in MORPH_SPLIT_COLUMNS},
+}
+
+# The commit whose feature_extractor.py is the golden reference
+BASELINE_REVISION = 'f0cc26f7217dea04e9702351bb3e9dbf0482db93'
+
+# (reference, engine) -> {column: reason}; engine None stands for every
+# engine. The reference is 'legacy' (evaluated live) or 'golden'.
+ALLOWED_DIFFERENCES = {
+    ('golden', None): {
+        'Zipf_8_pr': 'the baseline and outputs written before the Zipf_8_pr fix count Zipf band 3 instead of band 8',
+    },
+    **{(reference, engine): _LEGACY_QUIRKS
+       for reference in ('legacy', 'golden') for engine in ('state', 'approximate', 'batch', 'store')},
+}
+
+# engine -> {column: relative tolerance} for the columns it only estimates,
+# a few standard errors of the sketches (see sketches.py)
+ENGINE_TOLERANCES = {
+    'approximate': {
+        **dict.fromkeys(('V_word', 'V_lemma', 'TTR_word', 'TTR_lemma'), 0.05),
+        **dict.fromkeys(('N_lemma', 'YulesK_word', 'YulesK_lemma', 'YulesI_word', 'YulesI_lemma'), 0.1),
+        **dict.fromkeys(('hapax1_pr', 'hapax2_pr'), 0.2),
+    },
+}
+
+
+def legacy_metrics(words, sents, function_list, arglist, lookup=metric_function):
+    values = {}
+    for name, arg in zip(function_list, arglist):
+        function = lookup(name)
+        try:
+            values[name] = function(words) if arg == 'words' else function(sents) if arg == 'sents' else function(words, sents)
+        except ZeroDivisionError:
+            values[name] = math.nan
+    return values
+
+
+# An engine takes ``(name, words, sents)`` documents and returns one
+# ``{column: value}`` per document.
+
+def state_metrics(documents, function_list, arglist):
+    return [finalize(DocumentState.from_document(words, sents, lexicons), lexicons) for _, words, sents in documents]
+
+
+def approximate_metrics(documents, function_list, arglist):
+    return [finalize(DocumentState.from_document(words, sents, lexicons, approximate=True), lexicons)
+            for _, words, sents in documents]
+
+
+def batch_engine_metrics(documents, function_list, arglist):
+    # A ratio of a document without words is nan, as in the reference
+    rows = evaluate_batch(DocumentBatch.from_documents(documents), resolve_batch_metrics(function_list, arglist), errors=[])
+    return [dict(zip(function_list, row)) for row in rows]
+
+
+def store_metrics(documents, function_list, arglist):
+    functions = [metric_function(name) for name in function_list]
+    values = []
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'documents.tokens')
+        build_store(path, documents)
+        store = TokenStore(path)
+        for position in range(len(store)):
+            words, sents = store.document(position, Token)
+            # A ratio of a document without words is nan, as in the reference
+            values.append(dict(zip(function_list, evaluate_metrics(words, sents, functions, arglist, errors=[]))))
+    return values
+
+
+ENGINES = {
+    'state': state_metrics,
+    'approximate': approximate_metrics,
+    'batch': batch_engine_metrics,
+    'store': store_metrics,
+}
+
+
+def allowed_differences(reference, engine):
+    """``{column: reason}`` of the differences allowed between ``reference`` and ``engine``."""
+    return {**ALLOWED_DIFFERENCES.get((reference, None), {}), **ALLOWED_DIFFERENCES.get((reference, engine), {})}
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def difference(reference, candidate):
+    """``(absolute, relative)`` difference; NaN equals NaN."""
+    a, b = _number(reference), _number(candidate)
+    if math.isnan(a) and math.isnan(b) or a == b:
+        return 0.0, 0.0
+    if math.isnan(a) or math.isnan(b) or math.isinf(a) or math.isinf(b):
+        return math.inf, math.inf
+    absolute = abs(a - b)
+    return absolute, absolute / max(abs(a), abs(b))
+
+
+def read_golden(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        return {row['fname']: row for row in csv.DictReader(f)}
+
+
+def _import_baseline(folder, revision):
+    """Check ``feature_extractor.py`` and ``features.txt`` of ``revision`` out into ``folder`` and import them."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    prefix = subprocess.run(['git', 'rev-parse', '--show-prefix'], cwd=here, capture_output=True, text=True,
+                            check=True).stdout.strip()
+    for name in ('feature_extractor.py', 'features.txt'):
+        source = subprocess.run(['git', 'show', f'{revision}:{prefix}{name}'], cwd=here, capture_output=True,
+                                check=True).stdout
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(source)
+    os.symlink(os.path.join(here, 'Dictionaries'), os.path.join(folder, 'Dictionaries'))
+
+    # The baseline reads its dictionaries and feature list relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        spec = importlib.util.spec_from_file_location('baseline_feature_extractor', 'feature_extractor.py')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module, module.FeatureExtractor(folder, None, 1)
+    finally:
+        os.chdir(cwd)
+
+
+def baseline_golden(file_list, revision=BASELINE_REVISION):
+    """Golden table ``{fname: {column: value}}`` of the ``feature_extractor.py`` of ``revision``."""
+    with tempfile.TemporaryDirectory() as folder:
+        module, extractor = _import_baseline(folder, revision)
+    golden = {}
+    for path in tqdm(file_list, unit='doc', desc='baseline'):
+        words, sents = extractor.parse_csv(path)
+        golden[os.path.basename(path)] = {
+            'fname': os.path.basename(path),
+            **legacy_metrics(words, sents, extractor.function_list, extractor.arglist,
+                             lambda name: getattr(module, name)),
+        }
+    return golden
+
+
+def write_golden(golden, path):
+    columns = list(next(iter(golden.values()), {'fname': None}))
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(golden.values())
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def compare(file_list, engine, golden=None, atol=1e-12, rtol=1e-9, tolerances=None, batch_size=64):
+    """Per-column comparison of the reference and ``engine`` over ``file_list``.
+
+    ``tolerances`` maps columns to a relative tolerance used instead of ``rtol``.
+    """
+    prepare_lexicons()
+    function_list, arglist = read_feature_list()
+    tolerances = tolerances or {}
+    columns = {name: {'max_abs': 0.0, 'max_rel': 0.0, 'documents': 0, 'worst': None, 'compared': 0} for name in function_list}
+
+    if golden is not None:
+        file_list = [path for path in file_list if os.path.basename(path) in golden]
+    progress = tqdm(total=len(file_list), unit='doc')
+    for chunk in _chunks(file_list, batch_size):
+        documents = [(os.path.basename(path), *FeatureExtractor.parse_csv(path)) for path in chunk]
+        candidates = engine(documents, function_list, arglist)
+        for (fname, words, sents), candidate in zip(documents, candidates):
+            reference = golden[fname] if golden is not None else legacy_metrics(words, sents, function_list, arglist)
+            for name, column in columns.items():
+                if name not in reference:
+                    continue
+                absolute, relative = difference(reference[name], candidate[name])
+                column['compared'] += 1
+                scale = max(abs(_number(reference[name])), abs(_number(candidate[name])), 0.0)
+                if absolute > atol + tolerances.get(name, rtol) * scale or math.isinf(absolute):
+                    column['documents'] += 1
+                    if column['worst'] is None or absolute > column['max_abs']:
+                        column['worst'] = fname
+                column['max_abs'] = max(column['max_abs'], absolute)
+                column['max_rel'] = max(column['max_rel'], relative)
+        progress.update(len(chunk))
+    progress.close()
+    return columns
+
+
+def status(name, column, allowed, strict=False):
+    if not column['compared']:
+        return 'missing'
+    if not column['documents']:
+        return 'ok'
+    return 'allowed' if name in allowed and not strict else 'FAIL'
+
+
+def reason(name, allowed):
+    return allowed.get(name, '')
+
+
+def write_report(columns, path, allowed, strict=False):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['column', 'status', 'max_abs', 'max_rel', 'documents', 'compared', 'worst', 'reason'])
+        for name, column in columns.items():
+            writer.writerow([
+                name, status(name, column, allowed, strict), column['max_abs'], column['max_rel'], column['documents'],
+                column['compared'], column['worst'] or '', reason(name, allowed),
+            ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check a metric engine against the baseline or the legacy metrics")
+    parser.add_argument("--input-path", default="./data", help="folder of annotated documents")
+    parser.add_argument("--engine", default="state", choices=sorted(ENGINES), help="candidate engine")
+    parser.add_argument("--reference", default="golden", choices=["golden", "legacy"],
+                        help="golden table of the baseline commit, or the current functions evaluated live")
+    parser.add_argument("--golden", default=None,
+                        help="golden metrics CSV; written from the baseline commit if it does not exist")
+    parser.add_argument("--revision", default=BASELINE_REVISION, help="commit the golden table is written from")
+    parser.add_argument("--output", default=None, help="write the per-column report to this CSV file")
+    parser.add_argument("--atol", default=1e-12, type=float, help="absolute tolerance")
+    parser.add_argument("--rtol", default=1e-9, type=float, help="relative tolerance of the columns the engine computes exactly")
+    parser.add_argument("--strict", action="store_true", help="fail on allowlisted differences too")
+    parser.add_argument("--batch-size", default=64, type=int, help="documents handed to the engine at a time")
+
+    args = parser.parse_args()
+
+    file_list = sorted(annotated_documents(args.input_path))
+    golden = None
+    if args.reference == 'golden':
+        if args.golden and os.path.exists(args.golden):
+            golden = read_golden(args.golden)
+        else:
+            golden = baseline_golden(file_list, args.revision)
+            if args.golden:
+                write_golden(golden, args.golden)
+    allowed = allowed_differences(args.reference, args.engine)
+    columns = compare(file_list, ENGINES[args.engine], golden, args.atol, args.rtol, ENGINE_TOLERANCES.get(args.engine),
+                      args.batch_size)
+    if args.output:
+        write_report(columns, args.output, allowed, args.strict)
+
+    failed = 0
+    for name, column in columns.items():
+        result = status(name, column, allowed, args.strict)
+        if result == 'ok':
+            continue
+        failed += result == 'FAIL'
+        print(f"{result:8} {name}: max abs {column['max_abs']:.3g}, max rel {column['max_rel']:.3g}, "
+              f"{column['documents']}/{column['compared']} documents, worst {column['worst']}"
+              + (f" ({reason(name, allowed)})" if reason(name, allowed) else ''))
+    if failed:
+        sys.exit(f'{failed} columns differ from the reference')
+    print(f'{args.engine}: equivalent on {len(file_list)} documents')
+
+
+if __name__ == "__main__":
+    main()
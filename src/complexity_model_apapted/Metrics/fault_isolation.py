@@ -0,0 +1,232 @@
+"""
+Keeping a run going when single documents fail.
+
+``WorkerPool`` replaces ``multiprocessing.Pool`` in ``feature_extractor.py``.
+Like ``Pool.imap`` it hands chunks of items to worker processes and yields
+one result per item in input order. Unlike ``Pool``, a worker that exceeds
+its time (``timeout`` seconds per item of the chunk) is killed, and a worker
+that dies is replaced. Its chunk is split, and every item is retried on its
+own, so only the item that caused the trouble is lost:
+
+* an item that times out or raises fails at once,
+* an item whose worker dies is requeued, up to ``MAX_ATTEMPTS`` attempts,
+
+and a failed item gets the result of ``failed(item, stage, message)``.
+
+``ErrorLog`` collects what went wrong as JSON lines (document, stage, metric
+and the exception). ``time_limit`` bounds a call in the main thread (with
+``SIGALRM``), for the annotation of one review in
+``extract_characteristics.py``. This module has no sibling imports, so that
+it can be used from the package as well.
+"""
+
+import collections
+import json
+import multiprocessing
+import os
+import signal
+import time
+import traceback
+from contextlib import contextmanager
+from multiprocessing.connection import wait
+
+
+MAX_ATTEMPTS = 2
+# Workers that do not stop on request within this time are terminated
+SHUTDOWN_SECONDS = 5
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+def describe(error):
+    """``ExceptionType: message`` of an exception."""
+    message = str(error)
+    return f'{type(error).__name__}: {message}' if message else type(error).__name__
+
+
+class ErrorLog:
+
+    def __init__(self):
+        self.records = []
+
+    def add(self, name, stage, error, metric=None):
+        self.records.append({
+            'fname': name, 'stage': stage, 'metric': metric,
+            'error': describe(error) if isinstance(error, BaseException) else error,
+        })
+
+    def extend(self, records):
+        self.records.extend(records)
+
+    def summary(self):
+        documents = len({record['fname'] for record in self.records})
+        stages = collections.Counter(record['stage'] for record in self.records)
+        return f'{documents} documents with errors ({", ".join(f"{stage} {n}" for stage, n in sorted(stages.items()))})'
+
+    def write(self, path):
+        """Write the records as JSON lines; an old log at ``path`` is removed when there are none."""
+        if not self.records:
+            if os.path.isfile(path):
+                os.remove(path)
+            return
+        tmp_path = f'{path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w', encoding='utf-8') as fp:
+            for record in self.records:
+                fp.write(json.dumps(record, ensure_ascii=False) + '\n')
+        os.replace(tmp_path, path)
+
+
+@contextmanager
+def time_limit(seconds):
+    """Raise ``TaskTimeout`` in the block after ``seconds``; no limit for ``None`` or without ``SIGALRM``."""
+    if not seconds or not hasattr(signal, 'setitimer'):
+        yield
+        return
+
+    def expire(signum, frame):
+        raise TaskTimeout(f'no result after {seconds} s')
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _serve(connection, function, initializer, initargs):
+    try:
+        if initializer is not None:
+            initializer(*initargs)
+    except BaseException:
+        connection.send(('failed', traceback.format_exc()))
+        return
+    connection.send(('ready', None))
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        try:
+            connection.send(('done', function(task)))
+        except Exception as error:
+            connection.send(('error', describe(error)))
+
+
+class _Worker:
+
+    def __init__(self, function, initializer, initargs):
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve, args=(child, function, initializer, initargs), daemon=True)
+        self.process.start()
+        child.close()
+        self.ready = False
+        self.task = None
+        self.deadline = None
+
+    def stop(self, kill=False):
+        if kill:
+            self.process.kill()
+        else:
+            try:
+                self.connection.send(None)
+            except OSError:
+                pass
+            self.process.join(SHUTDOWN_SECONDS)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.process.join()
+        self.connection.close()
+
+
+class WorkerPool:
+    """``processes`` workers that apply ``function`` to chunks (lists) of items, see the module docstring.
+
+    ``function`` returns a list with one result per item of its chunk;
+    ``initializer(*initargs)`` runs once in every worker, also in the
+    workers that replace dead ones.
+    """
+
+    def __init__(self, processes, function, initializer=None, initargs=(), timeout=None, max_attempts=MAX_ATTEMPTS):
+        self.processes = max(1, processes)
+        self.function = function
+        self.initializer = initializer
+        self.initargs = initargs
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+
+    def _start(self):
+        return _Worker(self.function, self.initializer, self.initargs)
+
+    def imap(self, items, failed, chunksize=1):
+        items = list(items)
+        # Tasks are (index of the first item, chunk, attempts)
+        queue = collections.deque((start, items[start:start + chunksize], 0) for start in range(0, len(items), chunksize))
+        results = {}
+        next_index = 0
+        workers = [self._start() for _ in range(min(self.processes, len(queue)))]
+
+        def fail(task, stage, message, retry=False):
+            start, chunk, attempts = task
+            if len(chunk) > 1:
+                # Every item on its own, so that only the culprit fails
+                queue.extendleft((start + k, [item], 0) for k, item in reversed(list(enumerate(chunk))))
+            elif retry and attempts + 1 < self.max_attempts:
+                queue.appendleft((start, chunk, attempts + 1))
+            else:
+                results[start] = failed(chunk[0], stage, message)
+
+        try:
+            while next_index < len(items):
+                now = time.monotonic()
+                for worker in workers:
+                    if worker.ready and worker.task is None and queue:
+                        worker.task = queue.popleft()
+                        worker.connection.send(worker.task[1])
+                        worker.deadline = now + self.timeout * len(worker.task[1]) if self.timeout else None
+                deadlines = [worker.deadline for worker in workers if worker.deadline is not None]
+                wait([worker.connection for worker in workers] + [worker.process.sentinel for worker in workers],
+                     max(0.0, min(deadlines) - now) if deadlines else None)
+
+                now = time.monotonic()
+                for position, worker in enumerate(workers):
+                    message = None
+                    if worker.connection.poll():
+                        try:
+                            message = worker.connection.recv()
+                        except EOFError:
+                            pass
+                    if message is not None:
+                        kind, payload = message
+                        if kind == 'failed':
+                            raise RuntimeError(f'worker initialization failed:\n{payload}')
+                        if kind == 'ready':
+                            worker.ready = True
+                            continue
+                        start, chunk, _ = worker.task
+                        if kind == 'done':
+                            for k, result in enumerate(payload):
+                                results[start + k] = result
+                        else:
+                            fail(worker.task, 'error', payload)
+                        worker.task = worker.deadline = None
+                    elif not worker.process.is_alive():
+                        worker.stop()
+                        if not worker.ready:
+                            raise RuntimeError(f'worker died during initialization (exit code {worker.process.exitcode})')
+                        if worker.task is not None:
+                            fail(worker.task, 'worker', f'worker died (exit code {worker.process.exitcode})', retry=True)
+                        workers[position] = self._start()
+                    elif worker.deadline is not None and now >= worker.deadline:
+                        worker.stop(kill=True)
+                        fail(worker.task, 'timeout', f'no result after {self.timeout * len(worker.task[1]):g} s')
+                        workers[position] = self._start()
+
+                while next_index in results:
+                    yield results.pop(next_index)
+                    next_index += 1
+        finally:
+            for worker in workers:
+                worker.stop(kill=next_index < len(items))
@@ -16,16 +16,35 @@ Significant modifications have been made to adapt the original ideas to the spec
 
 """
 
+import time
+
+# Taken before any other import, for the startup time of --report
+STARTED = time.perf_counter()
+
 import argparse
 import csv
-import glob
+import functools
+import json
 import math 
 import os
+import random
 import re
-from multiprocessing import Pool, cpu_count
+import sys
+from sys import intern
 from collections import Counter
 
-from tqdm import tqdm
+import numpy as np
+
+from instrumentation import Instrumentation, peak_rss_bytes, profile_call
+from lexicon import LexiconStore
+from review_sources import annotated_documents, open_text
+
+# The modules of the optional modes (batches, plugins, stores, shards, the
+# index, states, sketches and language models) and the worker pool, with
+# multiprocessing, are imported where they are used, so that --help and
+# short runs do not pay for them.
+
+IMPORTED = time.perf_counter()
 
 
 def N_word(words):
@@ -405,109 +424,83 @@ def Dyn_Stat(words):
         return 0
 
 
-with open("./Dictionaries/zipf_dict.csv", encoding='utf-8') as fp:
-    reader = csv.reader(fp, delimiter="\t", quotechar='"')
-    next(reader, None)
-    zipf_dict = {row[0]: int(row[13]) for row in reader}
+lexicons = LexiconStore("./Dictionaries")
+ZIPF_BANDS = 9
+_zipf_cache = (None, None)
+
+
+def zipf_band_counts(words):
+    # The nine Zipf_*_pr metrics are evaluated one after another on the same
+    # document, so the band histogram is computed once and reused.
+    global _zipf_cache
+    if _zipf_cache[0] is not words:
+        bands = lexicons.frozen('zipf_dict').lookup([item['lemma'] for sublist in words for item in sublist])
+        counts = np.bincount(bands[(bands >= 0) & (bands < ZIPF_BANDS)], minlength=ZIPF_BANDS)
+        _zipf_cache = (words, counts.tolist())
+    return _zipf_cache[1]
+
+
+_match_cache = (None, {})
+
+
+def _list_matches(words, name, match):
+    # The matches of every list in the current document, shared by the
+    # dictionary metrics and the inverted index (document_postings)
+    global _match_cache
+    if _match_cache[0] is not words:
+        _match_cache = (words, {})
+    if name not in _match_cache[1]:
+        _match_cache[1][name] = match([item[LIST_FIELDS[name]].lower() for sublist in words for item in sublist])
+    return _match_cache[1][name]
+
+
+def word_list_matches(words, name):
+    """Whether every token is in the word list ``name``."""
+    return _list_matches(words, name, lexicons.word_list(name).contains)
+
+
+def phrase_list_matches(words, name):
+    """The text the phrase list ``name`` is matched in and its ``FrozenPatternSet.find`` matches."""
+    def match(tokens):
+        text = ' '.join(tokens)
+        return text, lexicons.phrase_list(name).find(text)
+    return _list_matches(words, name, match)
 
 
 def Zipf_0_pr(words):
-    n = 0
-    for word in [item['lemma'] for sublist in words for item in sublist]:
-        try:
-            if zipf_dict[word] == 0:
-                n+=1
-        except:
-            pass
-    return n / N_word(words)
+    return zipf_band_counts(words)[0] / N_word(words)
 
 
 def Zipf_1_pr(words):
-    n = 0
-    for word in [item['lemma'] for sublist in words for item in sublist]:
-        try:
-            if zipf_dict[word] == 1:
-                n+=1
-        except:
-            pass
-    return n / N_word(words)
+    return zipf_band_counts(words)[1] / N_word(words)
 
 
 def Zipf_2_pr(words):
-    n = 0
-    for word in [item['lemma'] for sublist in words for item in sublist]:
-        try:
-            if zipf_dict[word] == 2:
-                n+=1
-        except:
-            pass
-    return n / N_word(words)
+    return zipf_band_counts(words)[2] / N_word(words)
 
 
 def Zipf_3_pr(words):
-    n = 0
-    for word in [item['lemma'] for sublist in words for item in sublist]:
-        try:
-            if zipf_dict[word] == 3:
-                n+=1
-        except:
-            pass
-    return n / N_word(words)
+    return zipf_band_counts(words)[3] / N_word(words)
 
 
 def Zipf_4_pr(words):
-    n = 0
-    for word in [item['lemma'] for sublist in words for item in sublist]:
-        try:
-            if zipf_dict[word] == 4:
-                n+=1
-        except:
-            pass
-    return n / N_word(words)
+    return zipf_band_counts(words)[4] / N_word(words)
 
 
 def Zipf_5_pr(words):
-    n = 0
-    for word in [item['lemma'] for sublist in words for item in sublist]:
-        try:
-            if zipf_dict[word] == 5:
-                n+=1
-        except:
-            pass
-    return n / N_word(words)
+    return zipf_band_counts(words)[5] / N_word(words)
 
 
 def Zipf_6_pr(words):
-    n = 0
-    for word in [item['lemma'] for sublist in words for item in sublist]:
-        try:
-            if zipf_dict[word] == 6:
-                n+=1
-        except:
-            pass
-    return n / N_word(words)
+    return zipf_band_counts(words)[6] / N_word(words)
 
 
 def Zipf_7_pr(words):
-    n = 0
-    for word in [item['lemma'] for sublist in words for item in sublist]:
-        try:
-            if zipf_dict[word] == 7:
-                n+=1
-        except:
-            pass
-    return n / N_word(words)
+    return zipf_band_counts(words)[7] / N_word(words)
 
 
 def Zipf_8_pr(words):
-    n = 0
-    for word in [item['lemma'] for sublist in words for item in sublist]:
-        try:
-            if zipf_dict[word] == 3:
-                n+=1
-        except:
-            pass
-    return n / N_word(words)
+    return zipf_band_counts(words)[8] / N_word(words)
 
 
 def Word_form(words):
@@ -686,45 +679,23 @@ def Yavl_pr(words):
     return n / N_word(words)
 
 
-with open('./Dictionaries/Textdeixis.txt', encoding='utf-8') as file:
-    lines = file.readlines()
-    Textdeixis = [line.rstrip() for line in lines]
-    
-
 def Textdeixis_pr(words):
     wsw = [item['word'] for sublist in words for item in sublist]
+    Textdeixis = lexicons.prefixes('Textdeixis')
     n = 0
     for i in wsw:
-        if i.startswith(tuple(Textdeixis)):
+        if i.startswith(Textdeixis):
             n+=1
     return n / N_word(words)
 
 
-with open('./Dictionaries/Sokr.txt', encoding='utf-8') as file:
-    lines = file.readlines()
-    Sokr = [line.rstrip() for line in lines]
-    
-
 def Sokr_pr(words):
-    wsw = [item['word'].lower() for sublist in words for item in sublist]
-    n = 0
-    for i in wsw:
-        if i in Sokr:
-            n+=1
+    n = int(word_list_matches(words, 'Sokr').sum())
     return n / N_word(words)
 
 
-with open('./Dictionaries/Abbr.txt', encoding='utf-8') as file:
-    lines = file.readlines()
-    Abbr = [line.rstrip() for line in lines]
-    
-
 def Abbr_pr(words):
-    wsw = [item['word'].lower() for sublist in words for item in sublist]
-    n = 0
-    for i in wsw:
-        if i in Abbr:
-            n+=1
+    n = int(word_list_matches(words, 'Abbr').sum())
     return n / N_word(words)
 
 
@@ -733,99 +704,43 @@ def FZ_pr(words, sents):
     return n / N_word(words)
 
 
-with open('./Dictionaries/Term.txt', encoding='utf-8') as file:
-    lines = file.readlines()
-    Term = [line.rstrip() for line in lines]
-
-
 def Term_pr(words):
-    wsw = ' '.join([item['lemma'].lower() for sublist in words for item in sublist])
-    n = 0
-    for i in Term:
-        n+=wsw.count(i)
+    wsw, matches = phrase_list_matches(words, 'Term')
+    n = lexicons.phrase_list('Term').count_occurrences(wsw, matches)
     return n / N_word(words)
 
 
-with open('./Dictionaries/Abstract.txt', encoding='utf-8') as file:
-    lines = file.readlines()
-    Abstract = [line.rstrip() for line in lines]
-
-
 def Abstr_pr(words):
-    wsw = [item['lemma'].lower() for sublist in words for item in sublist]
-    n = 0
-    for i in wsw:
-        if i in Abstract:
-            n+=1
+    n = int(word_list_matches(words, 'Abstract').sum())
     return n / N_word(words)
 
 
-with open('./Dictionaries/Deont.txt', encoding='utf-8') as file:
-    lines = file.readlines()
-    Deont = [line.rstrip() for line in lines]
-
-
 def Deont_pr(words):
-    wsw = [item['lemma'].lower() for sublist in words for item in sublist]
-    n = 0
-    for i in wsw:
-        if i in Deont:
-            n+=1
+    n = int(word_list_matches(words, 'Deont').sum())
     return n / N_word(words)
 
 
-with open('./Dictionaries/Prep_mw.txt', encoding='utf-8') as file:
-    lines = file.readlines()
-    Prep_mw = [line.rstrip() for line in lines]
-
-
 def Prep_mw_pr(words):
-    wsw = ' '.join([item['word'].lower() for sublist in words for item in sublist])
-    n = 0
-    for i in Prep_mw:
-        if i in wsw:
-            n+=1
+    wsw, matches = phrase_list_matches(words, 'Prep_mw')
+    n = lexicons.phrase_list('Prep_mw').count_present(wsw, matches)
     return n / N_word(words)
 
-with open('./Dictionaries/Conj_mw.txt', encoding='utf-8') as file:
-    lines = file.readlines()
-    Conj_mw = [line.rstrip() for line in lines]
-
 
 def Conj_mw_pr(words):
-    wsw = ' '.join([item['word'].lower() for sublist in words for item in sublist])
-    n = 0
-    for i in Conj_mw:
-        if i in wsw:
-            n+=1
+    wsw, matches = phrase_list_matches(words, 'Conj_mw')
+    n = lexicons.phrase_list('Conj_mw').count_present(wsw, matches)
     return n / N_word(words)
 
 
-with open('./Dictionaries/LVC.txt', encoding='utf-8') as file:
-    lines = file.readlines()
-    LVC = [line.rstrip() for line in lines]
-
-
 def LVC_pr(words):
-    wsw = ' '.join([item['lemma'].lower() for sublist in words for item in sublist])
-    n = 0
-    for i in LVC:
-        if i in wsw:
-            n+=1
+    wsw, matches = phrase_list_matches(words, 'LVC')
+    n = lexicons.phrase_list('LVC').count_present(wsw, matches)
     return n / N_word(words)
 
 
-with open('./Dictionaries/Archaic_words.txt', encoding='utf-8') as file:
-    lines = file.readlines()
-    archaic = [line.rstrip() for line in lines]
-
-
 def Arch_pr(words):
-    wsw = ' '.join([item['lemma'].lower() for sublist in words for item in sublist])
-    n = 0
-    for i in archaic:
-        if i in wsw:
-            n+=1
+    wsw, matches = phrase_list_matches(words, 'Archaic_words')
+    n = lexicons.phrase_list('Archaic_words').count_present(wsw, matches)
     return n / N_word(words)
 
 
@@ -1062,86 +977,619 @@ def Cohes_2(words):
     return n    
  
 
+LANGUAGE_MODELS = {unit: f'./Dictionaries/lm_{unit}.ngram' for unit in ('lemma', 'pos')}
+_language_models = {}
+_language_model_cache = {}
+
+
+def language_model_statistics(words, unit):
+    # The five LM_<unit>_* metrics share one scoring pass per document; the
+    # model is mapped on first use (see ngram_model.py to build it).
+    if unit not in _language_models:
+        path = LANGUAGE_MODELS[unit]
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'{path}: build it with python ngram_model.py build --unit={unit}')
+        from ngram_model import NgramModel
+        _language_models[unit] = NgramModel(path)
+    cached = _language_model_cache.get(unit)
+    if cached is None or cached[0] is not words:
+        cached = _language_model_cache[unit] = (words, _language_models[unit].document_statistics(words))
+    return cached[1]
+
+
+def LM_lemma_ppl(words):
+    return language_model_statistics(words, 'lemma')['ppl']
+
+
+def LM_lemma_surprisal_mean(words):
+    return language_model_statistics(words, 'lemma')['surprisal_mean']
+
+
+def LM_lemma_surprisal_sd(words):
+    return language_model_statistics(words, 'lemma')['surprisal_sd']
+
+
+def LM_lemma_surprisal_p90(words):
+    return language_model_statistics(words, 'lemma')['surprisal_p90']
+
+
+def LM_lemma_oov_pr(words):
+    return language_model_statistics(words, 'lemma')['oov_pr']
+
+
+def LM_pos_ppl(words):
+    return language_model_statistics(words, 'pos')['ppl']
+
+
+def LM_pos_surprisal_mean(words):
+    return language_model_statistics(words, 'pos')['surprisal_mean']
+
+
+def LM_pos_surprisal_sd(words):
+    return language_model_statistics(words, 'pos')['surprisal_sd']
+
+
+def LM_pos_surprisal_p90(words):
+    return language_model_statistics(words, 'pos')['surprisal_p90']
+
+
+def LM_pos_oov_pr(words):
+    return language_model_statistics(words, 'pos')['oov_pr']
+
+
+APPROXIMATE_METRICS = (
+    'V_word', 'N_lemma', 'V_lemma', 'TTR_word', 'TTR_lemma', 'YulesK_word', 'YulesK_lemma',
+    'YulesI_word', 'YulesI_lemma', 'hapax1_pr', 'hapax2_pr',
+)
+_vocabulary_cache = (None, None)
+
+
+def approximate_vocabulary(words):
+    # Fixed-size sketches instead of sets and Counters over the document;
+    # exact while the vocabulary fits into the sketch sample.
+    global _vocabulary_cache
+    if _vocabulary_cache[0] is not words:
+        from metric_state import vocabulary_metrics, vocabulary_statistics
+        from sketches import VocabularySketch
+
+        word_sketch, lemma_sketch = VocabularySketch(), VocabularySketch()
+        for sentence in words:
+            word_sketch.update(item['word'] for item in sentence)
+            lemma_sketch.update(item['lemma'] for item in sentence)
+        vocab = vocabulary_statistics(word_sketch.estimate(), lemma_sketch.estimate())
+        _vocabulary_cache = (words, vocabulary_metrics(vocab, N_word(words)))
+    return _vocabulary_cache[1]
+
+
+def approximate_metric(name, words):
+    return approximate_vocabulary(words)[name]
+
+
+def metric_function(name, approximate=False):
+    if approximate and name in APPROXIMATE_METRICS:
+        return functools.partial(approximate_metric, name)
+    if name in globals():
+        return globals()[name]
+    from batch_metrics import BATCH_METRICS, single_document
+    if name not in BATCH_METRICS:
+        raise KeyError(name)
+    # A batch plugin (``name(batch)``) evaluated on one document
+    return single_document(BATCH_METRICS[name])
+
+
+def resolve_batch_metrics(function_list, arglist, approximate=False):
+    # The sketch-based vocabulary metrics keep their per-document version
+    keep_legacy = APPROXIMATE_METRICS if approximate else ()
+    from batch_metrics import resolve
+    return resolve(function_list, arglist, lambda name: metric_function(name, approximate), keep_legacy)
+
+
+WORD_LISTS = ('Sokr', 'Abbr', 'Abstract', 'Deont')
+PHRASE_LISTS = ('Term', 'Prep_mw', 'Conj_mw', 'LVC', 'Archaic_words')
+# The token field every list is matched against (lower-cased)
+LIST_FIELDS = {
+    'Sokr': 'word', 'Abbr': 'word', 'Abstract': 'lemma', 'Deont': 'lemma',
+    'Term': 'lemma', 'Prep_mw': 'word', 'Conj_mw': 'word', 'LVC': 'lemma', 'Archaic_words': 'lemma',
+}
+
+
+POS_NGRAM_SIZES = (2, 3)
+
+
+def document_postings(words):
+    """``{term: token positions}`` of a document for ``inverted_index``.
+
+    The dictionary matches come from the same per-document cache as those
+    of the metrics. A phrase is indexed at the token where it starts.
+    """
+    postings = {}
+    tokens = [item for sublist in words for item in sublist]
+    for name in WORD_LISTS:
+        field = LIST_FIELDS[name]
+        for position in np.flatnonzero(word_list_matches(words, name)).tolist():
+            postings.setdefault(f'{name}:{tokens[position][field].lower()}', []).append(position)
+    for name in PHRASE_LISTS:
+        _, matches = phrase_list_matches(words, name)
+        if not matches:
+            continue
+        # Offset of every token in the text, whose tokens are joined with one space
+        starts = np.cumsum([0] + [len(token[LIST_FIELDS[name]].lower()) + 1 for token in tokens[:-1]])
+        patterns = lexicons.phrase_list(name)
+        for pattern_id, offsets in matches.items():
+            positions = np.searchsorted(starts, offsets, side='right') - 1
+            postings.setdefault(f'{name}:{patterns.pattern(pattern_id)}', []).extend(positions.tolist())
+    for position, token in enumerate(tokens):
+        if token['dep']:
+            postings.setdefault(f'dep:{token["dep"].lower()}', []).append(position)
+    tags = [token['morph'].split(',')[0] for token in tokens]
+    for size in POS_NGRAM_SIZES:
+        for position in range(len(tags) - size + 1):
+            ngram = tags[position:position + size]
+            if all(ngram):
+                postings.setdefault('pos:' + '+'.join(ngram), []).append(position)
+    return postings
+
+
+def prepare_lexicons():
+    # Compile stale dictionaries once, before any worker starts. Workers then
+    # map the compiled files read-only and share their pages.
+    lexicons.frozen('zipf_dict')
+    for name in WORD_LISTS:
+        lexicons.word_list(name)
+    for name in PHRASE_LISTS:
+        lexicons.phrase_list(name)
+
+
+def read_feature_list(path='features.txt'):
+    with open(path, encoding='utf-8') as file:
+        lines = file.readlines()
+        functions_args = [line.rstrip() for line in lines]
+    function_list = [i.split('(')[0] for i in functions_args]
+    arglist = [i.split('(')[1][:-1] for i in functions_args]
+    return function_list, arglist
+
+
+def evaluate_metrics(words, sents, functions, arglist, timings=None, errors=None):
+    """Values of the metrics of one document.
+
+    The seconds spent in every metric are appended to ``timings``. With
+    ``errors``, a metric that raises gets ``nan`` and its position and
+    exception are appended to ``errors``, a ``ZeroDivisionError`` (an
+    undefined ratio, e.g. of a document without words) as well.
+    """
+    if timings is None and errors is None:
+        return [function(words)
+                if arg == 'words' else function(sents)
+                if arg == 'sents' else function(words, sents) for function, arg in zip(functions, arglist)]
+    values = []
+    for position, (function, arg) in enumerate(zip(functions, arglist)):
+        start = time.perf_counter()
+        if errors is None:
+            values.append(function(words) if arg == 'words' else function(sents) if arg == 'sents' else function(words, sents))
+        else:
+            try:
+                values.append(function(words) if arg == 'words' else function(sents) if arg == 'sents' else function(words, sents))
+            except Exception as error:
+                values.append(math.nan)
+                errors.append((position, error))
+        if timings is not None:
+            timings.append(time.perf_counter() - start)
+    return values
+
+
+_worker_function_list = None
+_worker_functions = None
+_worker_arglist = None
+_worker_states = False
+_worker_approximate = False
+_worker_instrumented = False
+_worker_store = None
+_worker_metrics = None
+_worker_indexed = False
+
+
+def _init_worker(function_list, arglist, with_states=False, approximate=False, instrumented=False, store_path=None, batched=False,
+                 plugins=(), indexed=False):
+    global _worker_function_list, _worker_functions, _worker_arglist, _worker_states, _worker_approximate, _worker_instrumented, \
+        _worker_store, _worker_metrics, _worker_indexed
+    if plugins:
+        from batch_metrics import load_plugins
+        load_plugins(plugins)
+    _worker_function_list = function_list
+    _worker_functions = [metric_function(name, approximate) for name in function_list]
+    _worker_metrics = resolve_batch_metrics(function_list, arglist, approximate) if batched else None
+    _worker_arglist = arglist
+    _worker_states = with_states
+    _worker_approximate = approximate
+    _worker_instrumented = instrumented
+    _worker_indexed = indexed
+    # Every worker maps the store; the pages are shared between them
+    if store_path:
+        from token_store import TokenStore
+        _worker_store = TokenStore(store_path)
+    else:
+        _worker_store = None
+
+
+def failed_result(file_path, stage, error, metrics):
+    """The result of a document that could not be evaluated: a row of ``nan`` and its error record."""
+    from fault_isolation import ErrorLog
+    name = os.path.basename(file_path)
+    errors = ErrorLog()
+    errors.add(name, stage, error)
+    return [name] + [math.nan] * metrics, None, None, errors.records, None
+
+
+def _worker_get_metr(file_path):
+    """Return ``(row, state, stats, errors, postings)``; state, stats and postings are None unless enabled.
+
+    Tasks carry only the file path (the document name with a store);
+    metric functions, lexicons and the store live in the worker since
+    _init_worker. A document that cannot be read gets a row of ``nan``, a
+    metric that raises a ``nan`` value; ``errors`` lists them as ``ErrorLog``
+    records.
+    """
+    from fault_isolation import ErrorLog
+    from metric_state import DocumentState
+
+    start = time.perf_counter()
+    try:
+        words, sents = FeatureExtractor.read_document(file_path, _worker_store)
+    except Exception as error:
+        return failed_result(file_path, 'read', error, len(_worker_functions))
+    parsed = time.perf_counter()
+    timings = [] if _worker_instrumented else None
+    name = os.path.basename(file_path)
+    failures = []
+    row = [name] + evaluate_metrics(words, sents, _worker_functions, _worker_arglist, timings, failures)
+    errors = ErrorLog()
+    for position, error in failures:
+        errors.add(name, 'metric', error, _worker_function_list[position])
+    evaluated = time.perf_counter()
+    postings = None
+    if _worker_indexed:
+        # Right after the metrics, whose dictionary matches are still cached
+        try:
+            postings = document_postings(words)
+        except Exception as error:
+            errors.add(name, 'index', error)
+    indexed = time.perf_counter()
+    state = None
+    if _worker_states:
+        try:
+            state = DocumentState.from_document(words, sents, lexicons, _worker_approximate).to_dict()
+        except Exception as error:
+            errors.add(name, 'state', error)
+    if not _worker_instrumented:
+        return row, state, None, errors.records, postings
+    end = time.perf_counter()
+    return row, state, {
+        'worker': os.getpid(),
+        'tokens': N_word(words),
+        'seconds': end - start,
+        'stages': {
+            'parse_csv': parsed - start, 'evaluate': evaluated - parsed,
+            'index': indexed - evaluated if _worker_indexed else None, 'state': end - indexed if _worker_states else None,
+        },
+        'metrics': timings,
+        'peak_rss': peak_rss_bytes(),
+    }, errors.records, postings
+
+
+def _worker_get_batch(file_paths):
+    """``_worker_get_metr`` for a batch of documents, evaluated with the batch metric API.
+
+    Times are split between the documents of the batch by their share of
+    its tokens.
+    """
+    from batch_metrics import DocumentBatch, evaluate_batch
+    from fault_isolation import ErrorLog
+    from metric_state import DocumentState
+
+    start = time.perf_counter()
+    if _worker_store is not None:
+        batch = DocumentBatch.from_store(_worker_store, [os.path.basename(path) for path in file_paths], Token)
+    else:
+        batch = DocumentBatch.from_documents(
+            (os.path.basename(path), *FeatureExtractor.parse_csv(path)) for path in file_paths
+        )
+    parsed = time.perf_counter()
+    timings = [] if _worker_instrumented else None
+    failures = []
+    rows = evaluate_batch(batch, _worker_metrics, timings, failures)
+    errors = [ErrorLog() for _ in range(len(batch))]
+    for document, position, error in failures:
+        errors[document].add(batch.names[document], 'metric', error, _worker_metrics[position].name)
+    evaluated = time.perf_counter()
+    postings = [None] * len(batch)
+    if _worker_indexed:
+        postings = [document_postings(batch.document(i)[0]) for i in range(len(batch))]
+    indexed = time.perf_counter()
+    states = [None] * len(batch)
+    if _worker_states:
+        states = [DocumentState.from_document(*batch.document(i), lexicons, _worker_approximate).to_dict() for i in range(len(batch))]
+    if not _worker_instrumented:
+        return [([name] + row, state, None, log.records, document) for name, row, state, log, document in zip(batch.names, rows, states, errors, postings)]
+    end = time.perf_counter()
+    total = int(batch.tokens.sum())
+    results = []
+    for name, row, state, log, document, tokens in zip(batch.names, rows, states, errors, postings, batch.tokens.tolist()):
+        share = tokens / total if total else 1 / len(batch)
+        results.append(([name] + row, state, {
+            'worker': os.getpid(),
+            'tokens': tokens,
+            'seconds': (end - start) * share,
+            'stages': {
+                'parse_csv': (parsed - start) * share, 'evaluate': (evaluated - parsed) * share,
+                'index': (indexed - evaluated) * share if _worker_indexed else None,
+                'state': (end - indexed) * share if _worker_states else None,
+            },
+            'metrics': [seconds * share for seconds in timings],
+            'peak_rss': peak_rss_bytes(),
+        }, log.records, document))
+    return results
+
+
+def _worker_evaluate(file_paths):
+    """Results of a chunk of documents, one ``_worker_get_metr`` result each."""
+    if _worker_metrics is not None:
+        try:
+            return _worker_get_batch(file_paths)
+        except Exception:
+            # Every document on its own, so that the errors are those of single documents
+            pass
+    return [_worker_get_metr(file_path) for file_path in file_paths]
+
+
+TOKEN_FIELDS = ('word', 'lemma', 'pos', 'morph', 'dep')
+
+
+class Token:
+    """One annotated token, as produced by ``FeatureExtractor.parse_csv``.
+
+    Fields are interned, so the repeated tags, relations and frequent words
+    of a document share one string each. Item access (``token['word']``)
+    and ``len`` behave like the five-key dict tokens used to be, which the
+    metric functions rely on (``comma_pr`` divides by ``len(token)``).
+    """
+
+    __slots__ = TOKEN_FIELDS
+
+    def __init__(self, word, lemma, pos, morph, dep):
+        self.word = intern(word)
+        self.lemma = intern(lemma)
+        self.pos = intern(pos)
+        self.morph = intern(morph)
+        self.dep = intern(dep)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in TOKEN_FIELDS else default
+
+    def __len__(self):
+        return len(TOKEN_FIELDS)
+
+    def __iter__(self):
+        return iter(TOKEN_FIELDS)
+
+    def keys(self):
+        return TOKEN_FIELDS
+
+    def __repr__(self):
+        return f'Token({", ".join(f"{key}={self[key]!r}" for key in TOKEN_FIELDS)})'
+
+
 class FeatureExtractor:
 
-    def __init__(self, input_path, output_path, num_workers):
+    def __init__(self, input_path, output_path, num_workers, shard=None, manifest_path=None, states_path=None, approximate=False,
+                 report_path=None, report_format=None, profile_path=None, features_path='features.txt', store_path=None,
+                 batch_size=1, plugins=(), timeout=None, errors_path=None, index_path=None):
         self.input_path = input_path
         self.output_path = output_path
         self.num_workers = num_workers
-        self.file_list =  [f for f in glob.glob(self.input_path + "/*.csv")]
-
-        with open('features.txt', encoding='utf-8') as file:
-            lines = file.readlines()
-            functions_args = [line.rstrip() for line in lines]
-        self.function_list = [i.split('(')[0] for i in functions_args]
-        self.arglist = [i.split('(')[1][:-1] for i in functions_args]
-
-    def parse_csv(self,file_path):
-        with open(file_path, newline='', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-
-            wordlist = []
-            sentlist = []
-
-            current_sentence_words = []
-
-            for row in reader:
-                sentence = row['sentence']
-                if sentence not in sentlist:
-
-                    if current_sentence_words:
-                        wordlist.append(current_sentence_words)
-                    current_sentence_words = []
-                    sentlist.append(sentence)
-
-                i = 1
-                while True:
-                    word_key = f'word{i}'
-
-                    if word_key not in row:
-                        break
-                    
-                    word = row[word_key].strip()
-                    if word:
-                        word_info = {
-                            'word': word,
-                            'lemma': row.get(f'lemma{i}', '').strip(),
-                            'pos': row.get(f'pos{i}', '').strip(),
-                            'morph': row.get(f'morph{i}', '').strip(),
-                            'dep': row.get(f'dep{i}', '').strip()
-                        }
-                        if word_info['word'].isalpha() or "-" in word_info['word']:  # Simple validation
-                            current_sentence_words.append(word_info)
-                    i += 1
-
-            if current_sentence_words:
-                wordlist.append(current_sentence_words)
-
-        return wordlist, sentlist
+        self.states_path = states_path
+        self.approximate = approximate
+        self.report_path = report_path
+        self.report_format = report_format
+        self.profile_path = profile_path
+        self.shard = shard
+        self.batch_size = batch_size
+        self.plugins = tuple(plugins)
+        if self.plugins:
+            from batch_metrics import load_plugins
+            load_plugins(self.plugins)
+        self.store_path = store_path
+        self.store = None
+        if store_path is not None:
+            from token_store import TokenStore
+            # Documents come from the store instead of the input folder
+            self.store = TokenStore(store_path)
+            self.file_list = list(self.store.names)
+        elif shard is None:
+            self.file_list =  annotated_documents(self.input_path)
+        else:
+            import sharding
+            index, num_shards = shard
+            manifest = sharding.load_or_create_manifest(
+                manifest_path or sharding.default_manifest_path(output_path), input_path, num_shards
+            )
+            self.file_list = [os.path.join(input_path, name) for name in sharding.shard_documents(manifest, index)]
+            self.output_path = sharding.shard_output_path(output_path, index, num_shards)
+            if states_path:
+                self.states_path = sharding.shard_output_path(states_path, index, num_shards)
+            if index_path:
+                index_path = sharding.shard_output_path(index_path, index, num_shards)
+            if errors_path:
+                errors_path = sharding.shard_output_path(errors_path, index, num_shards)
+
+        self.function_list, self.arglist = read_feature_list(features_path)
+        self.timeout = timeout
+        self.errors_path = errors_path or f'{self.output_path}.errors.jsonl'
+        self.index_path = index_path
+
+    @staticmethod
+    def parse_csv(file_path):
+        with open_text(file_path) as csvfile:
+            return FeatureExtractor.parse_rows(csv.DictReader(csvfile))
+
+    @staticmethod
+    def read_document(file_path, store=None):
+        if store is not None:
+            return store.document(os.path.basename(file_path), Token)
+        return FeatureExtractor.parse_csv(file_path)
+
+    @staticmethod
+    def parse_rows(rows):
+        """Words and sentences of annotated rows (mappings with ``sentence``, ``word1``, ``lemma1``, ...)."""
+        units = FeatureExtractor.parse_units(rows)
+        return [tokens for _, tokens in units if tokens], [sentence for sentence, _ in units]
+
+    @staticmethod
+    def parse_units(rows):
+        """``(sentence, tokens)`` per distinct sentence of annotated rows, in order.
+
+        The tokens of a row whose sentence was seen before go to the current
+        sentence; sentences without valid tokens keep an empty list.
+        """
+        units = []
+        seen = set()
+
+        for row in rows:
+            sentence = row['sentence']
+            if sentence not in seen:
+                seen.add(sentence)
+                units.append((sentence, []))
+            current_sentence_words = units[-1][1]
+
+            i = 1
+            while True:
+                word_key = f'word{i}'
+
+                if word_key not in row:
+                    break
+                
+                word = row[word_key].strip()
+                if word and (word.isalpha() or "-" in word):  # Simple validation
+                    current_sentence_words.append(Token(
+                        word,
+                        row.get(f'lemma{i}', '').strip(),
+                        row.get(f'pos{i}', '').strip(),
+                        row.get(f'morph{i}', '').strip(),
+                        row.get(f'dep{i}', '').strip()
+                    ))
+                i += 1
+
+        return units
 
     def get_metr(self, file_path):
-        words, sents = self.parse_csv(file_path)
-        metrics_list = [os.path.basename(file_path)]+[eval(name)(words) 
-                    if arg == 'words' else eval(name)(sents) 
-                    if arg =='sents' else eval(name)(words, sents) for name, arg in zip(self.function_list, self.arglist)]
+        words, sents = self.read_document(file_path, self.store)
+        functions = [metric_function(name, self.approximate) for name in self.function_list]
+        metrics_list = [os.path.basename(file_path)] + evaluate_metrics(words, sents, functions, self.arglist)
         return metrics_list
 
-    def run(self):
-        pool = Pool(processes=(self.num_workers))
-        metr_list_all = list(tqdm(pool.imap(self.get_metr, self.file_list)))
-        
-        pool.close()
-        with open(self.output_path, "w", newline="") as f:
+    def write_table(self, rows):
+        # Written under a temporary name so that a partially written table is
+        # never mistaken for a finished shard.
+        tmp_path = f'{self.output_path}.tmp{os.getpid()}'
+        with open(tmp_path, "w", newline="") as f:
             writer = csv.writer(f)
             writer.writerow(['fname']+self.function_list)
-            writer.writerows(metr_list_all)
+            writer.writerows(rows)
+        os.replace(tmp_path, self.output_path)
+
+    def profile(self):
+        # One document picked at random, parsed and evaluated in this process
+        file_path = random.choice(self.file_list)
+        profile_call(self.profile_path, self.get_metr, file_path)
+        print(f'{self.profile_path}: cProfile stats for {os.path.basename(file_path)}', file=sys.stderr)
+
+    def run(self):
+        prepare_lexicons()
+        if self.profile_path and self.file_list:
+            self.profile()
+        # The worker pool and tqdm are only needed for an actual run
+        from tqdm import tqdm
+        from fault_isolation import ErrorLog, WorkerPool
+
+        instrumentation = Instrumentation(started=STARTED) if self.report_path else None
+        if instrumentation is not None:
+            instrumentation.add('stages', 'import', IMPORTED - STARTED)
+        with_states = self.states_path is not None
+        # A document that fails, times out or kills its worker gets a row
+        # of nan and an entry in the error log; the others are unaffected.
+        pool = WorkerPool(
+            self.num_workers, _worker_evaluate, initializer=_init_worker,
+            initargs=(self.function_list, self.arglist, with_states, self.approximate, instrumentation is not None, self.store_path,
+                      self.batch_size > 1, self.plugins, self.index_path is not None),
+            timeout=self.timeout
+        )
+        metrics = len(self.function_list)
+        results = pool.imap(
+            self.file_list, lambda file_path, stage, message: failed_result(file_path, stage, message, metrics), self.batch_size
+        )
+        if instrumentation is not None:
+            instrumentation.ready()
+        states_file = open(self.states_path, "w", encoding='utf-8') if with_states else None
+        errors = ErrorLog()
+        index = None
+        if self.index_path is not None:
+            from inverted_index import IndexWriter
+            index = IndexWriter(self.index_path)
+
+        def rows():
+            # Rows are written as workers finish them instead of after the
+            # whole folder has been processed.
+            for row, state, stats, records, postings in tqdm(results, total=len(self.file_list), unit='doc'):
+                errors.extend(records)
+                if index is not None and postings is not None:
+                    index.add(row[0], postings)
+                if states_file is not None and state is not None:
+                    states_file.write(json.dumps({'fname': row[0], 'state': state}, ensure_ascii=False) + '\n')
+                if stats is not None:
+                    instrumentation.add_document(stats['worker'], stats['tokens'], stats['seconds'], stats['peak_rss'])
+                    for stage, seconds in stats['stages'].items():
+                        if seconds is not None:
+                            instrumentation.add('stages', stage, seconds)
+                    for name, seconds in zip(self.function_list, stats['metrics']):
+                        instrumentation.add('metrics', name, seconds)
+                yield row
+
+        try:
+            self.write_table(rows())
+        finally:
+            if states_file is not None:
+                states_file.close()
+        if index is not None:
+            terms = index.close()
+            print(f'{self.index_path}: {terms} terms in {len(index.names)} documents', file=sys.stderr)
+        errors.write(self.errors_path)
+        if errors.records:
+            print(f'{errors.summary()}, see {self.errors_path}', file=sys.stderr)
+        if instrumentation is not None:
+            instrumentation.write(self.report_path, self.report_format)
+
+        if self.shard is not None:
+            import sharding
+            names = [os.path.basename(f) for f in self.file_list]
+            sharding.mark_shard_done(self.output_path, *self.shard, names)
+
+
+def parse_shard(value):
+    # --shard is parsed by sharding, which is imported only when it is given
+    import sharding
+    return sharding.parse_shard(value)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Extract linguistic features from xml files")
 
     parser.add_argument(
-        "--input-path", default="./data", help="input path"
+        "--input-path", default="./data", help="folder of annotated documents (*.csv, also .csv.gz, .csv.bz2, .csv.xz, .csv.zst)"
     )
 
     parser.add_argument(
@@ -1149,15 +1597,110 @@ def main():
     )
 
     parser.add_argument(
-        "--num-workers", default=cpu_count(), type=int, help="number of workers"
+        "--num-workers", default=os.cpu_count(), type=int, help="number of workers"
+    )
+
+    parser.add_argument(
+        "--states-path", default=None,
+        help="also write mergeable per-document metric states (JSON lines) for metric_state.py aggregate"
+    )
+
+    parser.add_argument(
+        "--shard", default=None, type=parse_shard,
+        help="process only shard i of N (e.g. 0/8); merge the shards with sharding.py merge"
+    )
+
+    parser.add_argument(
+        "--manifest", default=None, help="shard manifest path (default: next to the output file)"
+    )
+
+    parser.add_argument(
+        "--approximate", action="store_true",
+        help="compute vocabulary metrics (V_*, TTR_*, Yules*, hapax*) with fixed-size sketches, see sketches.py"
+    )
+
+    parser.add_argument(
+        "--report", default=None,
+        help="write run statistics (per-metric and per-stage time, throughput per worker, peak RSS) to this file"
+    )
+
+    parser.add_argument(
+        "--report-format", default=None, choices=("json", "prometheus"),
+        help="format of --report (default: prometheus for *.prom files, json otherwise)"
+    )
+
+    parser.add_argument(
+        "--profile", default=None,
+        help="dump cProfile stats (pstats format) for one randomly sampled document to this file"
+    )
+
+    parser.add_argument(
+        "--store", default=None,
+        help="read the documents from a token store built with token_store.py build instead of --input-path"
+    )
+
+    parser.add_argument(
+        "--features", default="features.txt",
+        help="metrics to compute, one name(args) per line (see annotation_layers.py for the annotation each reads)"
+    )
+
+    parser.add_argument(
+        "--batch-size", default=1, type=int,
+        help="evaluate the metrics on batches of this many documents with the batch metric API (see batch_metrics.py)"
+    )
+
+    parser.add_argument(
+        "--plugins", default="",
+        help="comma-separated modules that register batch metrics, for name(batch) lines of --features"
+    )
+
+    parser.add_argument(
+        "--timeout", default=None, type=float,
+        help="seconds a document may take; a document over the limit gets a row of nan and an error log entry"
+    )
+
+    parser.add_argument(
+        "--errors-path", default=None,
+        help="JSON lines of the documents and metrics that failed (default: the output path + .errors.jsonl)"
+    )
+
+    parser.add_argument(
+        "--index-path", default=None,
+        help="also write an inverted index of dictionary entries, dep relations and POS n-grams (see inverted_index.py)"
     )
 
     args = parser.parse_args()
+    if args.timeout is not None and args.timeout <= 0:
+        parser.error("--timeout must be positive")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.store and args.shard:
+        parser.error("--shard works on --input-path folders, not on --store")
+    if not args.store and not os.path.isdir(args.input_path):
+        parser.error(f"--input-path: no such folder: {args.input_path}")
+    if args.store and not os.path.isfile(args.store):
+        parser.error(f"--store: no such file: {args.store}")
+    if not os.path.isfile(args.features):
+        parser.error(f"--features: no such file: {args.features}")
 
     feature_extractor = FeatureExtractor(
         input_path = args.input_path,
         output_path = args.output_path,
-        num_workers= args.num_workers
+        num_workers= args.num_workers,
+        shard = args.shard,
+        manifest_path = args.manifest,
+        states_path = args.states_path,
+        approximate = args.approximate,
+        report_path = args.report,
+        report_format = args.report_format,
+        profile_path = args.profile,
+        features_path = args.features,
+        store_path = args.store,
+        batch_size = args.batch_size,
+        plugins = [module for module in args.plugins.split(',') if module],
+        timeout = args.timeout,
+        errors_path = args.errors_path,
+        index_path = args.index_path
     )
     feature_extractor.run()
 
@@ -0,0 +1,316 @@
+"""
+Statistical comparison of metric groups (actual vs generated, model, prompt).
+
+Takes a per-document metrics table (``feature_extractor.py`` output) and a
+group per document, either a column of the table or a ``fname`` -> group
+mapping (``--groups``, as ``metric_state.py aggregate`` takes). Every pair of
+groups (or every group against ``--reference``) is compared on all
+``features.txt`` columns at once:
+
+* group means and their difference (second group minus first) with a
+  percentile bootstrap confidence interval. Resampling uses Poisson(1)
+  weights, which for large groups is equivalent to the multinomial
+  bootstrap and lets all replicates and columns be computed as one matrix
+  product per chunk of units (see below).
+* Hedges' g (standardized mean difference) and Cliff's delta (the
+  probability that a value of the second group is larger than one of the
+  first, minus the reverse).
+* a two-sided permutation test of the mean difference. Each permutation
+  relabels the pooled rows with the original group sizes, and its p-value
+  has resolution ``1 / (permutations + 1)``.
+* p-values adjusted for the number of tests in the run (Benjamini-Hochberg
+  by default, or Holm or Bonferroni).
+
+Missing values (metrics undefined for a document) are left out per column.
+
+For the bootstrap, a group of more than ``--units`` rows is resampled as
+that many equal-sized buckets of its randomly assigned rows, using their
+sums and counts. The bootstrap resamples each group on its own, and within
+a group the buckets give the same variance of the mean as the rows, so its
+cost depends on ``--units``, not on the number of documents. The
+permutation test relabels the pooled rows themselves: buckets of one group
+against rows of the other would not be exchangeable. Its cost therefore
+grows with the number of rows. Weights and labels are generated in chunks
+of at most ``CHUNK_ELEMENTS`` entries. Means, Hedges' g and Cliff's delta
+always use every row.
+
+    python group_compare.py --metrics-path=review_complexity.csv --group-column=source --reference=actual --output=comparison.csv
+"""
+
+import argparse
+import itertools
+import os
+import sys
+import warnings
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from annotation_layers import feature_names
+
+
+BOOTSTRAP = 1000
+PERMUTATIONS = 1000
+CONFIDENCE = 0.95
+UNITS = 20000
+CHUNK_ELEMENTS = 1 << 24
+
+OUTPUT_COLUMNS = (
+    'group_a', 'group_b', 'column', 'n_a', 'n_b', 'mean_a', 'mean_b', 'difference', 'ci_low', 'ci_high',
+    'hedges_g', 'cliffs_delta', 'p_value', 'p_adjusted', 'significant',
+)
+
+
+@contextmanager
+def _quiet():
+    # Columns without values in a group give NaN, which is expected
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+        yield
+
+
+def read_table(metrics_path, group_column, groups_path=None, columns=None):
+    """``(groups, values, columns)``: a group label per row and the metric values, one row per column."""
+    table = pd.read_csv(metrics_path, low_memory=False)
+    if groups_path:
+        mapping = pd.read_csv(groups_path, usecols=['fname', group_column], dtype=str)
+        table = table.drop(columns=[group_column], errors='ignore').merge(mapping, on='fname', how='inner')
+    if group_column not in table:
+        raise ValueError(f'{metrics_path} has no column {group_column!r}; pass --groups to map fname to groups')
+    table = table[table[group_column].notna()]
+    if columns is None:
+        columns = [name for name in table.columns if name not in ('fname', group_column)]
+    # Tables computed with another --features list have fewer columns
+    columns = [name for name in columns if name in table]
+    if not columns:
+        raise ValueError(f'{metrics_path} has none of the metric columns')
+    values = table[columns].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+    # Columns first, so that every per-column statistic reads contiguous memory
+    return table[group_column].astype(str).to_numpy(), np.ascontiguousarray(values.T), list(columns)
+
+
+def _buckets(n, units, rng):
+    # Rows are their own bootstrap units, or are dealt at random into equal-sized buckets
+    return None if n <= units else rng.permutation(n) % units
+
+
+def column_statistics(a, b, units, rng):
+    """Per-column counts, means, variances and Cliff's delta of groups ``a`` and ``b`` (columns x rows).
+
+    Also returns the bootstrap units of both groups, ``(sums, counts)`` of
+    shape columns x units. Columns are processed one at a time, so the only
+    temporaries are single columns.
+    """
+    columns = a.shape[0]
+    stats = {key: np.full(columns, np.nan) for key in ('mean_a', 'mean_b', 'var_a', 'var_b', 'cliffs_delta')}
+    stats['n_a'], stats['n_b'] = np.zeros(columns, dtype=np.int64), np.zeros(columns, dtype=np.int64)
+    resampled = []
+    for group, values in (('a', a), ('b', b)):
+        buckets = _buckets(values.shape[1], units, rng)
+        width = values.shape[1] if buckets is None else units
+        resampled.append((buckets, np.zeros((columns, width)), np.zeros((columns, width))))
+
+    for column in range(columns):
+        present = []
+        for (group, values), (buckets, sums, counts) in zip((('a', a), ('b', b)), resampled):
+            row = values[column]
+            mask = ~np.isnan(row)
+            x = row[mask]
+            present.append(x)
+            stats[f'n_{group}'][column] = len(x)
+            if len(x):
+                stats[f'mean_{group}'][column] = x.mean()
+            if len(x) > 1:
+                stats[f'var_{group}'][column] = x.var(ddof=1)
+            if buckets is None:
+                sums[column, mask] = x
+                counts[column] = mask
+            else:
+                sums[column] = np.bincount(buckets[mask], weights=x, minlength=units)
+                counts[column] = np.bincount(buckets[mask], minlength=units)
+        x, y = present
+        if len(x) and len(y):
+            x = np.sort(x)
+            below = np.searchsorted(x, y, side='left').sum()
+            above = (len(x) - np.searchsorted(x, y, side='right')).sum()
+            stats['cliffs_delta'][column] = (below - above) / (len(x) * len(y))
+    return stats, tuple(resampled[0][1:]), tuple(resampled[1][1:])
+
+
+def _units_per_chunk(replicates):
+    return max(1, CHUNK_ELEMENTS // max(1, replicates))
+
+
+def bootstrap_means(sums, counts, replicates, rng):
+    """``(columns, replicates)`` means of Poisson-weighted resamples of the units."""
+    total = np.zeros((sums.shape[0], replicates))
+    total_count = np.zeros((sums.shape[0], replicates))
+    step = _units_per_chunk(replicates)
+    for start in range(0, sums.shape[1], step):
+        weights = rng.poisson(1.0, size=(min(step, sums.shape[1] - start), replicates)).astype(np.float64)
+        total += sums[:, start:start + step] @ weights
+        total_count += counts[:, start:start + step] @ weights
+    with _quiet():
+        return total / total_count
+
+
+def permutation_differences(a, b, permutations, rng):
+    """``(columns, permutations)`` mean differences (b - a) after random relabeling of the rows of ``a`` and ``b``."""
+    pooled = np.hstack([a, b])
+    counts = ~np.isnan(pooled)
+    sums = np.where(counts, pooled, 0.0)
+    counts = counts.astype(np.float64)
+    total, total_count = sums.sum(axis=1, keepdims=True), counts.sum(axis=1, keepdims=True)
+    n, n_a = sums.shape[1], a.shape[1]
+    differences = np.empty((sums.shape[0], permutations))
+    # Permutations are drawn in chunks of at most CHUNK_ELEMENTS labels
+    step = max(1, CHUNK_ELEMENTS // n)
+    for start in range(0, permutations, step):
+        k = min(step, permutations - start)
+        labels = np.zeros((n, k))
+        chosen = np.argpartition(rng.random((n, k)), n_a - 1, axis=0)[:n_a]
+        np.put_along_axis(labels, chosen, 1.0, axis=0)
+        sum_a, count_a = sums @ labels, counts @ labels
+        with _quiet():
+            differences[:, start:start + k] = (total - sum_a) / (total_count - count_a) - sum_a / count_a
+    return differences
+
+
+def hedges_g(n_a, mean_a, var_a, n_b, mean_b, var_b):
+    with _quiet():
+        pooled = np.sqrt(((n_a - 1) * var_a + (n_b - 1) * var_b) / (n_a + n_b - 2))
+        return (mean_b - mean_a) / pooled * (1 - 3 / (4 * (n_a + n_b) - 9))
+
+
+def compare_pair(a, b, bootstrap=BOOTSTRAP, permutations=PERMUTATIONS, confidence=CONFIDENCE, units=UNITS, rng=None):
+    """Statistics of group ``b`` against group ``a`` (columns x rows), one entry per column."""
+    rng = rng if rng is not None else np.random.default_rng()
+    stats, units_a, units_b = column_statistics(a, b, units, rng)
+    difference = stats['mean_b'] - stats['mean_a']
+    result = {
+        'n_a': stats['n_a'], 'n_b': stats['n_b'], 'mean_a': stats['mean_a'], 'mean_b': stats['mean_b'],
+        'difference': difference,
+        'hedges_g': hedges_g(stats['n_a'], stats['mean_a'], stats['var_a'], stats['n_b'], stats['mean_b'], stats['var_b']),
+        'cliffs_delta': stats['cliffs_delta'],
+        'ci_low': np.full(a.shape[0], np.nan), 'ci_high': np.full(a.shape[0], np.nan),
+        'p_value': np.full(a.shape[0], np.nan),
+    }
+    if bootstrap:
+        replicates = bootstrap_means(*units_b, bootstrap, rng) - bootstrap_means(*units_a, bootstrap, rng)
+        tail = (1 - confidence) / 2 * 100
+        with _quiet():
+            result['ci_low'], result['ci_high'] = np.nanpercentile(replicates, [tail, 100 - tail], axis=1)
+    if permutations:
+        permuted = permutation_differences(a, b, permutations, rng)
+        # Relative slack so that permutations equal to the observed value count
+        observed = np.abs(difference)[:, None] * (1 - 1e-12)
+        extreme = np.sum(np.abs(permuted) >= observed, axis=1)
+        result['p_value'] = np.where(np.isnan(difference), np.nan, (1 + extreme) / (1 + permutations))
+    return result
+
+
+def benjamini_hochberg(p):
+    adjusted = np.full(p.shape, np.nan)
+    valid = ~np.isnan(p)
+    q = p[valid]
+    order = np.argsort(q)
+    m = len(q)
+    scaled = q[order] * m / np.arange(1, m + 1)
+    adjusted_valid = np.empty(m)
+    adjusted_valid[order] = np.minimum(1.0, np.minimum.accumulate(scaled[::-1])[::-1])
+    adjusted[valid] = adjusted_valid
+    return adjusted
+
+
+def holm(p):
+    adjusted = np.full(p.shape, np.nan)
+    valid = ~np.isnan(p)
+    q = p[valid]
+    order = np.argsort(q)
+    m = len(q)
+    scaled = q[order] * (m - np.arange(m))
+    adjusted_valid = np.empty(m)
+    adjusted_valid[order] = np.minimum(1.0, np.maximum.accumulate(scaled))
+    adjusted[valid] = adjusted_valid
+    return adjusted
+
+
+def bonferroni(p):
+    return np.minimum(1.0, p * np.sum(~np.isnan(p)))
+
+
+CORRECTIONS = {
+    'bh': benjamini_hochberg,
+    'holm': holm,
+    'bonferroni': bonferroni,
+}
+
+
+def group_pairs(labels, reference=None):
+    names = sorted(set(str(label) for label in labels))
+    if reference is None:
+        return list(itertools.combinations(names, 2))
+    if reference not in names:
+        raise ValueError(f'no documents in reference group {reference!r} (groups: {", ".join(names)})')
+    return [(reference, name) for name in names if name != reference]
+
+
+def compare_groups(labels, values, columns, reference=None, bootstrap=BOOTSTRAP, permutations=PERMUTATIONS,
+                   confidence=CONFIDENCE, correction='bh', alpha=0.05, units=UNITS, seed=0):
+    """One output row (``OUTPUT_COLUMNS``) per group pair and column; ``values`` is columns x rows."""
+    rng = np.random.default_rng(seed)
+    results = []
+    for group_a, group_b in group_pairs(labels, reference):
+        a, b = values.compress(labels == group_a, axis=1), values.compress(labels == group_b, axis=1)
+        stats = compare_pair(a, b, bootstrap, permutations, confidence, units, rng)
+        results.append((group_a, group_b, stats))
+
+    p_values = np.concatenate([stats['p_value'] for _, _, stats in results]) if results else np.empty(0)
+    adjusted = CORRECTIONS[correction](p_values) if len(p_values) else p_values
+    rows = []
+    for pair, (group_a, group_b, stats) in enumerate(results):
+        for column, name in enumerate(columns):
+            p_adjusted = adjusted[pair * len(columns) + column]
+            rows.append([group_a, group_b, name] + [stats[key][column] for key in OUTPUT_COLUMNS[3:-2]]
+                        + [p_adjusted, bool(p_adjusted <= alpha)])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare metric groups with bootstrap CIs, effect sizes and permutation tests")
+    parser.add_argument("--metrics-path", required=True, help="per-document metrics table (feature_extractor.py output)")
+    parser.add_argument("--group-column", default="group", help="group column of the table or of --groups")
+    parser.add_argument("--groups", default=None, help="CSV file mapping fname to --group-column")
+    parser.add_argument("--reference", default=None, help="compare every group with this one (default: all pairs)")
+    parser.add_argument("--features", default="features.txt", help="metric columns to compare (default: features.txt)")
+    parser.add_argument("--output", default="comparison.csv", help="output file name")
+    parser.add_argument("--bootstrap", default=BOOTSTRAP, type=int, help="bootstrap replicates (0 to skip)")
+    parser.add_argument("--permutations", default=PERMUTATIONS, type=int, help="permutations per test (0 to skip)")
+    parser.add_argument("--confidence", default=CONFIDENCE, type=float, help="confidence level of the intervals")
+    parser.add_argument("--correction", default="bh", choices=sorted(CORRECTIONS), help="multiple-comparison correction")
+    parser.add_argument("--alpha", default=0.05, type=float, help="significance level of the adjusted p-values")
+    parser.add_argument("--units", default=UNITS, type=int, help="bootstrap larger groups as this many random buckets")
+    parser.add_argument("--seed", default=0, type=int, help="random seed")
+
+    args = parser.parse_args()
+
+    columns = feature_names(args.features) if os.path.exists(args.features) else None
+    try:
+        labels, values, columns = read_table(args.metrics_path, args.group_column, args.groups, columns)
+        rows = compare_groups(labels, values, columns, args.reference, args.bootstrap, args.permutations,
+                              args.confidence, args.correction, args.alpha, args.units, args.seed)
+    except ValueError as error:
+        sys.exit(str(error))
+
+    pd.DataFrame(rows, columns=OUTPUT_COLUMNS).to_csv(args.output, index=False)
+    significant = {}
+    for row in rows:
+        significant.setdefault((row[0], row[1]), 0)
+        significant[(row[0], row[1])] += row[-1]
+    for (group_a, group_b), count in significant.items():
+        print(f'{group_b} vs {group_a}: {count}/{len(columns)} columns differ ({args.correction}, alpha {args.alpha})')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Run statistics for ``feature_extractor.py`` and ``extract_characteristics.py``.
+
+``Instrumentation`` collects wall time and call counts per metric function and
+per pipeline stage (parse_csv, segment, tag_morph, parse_syntax, pymorphy2,
+...), documents and tokens per worker, and peak resident memory. Startup
+(imports, argument parsing and model loading until the first document) is
+reported separately, with the imports and model loading also as stages. ``write``
+stores them as a JSON summary or in the Prometheus textfile format (for the
+node_exporter textfile collector), depending on the file extension or
+``fmt``.
+
+``profile_call`` runs one function under cProfile and dumps the stats in the
+``pstats`` format, which ``python -m pstats``, snakeviz and similar tools read.
+"""
+
+import cProfile
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+PROMETHEUS_PREFIX = 'complexity'
+
+
+def peak_rss_bytes(children=False):
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+
+class Instrumentation:
+
+    def __init__(self, started=None):
+        # started: perf_counter() taken at the top of the entry script
+        self.started = time.perf_counter() if started is None else started
+        self.startup_seconds = None
+        self.timings = {'metrics': {}, 'stages': {}}
+        self.workers = {}
+
+    def ready(self):
+        """Mark the end of startup; only the first call counts."""
+        if self.startup_seconds is None:
+            self.startup_seconds = time.perf_counter() - self.started
+
+    def add(self, kind, name, seconds, calls=1):
+        entry = self.timings[kind].setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += calls
+
+    @contextmanager
+    def timer(self, name, kind='stages'):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(kind, name, time.perf_counter() - start)
+
+    def add_document(self, worker, tokens, seconds, peak_rss=None):
+        stats = self.workers.setdefault(str(worker), {'documents': 0, 'tokens': 0, 'busy_seconds': 0.0, 'peak_rss_bytes': None})
+        stats['documents'] += 1
+        stats['tokens'] += tokens
+        stats['busy_seconds'] += seconds
+        if peak_rss is not None:
+            stats['peak_rss_bytes'] = max(stats['peak_rss_bytes'] or 0, peak_rss)
+
+    def summary(self):
+        wall = time.perf_counter() - self.started
+        documents = sum(stats['documents'] for stats in self.workers.values())
+        tokens = sum(stats['tokens'] for stats in self.workers.values())
+        workers = {}
+        for worker, stats in self.workers.items():
+            busy = stats['busy_seconds']
+            workers[worker] = dict(
+                stats,
+                docs_per_sec=stats['documents'] / busy if busy else None,
+                tokens_per_sec=stats['tokens'] / busy if busy else None,
+            )
+        return {
+            'wall_seconds': wall,
+            'startup_seconds': self.startup_seconds,
+            'documents': documents,
+            'tokens': tokens,
+            'docs_per_sec': documents / wall if wall else None,
+            'tokens_per_sec': tokens / wall if wall else None,
+            'peak_rss_bytes': {'main': peak_rss_bytes(), 'children': peak_rss_bytes(children=True)},
+            'workers': workers,
+            'stages': {name: {'seconds': s, 'calls': c} for name, (s, c) in self.timings['stages'].items()},
+            'metrics': {name: {'seconds': s, 'calls': c} for name, (s, c) in self.timings['metrics'].items()},
+        }
+
+    def write(self, path, fmt=None):
+        fmt = fmt or ('prometheus' if path.endswith('.prom') else 'json')
+        summary = self.summary()
+        text = prometheus_text(summary) if fmt == 'prometheus' else json.dumps(summary, indent=1) + '\n'
+        # The textfile collector may read at any moment, so replace atomically.
+        tmp_path = f'{path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w', encoding='utf-8') as fp:
+            fp.write(text)
+        os.replace(tmp_path, path)
+        return summary
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(summary):
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP {PROMETHEUS_PREFIX}_{name} {help_text}')
+        lines.append(f'# TYPE {PROMETHEUS_PREFIX}_{name} {kind}')
+        for labels, value in samples:
+            if value is None:
+                continue
+            rendered = ','.join(f'{key}="{_label(v)}"' for key, v in labels.items())
+            lines.append(f'{PROMETHEUS_PREFIX}_{name}{{{rendered}}} {value}' if rendered else f'{PROMETHEUS_PREFIX}_{name} {value}')
+
+    metric('wall_seconds', 'gauge', 'Wall time of the run.', [({}, summary['wall_seconds'])])
+    metric('startup_seconds', 'gauge', 'Time from start to the first document.', [({}, summary['startup_seconds'])])
+    metric('documents_total', 'counter', 'Documents processed.', [({}, summary['documents'])])
+    metric('tokens_total', 'counter', 'Tokens processed.', [({}, summary['tokens'])])
+    metric('peak_rss_bytes', 'gauge', 'Peak resident set size.',
+           [({'process': process}, value) for process, value in summary['peak_rss_bytes'].items()])
+    workers = summary['workers'].items()
+    metric('worker_documents_total', 'counter', 'Documents processed per worker.',
+           [({'worker': w}, stats['documents']) for w, stats in workers])
+    metric('worker_tokens_total', 'counter', 'Tokens processed per worker.',
+           [({'worker': w}, stats['tokens']) for w, stats in workers])
+    metric('worker_busy_seconds_total', 'counter', 'Time each worker spent on documents.',
+           [({'worker': w}, stats['busy_seconds']) for w, stats in workers])
+    metric('worker_peak_rss_bytes', 'gauge', 'Peak resident set size per worker.',
+           [({'worker': w}, stats['peak_rss_bytes']) for w, stats in workers])
+    for kind in ('stages', 'metrics'):
+        label = kind[:-1]
+        metric(f'{label}_seconds_total', 'counter', f'Time spent per {label}.',
+               [({label: name}, entry['seconds']) for name, entry in summary[kind].items()])
+        metric(f'{label}_calls_total', 'counter', f'Calls per {label}.',
+               [({label: name}, entry['calls']) for name, entry in summary[kind].items()])
+    return '\n'.join(lines) + '\n'
+
+
+def profile_call(path, function, *args, **kwargs):
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        profiler.dump_stats(path)
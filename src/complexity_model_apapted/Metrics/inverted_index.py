@@ -0,0 +1,267 @@
+"""
+Inverted index from dictionary entries, dependency relations and POS n-grams
+to the documents and token positions where they occur.
+
+``feature_extractor.py --index-path=reviews.idx`` writes the index during the
+metric pass, from the same dictionary matches the metrics count
+(``document_postings``). Terms are
+
+* ``<list>:<entry>`` for the dictionary lists (``Archaic_words:сей``,
+  ``Term:...``, ``Abstract:...``, ``Sokr:...``, ...),
+* ``dep:<relation>`` (``dep:acl:relcl``),
+* ``pos:<tag>+<tag>`` and ``pos:<tag>+<tag>+<tag>``, of the first ``morph``
+  tags as in ``Pos_ngrams_*`` (``pos:PRTF+NOUN``).
+
+Every term has a posting list: for every document the difference of its id
+to the previous one, the number of positions and the differences between
+the positions, all as LEB128 varints. The lists are collected per term in
+memory in this compressed form. The index file is an ``arrayfile`` with the
+sorted terms, so a lookup is a binary search over the mapped terms and the
+decoding of one posting list.
+
+A query lists the documents that contain every given term. A term without
+an entry (``Archaic_words``, ``dep:``) stands for all the terms it prefixes:
+
+    python inverted_index.py query --index=reviews.idx Archaic_words dep:acl:relcl --positions
+    python inverted_index.py terms --index=reviews.idx --prefix=dep:
+"""
+
+import argparse
+import os
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+
+import numpy as np
+
+from arrayfile import map_arrays, write_arrays
+
+
+INDEX_MAGIC = b'FIDX0001'
+# Buffered posting numbers are compressed once there are this many
+FLUSH_NUMBERS = 1 << 22
+
+
+def encode_varints(values):
+    """LEB128 bytes of unsigned integers."""
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        lengths += rest > 0
+        rest >>= np.uint64(7)
+    starts = np.cumsum(lengths) - lengths
+    encoded = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for k in range(int(lengths.max(initial=0))):
+        selected = lengths > k
+        byte = (values[selected] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = (lengths[selected] > k + 1).astype(np.uint64) << np.uint64(7)
+        encoded[starts[selected] + k] = (byte | more).astype(np.uint8)
+    return encoded
+
+
+def decode_varints(data):
+    data = np.asarray(data, dtype=np.uint8)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    values = np.zeros(len(ends), dtype=np.uint64)
+    for k in range(int(lengths.max(initial=0))):
+        selected = lengths > k
+        values[selected] |= (data[starts[selected] + k] & np.uint8(0x7F)).astype(np.uint64) << np.uint64(7 * k)
+    return values
+
+
+def _strings(strings):
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(string) for string in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+class IndexWriter:
+    """Posting lists of documents added in order (``add``), written by ``close``."""
+
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        # term -> [compressed bytes, buffered numbers, last document, documents, occurrences]
+        self.terms = {}
+        self.buffered = 0
+
+    def add(self, name, postings):
+        """Add a document with ``{term: token positions}``."""
+        document = len(self.names)
+        self.names.append(name)
+        for term, positions in postings.items():
+            entry = self.terms.get(term)
+            if entry is None:
+                entry = self.terms[term] = [bytearray(), array('Q'), 0, 0, 0]
+            positions = sorted(set(positions))
+            entry[1].append(document - entry[2])
+            entry[1].append(len(positions))
+            entry[1].extend(position - previous for position, previous in zip(positions, [0] + positions[:-1]))
+            entry[2] = document
+            entry[3] += 1
+            entry[4] += len(positions)
+            self.buffered += 2 + len(positions)
+        if self.buffered >= FLUSH_NUMBERS:
+            self._flush()
+
+    def _flush(self):
+        for entry in self.terms.values():
+            if entry[1]:
+                entry[0] += encode_varints(np.frombuffer(entry[1], dtype=np.uint64)).tobytes()
+                entry[1] = array('Q')
+        self.buffered = 0
+
+    def close(self):
+        self._flush()
+        terms = sorted(self.terms)
+        term_blob, term_offsets = _strings(terms)
+        name_blob, name_offsets = _strings(self.names)
+        posting_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        posting_offsets[1:] = np.cumsum([len(self.terms[term][0]) for term in terms])
+        write_arrays(self.path, INDEX_MAGIC, {
+            'terms': term_blob,
+            'term_offsets': term_offsets,
+            'postings': np.frombuffer(b''.join(self.terms[term][0] for term in terms), dtype=np.uint8),
+            'posting_offsets': posting_offsets,
+            'documents': np.array([self.terms[term][3] for term in terms], dtype=np.uint32),
+            'occurrences': np.array([self.terms[term][4] for term in terms], dtype=np.uint64),
+            'names': name_blob,
+            'name_offsets': name_offsets,
+        }, meta={'documents': len(self.names)})
+        return len(terms)
+
+
+class _Terms:
+    # Sequence view of the sorted terms, for bisect
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index.term_offsets) - 1
+
+    def __getitem__(self, i):
+        return self.index.term(i)
+
+
+class InvertedIndex:
+
+    def __init__(self, path):
+        arrays, meta = map_arrays(path, INDEX_MAGIC)
+        self.path = path
+        self.terms = arrays['terms']
+        self.term_offsets = arrays['term_offsets']
+        self.postings = arrays['postings']
+        self.posting_offsets = arrays['posting_offsets']
+        self.documents = arrays['documents']
+        self.occurrences = arrays['occurrences']
+        self.names = arrays['names']
+        self.name_offsets = arrays['name_offsets']
+        self.size = meta['documents']
+        self._sorted = _Terms(self)
+
+    def __len__(self):
+        return self.size
+
+    def term(self, i):
+        return self.terms[self.term_offsets[i]:self.term_offsets[i + 1]].tobytes().decode('utf-8')
+
+    def name(self, document):
+        return self.names[self.name_offsets[document]:self.name_offsets[document + 1]].tobytes().decode('utf-8')
+
+    def term_ids(self, query):
+        """Ids of ``query``, or of all the terms it prefixes when it has no entry (``dep:``, ``Archaic_words``)."""
+        first = bisect_left(self._sorted, query)
+        if ':' in query.rstrip(':') and first < len(self._sorted) and self._sorted[first] == query:
+            return range(first, first + 1)
+        prefix = query.rstrip(':') + ':'
+        first = bisect_left(self._sorted, prefix)
+        return range(first, bisect_left(self._sorted, prefix + '\U0010ffff'))
+
+    def posting_list(self, term_id):
+        """``{document: [positions]}`` of a term."""
+        values = decode_varints(self.postings[self.posting_offsets[term_id]:self.posting_offsets[term_id + 1]]).tolist()
+        postings = {}
+        document = i = 0
+        while i < len(values):
+            document += values[i]
+            count = values[i + 1]
+            postings[document] = list(accumulate(values[i + 2:i + 2 + count]))
+            i += 2 + count
+        return postings
+
+    def lookup(self, query):
+        """``{document: {term: [positions]}}`` of a query term."""
+        found = {}
+        for term_id in self.term_ids(query):
+            term = self.term(term_id)
+            for document, positions in self.posting_list(term_id).items():
+                found.setdefault(document, {})[term] = positions
+        return found
+
+    def search(self, queries):
+        """``[(name, {term: [positions]})]`` of the documents that match every query term."""
+        matched = None
+        for query in queries:
+            found = self.lookup(query)
+            if matched is None:
+                matched = found
+            else:
+                matched = {document: {**terms, **found[document]} for document, terms in matched.items() if document in found}
+            if not matched:
+                return []
+        return [(self.name(document), terms) for document, terms in sorted((matched or {}).items())]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Look up documents in an inverted index written by feature_extractor.py --index-path")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    query_parser = subparsers.add_parser('query', help="documents that contain every term")
+    query_parser.add_argument("terms", nargs='+', help="terms such as Archaic_words:сей, Archaic_words, dep:acl:relcl, pos:PRTF+NOUN")
+    query_parser.add_argument("--index", action='append', required=True, help="index file; repeat for the indexes of several shards")
+    query_parser.add_argument("--positions", action='store_true', help="also print the matching terms and token positions")
+    query_parser.add_argument("--limit", type=int, default=None, help="print at most this many documents")
+
+    terms_parser = subparsers.add_parser('terms', help="terms with their numbers of documents and occurrences")
+    terms_parser.add_argument("--index", required=True, help="index file")
+    terms_parser.add_argument("--prefix", default='', help="only the terms that start with this prefix")
+
+    args = parser.parse_args()
+    for path in [args.index] if args.command == 'terms' else args.index:
+        if not os.path.isfile(path):
+            parser.error(f"--index: no such file: {path}")
+
+    if args.command == 'terms':
+        index = InvertedIndex(args.index)
+        first = bisect_left(index._sorted, args.prefix)
+        for term_id in range(first, len(index._sorted)):
+            term = index.term(term_id)
+            if not term.startswith(args.prefix):
+                break
+            print(f'{term}\t{index.documents[term_id]}\t{index.occurrences[term_id]}')
+        return
+
+    start = time.perf_counter()
+    found = 0
+    for path in args.index:
+        for name, terms in InvertedIndex(path).search(args.terms):
+            if args.limit is not None and found >= args.limit:
+                break
+            found += 1
+            if args.positions:
+                print('\t'.join([name] + [f'{term}@{",".join(map(str, positions))}' for term, positions in sorted(terms.items())]))
+            else:
+                print(name)
+    print(f'{found} documents in {(time.perf_counter() - start) * 1000:.1f} ms', file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
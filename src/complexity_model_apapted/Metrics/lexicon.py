@@ -0,0 +1,311 @@
+"""
+Frozen lexicon formats used by the dictionary-based metrics.
+
+Every dictionary is compiled once into a file written with ``arrayfile`` and
+opened with ``numpy.memmap`` in read-only mode, so all worker processes map
+the same pages instead of holding their own copy of the lexicon.
+
+* ``FrozenLexicon`` holds sorted fixed-width UTF-8 keys and a parallel uint8
+  value array; a whole document is looked up with one ``searchsorted`` call.
+  It backs the Zipf bands and the single-word lists (Sokr, Abbr, ...).
+* ``FrozenPatternSet`` is a multi-pattern substring matcher for the phrase
+  lists (Term, LVC, ...). Patterns are grouped by length and stored as sorted
+  64-bit polynomial hashes, so a text is scanned once per distinct pattern
+  length with vectorized rolling hashes. A bitmap over the top hash bits
+  rejects almost every window before the binary search, and the remaining
+  candidates are verified against the pattern text.
+
+Build the Zipf lexicon from the source frequency list with:
+
+    python lexicon.py build-zipf --source ./Dictionaries/zipf_dict.csv --output ./Dictionaries/zipf_dict.lex
+
+The ``.txt`` word and phrase lists are compiled automatically by
+``LexiconStore`` the first time they are needed or when the source changes.
+"""
+
+import argparse
+import csv
+import os
+from collections import Counter
+
+import numpy as np
+
+from arrayfile import map_arrays, write_arrays
+
+
+LEXICON_MAGIC = b'FLEX0002'
+PATTERNS_MAGIC = b'FPAT0001'
+MISSING = -1
+
+HASH_BASE = 0x9E3779B97F4A7C15
+HASH_MASK = (1 << 64) - 1
+HASH_BASE_INV = pow(HASH_BASE, -1, 1 << 64)
+FILTER_BITS = 24
+
+
+def build(entries, output_path):
+    table = {}
+    for key, value in entries:
+        if not 0 <= value <= 255:
+            raise ValueError(f'value {value} of {key!r} does not fit into uint8')
+        table[key.encode('utf-8')] = value
+
+    width = max((len(key) for key in table), default=1) or 1
+    keys = np.array(list(table), dtype=f'S{width}')
+    values = np.array(list(table.values()), dtype=np.uint8)
+    order = np.argsort(keys, kind='stable')
+
+    write_arrays(output_path, LEXICON_MAGIC, {'keys': keys[order], 'values': values[order]})
+    return len(keys)
+
+
+class FrozenLexicon:
+
+    def __init__(self, path):
+        arrays, _ = map_arrays(path, LEXICON_MAGIC)
+        self.path = path
+        self.keys = arrays['keys']
+        self.values = arrays['values']
+        self.width = self.keys.dtype.itemsize
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return bool(self.lookup([key])[0] != MISSING)
+
+    def lookup(self, keys):
+        """Return the value of every key, or ``MISSING`` for unknown keys."""
+        encoded = [key.encode('utf-8') for key in keys]
+        result = np.full(len(encoded), MISSING, dtype=np.int16)
+        if not encoded or not len(self.keys):
+            return result
+
+        # Longer keys would be truncated to the lexicon width and could
+        # collide with a stored prefix, so they are never looked up.
+        fits = np.array([len(key) <= self.width for key in encoded], dtype=bool)
+        queries = np.array(encoded, dtype=f'S{self.width}')
+
+        positions = np.searchsorted(self.keys, queries)
+        positions[positions == len(self.keys)] = 0
+        found = fits & (self.keys[positions] == queries)
+        result[found] = self.values[positions[found]]
+        return result
+
+    def contains(self, keys):
+        return self.lookup(keys) != MISSING
+
+
+def _codes(text):
+    # Code points shifted by one so that no character hashes to zero.
+    return np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64) + 1
+
+
+def pattern_hash(text):
+    value = 0
+    for code in _codes(text).tolist():
+        value = (value * HASH_BASE + code) & HASH_MASK
+    return value
+
+
+def build_patterns(patterns, output_path):
+    """Compile phrase patterns; duplicated patterns keep their multiplicity."""
+    multiplicity = Counter(patterns)
+    empty = multiplicity.pop('', 0)
+    texts = sorted(multiplicity, key=lambda p: (len(p), pattern_hash(p), p))
+
+    lengths = np.array([len(p) for p in texts], dtype=np.int64)
+    hashes = np.array([pattern_hash(p) for p in texts], dtype=np.uint64)
+    blob = [p.encode('utf-8') for p in texts]
+    offsets = np.zeros(len(blob) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in blob])
+
+    filter_index = hashes >> np.uint64(64 - FILTER_BITS)
+    hash_filter = np.zeros(1 << (FILTER_BITS - 3), dtype=np.uint8)
+    np.bitwise_or.at(hash_filter, filter_index >> np.uint64(3), (1 << (filter_index & np.uint64(7))).astype(np.uint8))
+
+    group_lengths, group_starts = np.unique(lengths, return_index=True)
+    group_bounds = np.append(group_starts, len(texts)).astype(np.int64)
+
+    write_arrays(
+        output_path,
+        PATTERNS_MAGIC,
+        {
+            'hashes': hashes,
+            'multiplicity': np.array([multiplicity[p] for p in texts], dtype=np.uint32),
+            'group_lengths': group_lengths.astype(np.int64),
+            'group_bounds': group_bounds,
+            'offsets': offsets,
+            'blob': np.frombuffer(b''.join(blob), dtype=np.uint8),
+            'filter': hash_filter,
+        },
+        meta={'empty_multiplicity': empty},
+    )
+    return len(texts) + (1 if empty else 0)
+
+
+class FrozenPatternSet:
+
+    def __init__(self, path):
+        arrays, meta = map_arrays(path, PATTERNS_MAGIC)
+        self.path = path
+        self.hashes = arrays['hashes']
+        self.multiplicity = arrays['multiplicity']
+        self.group_lengths = arrays['group_lengths']
+        self.group_bounds = arrays['group_bounds']
+        self.offsets = arrays['offsets']
+        self.blob = arrays['blob']
+        self.filter = arrays['filter']
+        self.empty_multiplicity = meta['empty_multiplicity']
+        self._decoded = {}
+
+    def __len__(self):
+        return len(self.hashes) + (1 if self.empty_multiplicity else 0)
+
+    def pattern(self, pattern_id):
+        # Only patterns that actually matched are decoded and kept per process.
+        if pattern_id not in self._decoded:
+            start, end = self.offsets[pattern_id], self.offsets[pattern_id + 1]
+            self._decoded[pattern_id] = self.blob[start:end].tobytes().decode('utf-8')
+        return self._decoded[pattern_id]
+
+    def find(self, text):
+        """Return ``{pattern_id: [start, ...]}`` for every (possibly overlapping) match."""
+        matches = {}
+        size = len(text)
+        if not size or not len(self.hashes):
+            return matches
+
+        codes = _codes(text)
+        powers = np.ones(size + 1, dtype=np.uint64)
+        powers[1:] = np.cumprod(np.full(size, HASH_BASE, dtype=np.uint64))
+        inverse = np.ones(size, dtype=np.uint64)
+        inverse[1:] = np.cumprod(np.full(size - 1, HASH_BASE_INV, dtype=np.uint64))
+        prefix = np.zeros(size + 1, dtype=np.uint64)
+        prefix[1:] = np.cumsum(codes * inverse)
+
+        for length, start, end in zip(self.group_lengths.tolist(), self.group_bounds[:-1].tolist(), self.group_bounds[1:].tolist()):
+            if length > size:
+                break
+            group = self.hashes[start:end]
+            windows = powers[length - 1:size] * (prefix[length:] - prefix[:size - length + 1])
+            bits = windows >> np.uint64(64 - FILTER_BITS)
+            candidates = np.flatnonzero((self.filter[bits >> np.uint64(3)] >> (bits & np.uint64(7)).astype(np.uint8)) & 1)
+            slots = np.searchsorted(group, windows[candidates])
+            hit = slots < len(group)
+            hit[hit] = group[slots[hit]] == windows[candidates[hit]]
+
+            for position, slot in zip(candidates[hit].tolist(), slots[hit].tolist()):
+                fragment = text[position:position + length]
+                # Equal hashes are adjacent; check all of them against the text.
+                while True:
+                    if self.pattern(start + slot) == fragment:
+                        matches.setdefault(start + slot, []).append(position)
+                    slot += 1
+                    if slot == len(group) or group[slot] != group[slot - 1]:
+                        break
+        return matches
+
+    def count_present(self, text, matches=None):
+        """Number of patterns (with multiplicity) that occur in ``text``, like ``sum(p in text)``.
+
+        ``matches`` is ``find(text)``, when it is already known.
+        """
+        found = self.find(text) if matches is None else matches
+        return self.empty_multiplicity + int(sum(self.multiplicity[pattern_id] for pattern_id in found))
+
+    def count_occurrences(self, text, matches=None):
+        """Total non-overlapping occurrences of all patterns, like ``sum(text.count(p))``."""
+        total = self.empty_multiplicity * (len(text) + 1)
+        for pattern_id, positions in (self.find(text) if matches is None else matches).items():
+            length = len(self.pattern(pattern_id))
+            count, free = 0, 0
+            for position in positions:
+                if position >= free:
+                    count += 1
+                    free = position + length
+            total += count * int(self.multiplicity[pattern_id])
+        return total
+
+
+def read_list(path):
+    with open(path, encoding='utf-8') as file:
+        return [line.rstrip() for line in file.readlines()]
+
+
+def read_zipf_source(path):
+    with open(path, encoding='utf-8') as fp:
+        reader = csv.reader(fp, delimiter="\t", quotechar='"')
+        next(reader, None)
+        for row in reader:
+            yield row[0], int(row[13])
+
+
+def _is_stale(source_path, compiled_path):
+    return not os.path.exists(compiled_path) or os.path.getmtime(compiled_path) < os.path.getmtime(source_path)
+
+
+class LexiconStore:
+    """Compiled dictionaries of a ``Dictionaries`` folder, mapped on first use.
+
+    Compilation happens in whichever process asks first (normally the parent
+    before it starts the worker pool) and is written atomically, so workers
+    only ever attach to finished files.
+    """
+
+    def __init__(self, dictionary_dir, compiled_dir=None):
+        self.dictionary_dir = dictionary_dir
+        self.compiled_dir = compiled_dir or os.path.join(dictionary_dir, 'compiled')
+        self._mapped = {}
+
+    def _compiled(self, name, suffix, builder):
+        source = os.path.join(self.dictionary_dir, f'{name}.txt')
+        target = os.path.join(self.compiled_dir, f'{name}{suffix}')
+        if _is_stale(source, target):
+            os.makedirs(self.compiled_dir, exist_ok=True)
+            builder(read_list(source), target)
+        return target
+
+    def word_list(self, name):
+        if name not in self._mapped:
+            path = self._compiled(name, '.lex', lambda lines, target: build(((line, 0) for line in lines), target))
+            self._mapped[name] = FrozenLexicon(path)
+        return self._mapped[name]
+
+    def phrase_list(self, name):
+        if name not in self._mapped:
+            path = self._compiled(name, '.pat', build_patterns)
+            self._mapped[name] = FrozenPatternSet(path)
+        return self._mapped[name]
+
+    def prefixes(self, name):
+        # Short prefix lists are used with str.startswith and stay in memory.
+        if name not in self._mapped:
+            self._mapped[name] = tuple(read_list(os.path.join(self.dictionary_dir, f'{name}.txt')))
+        return self._mapped[name]
+
+    def frozen(self, name):
+        if name not in self._mapped:
+            self._mapped[name] = FrozenLexicon(os.path.join(self.dictionary_dir, f'{name}.lex'))
+        return self._mapped[name]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build frozen lexicons for feature_extractor.py")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    zipf_parser = subparsers.add_parser('build-zipf', help="compile the Zipf frequency list")
+    zipf_parser.add_argument(
+        "--source", default="./Dictionaries/zipf_dict.csv", help="tab-separated frequency list"
+    )
+    zipf_parser.add_argument(
+        "--output", default="./Dictionaries/zipf_dict.lex", help="frozen lexicon file"
+    )
+
+    args = parser.parse_args()
+    size = build(read_zipf_source(args.source), args.output)
+    print(f'{args.output}: {size} entries')
+
+
+if __name__ == "__main__":
+    main()
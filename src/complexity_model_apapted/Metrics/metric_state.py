@@ -0,0 +1,660 @@
+"""
+Mergeable per-document state for the ``features.txt`` metrics.
+
+``DocumentState.from_document`` scans the tokens of a parsed document once and
+keeps only what the metrics need: additive counts (tokens, sentences,
+characters, POS/morph/dep tags, lexicon hits, ...), the word and lemma
+frequency counters, and a little boundary context (the first and last tokens,
+noun runs, first and last sentences, the head and tail of the joined lemma
+and word texts). ``merge`` combines two states into the state of the
+concatenated document, so group-level metrics (by source, model, prompt, ...)
+are an aggregation over stored per-document states instead of a rescan of
+the tokens. ``finalize`` turns any state into the metric values.
+
+The result of merging is exactly what ``feature_extractor.py`` reports for the
+documents parsed separately and concatenated in merge order, quirks included,
+with two exceptions:
+
+* ``parse_csv`` folds a repeated sentence into the preceding one. Across
+  documents this only happens when they are stored in one CSV file, so
+  merged states do not reproduce it.
+* ``Term_pr`` counts non-overlapping occurrences per term. A term occurrence
+  that straddles a document boundary is counted even if it overlaps the
+  previous occurrence of the same term.
+
+Undefined values (divisions by zero on empty documents) are NaN.
+
+States created with ``approximate=True`` (``feature_extractor.py
+--approximate``) keep the word and lemma frequencies in fixed-size
+``sketches.VocabularySketch`` objects instead of counters, so a merged state
+stays the same size however many documents it covers. The vocabulary metrics
+of such a state are exact while the vocabulary fits into the sketch sample
+and estimates with the error bounds documented in ``sketches`` beyond that;
+all other metrics are unaffected.
+
+    python metric_state.py aggregate --states-path=states.jsonl --groups=groups.csv --group-column=model --output-path=groups_metrics.csv
+"""
+
+import argparse
+import csv
+import json
+import math
+import re
+from collections import Counter
+from copy import deepcopy
+
+from sketches import VocabularySketch
+
+
+PUNCTUATION_CHARS = ".,;:!?()[]{}'\"-"
+NOT_VOWEL = re.compile('[^ауоыиэяюёе]+')
+NOT_LETTER = re.compile('[^a-zA-Zа-яА-Я]+')
+NOT_DIGIT = re.compile('[^0-9]+')
+FZ = re.compile(r'[0-9]-ФЗ')
+WORD_FORM_SUFFIXES = ('ция', 'ние', 'вие', 'тие', 'ист', 'изм', 'ура', 'ище', 'ство', 'ость', 'овка', 'атор', 'итор', 'тель', 'льный', 'овать')
+
+POS_GROUPS = {
+    'Func_word_pr': ('ADP', 'AUX', 'CCONJ', 'PART', 'SCONJ'),
+    'Verb_pr': ('VERB', 'AUX'),
+    'Noun_pr': ('NOUN', 'PROPN'),
+    'Adj_pr': ('ADJ',),
+    'Prop_pr': ('DET', 'PRON'),
+    'Autosem_pr': ('ADJ', 'ADV', 'NOUN', 'NUM', 'PROPN', 'VERB'),
+    'Nouns_pr': ('ADJ', 'NOUN', 'PROPN'),
+    'Cconj_pr': ('CCONJ',),
+    'Sconj_pr': ('SCONJ',),
+}
+
+MORPH_TAGS = {
+    'Adjs_pr': 'ADJS', 'Prtf_pr': 'PRTF', 'Prts_pr': 'PRTS', 'Npro_pr': 'NPRO', 'Pred_pr': 'PRED',
+    'Grnd_pr': 'GRND', 'Infn_pr': 'INFN', 'Numr_pr': 'NUMR', 'Prcl_pr': 'PRCL', 'Prep_pr': 'PREP',
+    'Comp_pr': 'COMP', 'Gen_pr': 'gent', 'Ablt_pr': 'ablt', 'datv': 'datv', 'nomn': 'nomn',
+    'loct': 'loct', 'Neut_pr': 'neut', 'Inan_pr': 'inan', 'P1_pr': '1per', 'P3_pr': '3per',
+    'Pres_pr': 'pres', 'Futr_pr': 'futr', 'Past_pr': 'past', 'Impf_pr': 'impf', 'Perf_pr': 'perf',
+}
+
+MORPH_TAG_SET = frozenset(MORPH_TAGS.values())
+
+# Bigrams of first morph tags. None of them overlaps itself, so the legacy
+# ``'+'.join(tags).count(pattern)`` equals the number of adjacent pairs whose
+# first tags end and start with the two halves.
+BIGRAMS = (
+    'VERB+NOUN', 'NOUN+VERB', 'ADVB+VERB', 'ADJF+NOUN', 'GRND+NOUN',
+    'ADVB+GRND', 'PRTF+NOUN', 'PRTF+ADVB', 'PRTS+ADVB', 'ADJF+VERB',
+)
+BIGRAM_PARTS = [(bigram, *bigram.split('+')) for bigram in BIGRAMS]
+
+DEP_RELATIONS = {
+    'Acl_pr': 'acl', 'Aclrelcl_pr': 'acl:relcl', 'Advcl_pr': 'advcl', 'Advmod_pr': 'advmod',
+    'Amod_pr': 'amod', 'Appos_pr': 'appos', 'Auxpass_pr': 'aux:pass', 'Cc_pr': 'cc',
+    'Ccomp_pr': 'ccomp', 'Compound_pr': 'compound', 'Conj_pr': 'conj', 'Cop_pr': 'cop',
+    'Csubj_pr': 'csubj', 'Csubjpass_pr': 'csubj:pass', 'Discourse_pr': 'discourse', 'Mark_pr': 'mark',
+    'Nsubj_pr': 'nsubj', 'Nsubjpass_pr': 'nsubj:pass', 'Nummod_pr': 'nummod', 'Orphan_pr': 'orphan',
+    'Parataxis_pr': 'parataxis', 'Xcomp_pr': 'xcomp',
+}
+
+# metric -> (dictionary, token field); tokens are lower-cased before lookup.
+WORD_LISTS = {
+    'Sokr_pr': ('Sokr', 'word'),
+    'Abbr_pr': ('Abbr', 'word'),
+    'Abstr_pr': ('Abstract', 'lemma'),
+    'Deont_pr': ('Deont', 'lemma'),
+}
+
+# metric -> (dictionary, joined text, 'count' occurrences or 'present' patterns)
+PHRASE_LISTS = {
+    'Term_pr': ('Term', 'lemma', 'count'),
+    'Prep_mw_pr': ('Prep_mw', 'word', 'present'),
+    'Conj_mw_pr': ('Conj_mw', 'word', 'present'),
+    'LVC_pr': ('LVC', 'lemma', 'present'),
+    'Arch_pr': ('Archaic_words', 'lemma', 'present'),
+}
+
+ZIPF_BANDS = 9
+BOUNDARY_TOKENS = 2
+PHRASE_CONTEXT = 256
+
+
+def _syllables(text):
+    return len(NOT_VOWEL.sub('', text))
+
+
+def _aspect_tense(tags):
+    # Number of (aspect, tense) combinations of a verb, as counted by Cohes_2.
+    if 'VERB' not in tags:
+        return 0
+    return (('impf' in tags) + ('perf' in tags)) * (('pres' in tags) + ('past' in tags) + ('futr' in tags))
+
+
+def _position_counts(tokens, i):
+    """Pair/triple counts contributed by token ``i`` looking ahead in ``tokens``.
+
+    ``tokens`` holds ``(first_tag, tags)`` pairs; lookahead stops at the end
+    of the list exactly like the legacy loops.
+    """
+    counts = Counter()
+    if i + 1 >= len(tokens):
+        return counts
+    first, tags = tokens[i]
+    next_first, next_tags = tokens[i + 1]
+
+    for bigram, left, right in BIGRAM_PARTS:
+        if first.endswith(left) and next_first.startswith(right):
+            counts[f'bigram:{bigram}'] += 1
+    if 'NOUN' in tags:
+        if 'NOUN' in next_tags and 'gent' in next_tags:
+            counts['noun_gent'] += 1
+        if 'PNCT' in next_tags:
+            if i + 2 < len(tokens) and 'PRTF' in tokens[i + 2][1]:
+                counts['noun_prtf'] += 1
+        elif 'PRTF' in next_tags:
+            counts['noun_prtf'] += 1
+    return counts
+
+
+def count_sentence(sums, sentence, sign=1):
+    """Add (``sign=-1``: remove) the counts of one sentence text."""
+    sums['sents'] += sign
+    sums['chars'] += sign * len(sentence)
+    sums['letters'] += sign * len(NOT_LETTER.sub('', sentence))
+    sums['digits'] += sign * len(NOT_DIGIT.sub('', sentence))
+    sums['syllables'] += sign * _syllables(sentence)
+    sums['fz'] += sign * len(FZ.findall(sentence))
+
+
+def count_token(sums, word, lemma, pos, morph, dep, tags, textdeixis, sign=1):
+    """Add (``sign=-1``: remove) the counts of one token that need no context."""
+    first = tags[0]
+    sums['tokens'] += sign
+    word_syllables = _syllables(word)
+    sums['word_syllables'] += sign * word_syllables
+    sums['word_chars'] += sign * len(word)
+    sums['word_long'] += sign * (word_syllables > 3)
+    sums['lemma_long'] += sign * (_syllables(lemma) > 3)
+    sums['comma'] += sign * (word == ',')
+    sums['punct'] += sign * (word in PUNCTUATION_CHARS)
+    sums[f'pos:{pos}'] += sign
+    for tag in MORPH_TAG_SET.intersection(tags):
+        sums[f'tag:{tag}'] += sign
+    sums['pssv_prtf'] += sign * ('pssv' in tags and 'PRTF' in tags)
+    sums['pssv_prts'] += sign * ('pssv' in tags and 'PRTS' in tags)
+    sums['adjf'] += sign * morph.count('ADJF')
+    sums['sja_verb'] += sign * (word.endswith('ся') and first == 'VERB')
+    sums['yavl'] += sign * (lemma == 'являться')
+    sums['word_form'] += sign * lemma.endswith(WORD_FORM_SUFFIXES)
+    sums['textdeixis'] += sign * word.startswith(textdeixis)
+    sums[f'dep:{dep.lower()}'] += sign
+
+
+def _noun_runs(first_tags):
+    # pymorphy2 always writes a noun's first tag as exactly 'NOUN'
+    runs = []
+    length = 0
+    for first in first_tags:
+        if first == 'NOUN':
+            length += 1
+        else:
+            runs.append(length)
+            length = 0
+    runs.append(length)
+    return runs
+
+
+class DocumentState:
+
+    def __init__(self, approximate=False):
+        self.approximate = approximate
+        self.sums = Counter()
+        self.words = VocabularySketch() if approximate else Counter()
+        self.lemmas = VocabularySketch() if approximate else Counter()
+        self.head = []
+        self.tail = []
+        # leading/trailing NOUN run lengths and the pair/triple counts of the
+        # runs in between (Pos_ngrams_5_pr and Pos_ngrams_6_pr)
+        self.noun_lead = 0
+        self.noun_trail = 0
+        self.noun_inner = [0, 0]
+        self.first_nouns = None
+        self.last_nouns = None
+        self.first_aspect = 0
+        self.last_aspect = 0
+        self.texts = {'lemma': ['', '', 0], 'word': ['', '', 0]}
+        self.phrases = {name: set() for name, _, mode in PHRASE_LISTS.values() if mode == 'present'}
+
+    @classmethod
+    def from_document(cls, words, sents, lexicons, approximate=False):
+        state = cls(approximate)
+        sums = state.sums
+        sums['sents'] = 0
+        sums['word_sents'] = len(words)
+        for sentence in sents:
+            count_sentence(sums, sentence)
+
+        textdeixis = lexicons.prefixes('Textdeixis')
+        tokens = []
+        lemma_list = []
+        lowered = {'word': [], 'lemma': []}
+        aspects = []
+        nouns = []
+        for sentence in words:
+            sentence_aspect = 0
+            sentence_nouns = set()
+            for item in sentence:
+                word, lemma, pos, morph, dep = item['word'], item['lemma'], item['pos'], item['morph'], item['dep']
+                tags = morph.split(',')
+                first = tags[0]
+                tokens.append((first, tags))
+                lemma_list.append(lemma)
+                lowered['word'].append(word.lower())
+                lowered['lemma'].append(lemma.lower())
+
+                count_token(sums, word, lemma, pos, morph, dep, tags, textdeixis)
+
+                sentence_aspect += _aspect_tense(tags)
+                if pos == 'NOUN':
+                    sentence_nouns.add(lemma)
+            state.words.update(item['word'] for item in sentence)
+            state.lemmas.update(item['lemma'] for item in sentence)
+            aspects.append(sentence_aspect)
+            nouns.append(sentence_nouns)
+
+        for i in range(len(tokens)):
+            sums.update(_position_counts(tokens, i))
+        state.head = tokens[:BOUNDARY_TOKENS]
+        state.tail = tokens[-BOUNDARY_TOKENS:]
+
+        runs = _noun_runs([first for first, _ in tokens])
+        state.noun_lead, state.noun_trail = runs[0], runs[-1]
+        state.noun_inner = [sum(run // k for run in runs[1:-1]) for k in (2, 3)]
+
+        sums['cohes1'] = sum(len(nouns[i] & nouns[i + 1]) for i in range(len(nouns) - 1))
+        sums['aspect'] = sum(aspects)
+        if words:
+            state.first_nouns, state.last_nouns = nouns[0], nouns[-1]
+            state.first_aspect, state.last_aspect = aspects[0], aspects[-1]
+
+        bands = lexicons.frozen('zipf_dict').lookup(lemma_list)
+        for band, count in Counter(bands.tolist()).items():
+            if 0 <= band < ZIPF_BANDS:
+                sums[f'zipf:{band}'] = count
+        for name, field in WORD_LISTS.values():
+            sums[f'list:{name}'] = int(lexicons.word_list(name).contains(lowered[field]).sum())
+
+        for field in ('lemma', 'word'):
+            text = ' '.join(lowered[field])
+            state.texts[field] = [text[:PHRASE_CONTEXT], text[-PHRASE_CONTEXT:], len(text)]
+        for name, field, mode in PHRASE_LISTS.values():
+            patterns = lexicons.phrase_list(name)
+            text = ' '.join(lowered[field])
+            if mode == 'count':
+                sums[f'phrase:{name}'] = patterns.count_occurrences(text)
+            else:
+                state.phrases[name] = set(patterns.find(text))
+        return state
+
+    def copy(self):
+        state = DocumentState(self.approximate)
+        state.sums = Counter(self.sums)
+        state.words = deepcopy(self.words) if self.approximate else Counter(self.words)
+        state.lemmas = deepcopy(self.lemmas) if self.approximate else Counter(self.lemmas)
+        state.head, state.tail = list(self.head), list(self.tail)
+        state.noun_lead, state.noun_trail, state.noun_inner = self.noun_lead, self.noun_trail, list(self.noun_inner)
+        state.first_nouns, state.last_nouns = self.first_nouns, self.last_nouns
+        state.first_aspect, state.last_aspect = self.first_aspect, self.last_aspect
+        state.texts = {field: list(value) for field, value in self.texts.items()}
+        state.phrases = {name: set(ids) for name, ids in self.phrases.items()}
+        return state
+
+    def merge(self, other, lexicons):
+        """Return the state of this document followed by ``other``."""
+        return self.copy().update(other, lexicons)
+
+    def update(self, other, lexicons):
+        """Append ``other`` to this state in place and return it.
+
+        The cost depends on the size of ``other`` only, so folding a group
+        of documents into one state is linear in the group.
+        """
+        if not other.sums['tokens'] and not other.sums['sents'] and not other.sums['word_sents']:
+            return self
+        if not self.sums['tokens'] and not self.sums['sents'] and not self.sums['word_sents']:
+            self.__dict__.update(other.copy().__dict__)
+            return self
+        if self.approximate != other.approximate:
+            raise ValueError('cannot merge an approximate state with an exact one')
+
+        n_self, n_other = self.sums['tokens'], other.sums['tokens']
+        self_sentences = self.sums['word_sents']
+        sums = self.sums
+        # Adjacent-token counts of our last tokens change once they can look
+        # ahead into the other document.
+        window = self.tail + other.head
+        for i in range(len(self.tail)):
+            sums.subtract(_position_counts(self.tail, i))
+            sums.update(_position_counts(window, i))
+        sums.update(other.sums)
+        if self.approximate:
+            self.words = self.words + other.words
+            self.lemmas = self.lemmas + other.lemmas
+        else:
+            self.words.update(other.words)
+            self.lemmas.update(other.lemmas)
+
+        self_all = n_self and self.noun_lead == n_self
+        other_all = n_other and other.noun_lead == n_other
+        if self_all or other_all or not n_self or not n_other:
+            self.noun_inner = [a + b for a, b in zip(self.noun_inner, other.noun_inner)]
+        else:
+            joined = self.noun_trail + other.noun_lead
+            self.noun_inner = [a + b + joined // k for a, b, k in zip(self.noun_inner, other.noun_inner, (2, 3))]
+        noun_lead = self.noun_lead + other.noun_lead if self_all or not n_self else self.noun_lead
+        self.noun_trail = self.noun_trail + other.noun_trail if other_all or not n_other else other.noun_trail
+        self.noun_lead = noun_lead
+
+        if self.first_nouns is not None and other.first_nouns is not None:
+            sums['cohes1'] += len(set(self.last_nouns) & set(other.first_nouns))
+        if self.first_nouns is None:
+            self.first_nouns = other.first_nouns
+        if other.last_nouns is not None:
+            self.last_nouns = other.last_nouns
+        if not self_sentences:
+            self.first_aspect = other.first_aspect
+        if other.sums['word_sents']:
+            self.last_aspect = other.last_aspect
+
+        for name in self.phrases:
+            self.phrases[name] |= other.phrases[name]
+        crossing = {}
+        for field in ('lemma', 'word'):
+            head, tail, length = self.texts[field]
+            other_head, other_tail, other_length = other.texts[field]
+            if n_self and n_other:
+                crossing[field] = (tail + ' ' + other_head, len(tail))
+                self.texts[field] = [
+                    head if length >= PHRASE_CONTEXT else (head + ' ' + other_head)[:PHRASE_CONTEXT],
+                    other_tail if other_length >= PHRASE_CONTEXT else (tail + ' ' + other_tail)[-PHRASE_CONTEXT:],
+                    length + 1 + other_length,
+                ]
+            elif not n_self:
+                self.texts[field] = list(other.texts[field])
+
+        for name, field, mode in PHRASE_LISTS.values():
+            if field not in crossing:
+                continue
+            text, separator = crossing[field]
+            patterns = lexicons.phrase_list(name)
+            if not len(patterns.group_lengths):
+                continue
+            # Only matches that span the separator are new; none is longer than the longest pattern
+            reach = int(patterns.group_lengths[-1]) - 1
+            text, separator = text[max(0, separator - reach):separator + 1 + reach], min(separator, reach)
+            for pattern_id, positions in patterns.find(text).items():
+                length = len(patterns.pattern(pattern_id))
+                spans = [p for p in positions if p <= separator < p + length]
+                if spans and mode == 'count':
+                    sums[f'phrase:{name}'] += len(spans) * int(patterns.multiplicity[pattern_id])
+                elif spans:
+                    self.phrases[name].add(pattern_id)
+        self.head = (self.head + other.head)[:BOUNDARY_TOKENS]
+        self.tail = (self.tail + other.tail)[-BOUNDARY_TOKENS:]
+        return self
+
+    def to_dict(self):
+        encode = VocabularySketch.to_dict if self.approximate else dict
+        return {
+            'approximate': self.approximate,
+            'sums': dict(self.sums),
+            'words': encode(self.words),
+            'lemmas': encode(self.lemmas),
+            'head': self.head,
+            'tail': self.tail,
+            'noun_runs': [self.noun_lead, self.noun_trail] + self.noun_inner,
+            'nouns': [sorted(self.first_nouns), sorted(self.last_nouns)] if self.first_nouns is not None else None,
+            'aspect': [self.first_aspect, self.last_aspect],
+            'texts': self.texts,
+            'phrases': {name: sorted(ids) for name, ids in self.phrases.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        state = cls(data.get('approximate', False))
+        decode = VocabularySketch.from_dict if state.approximate else Counter
+        state.sums = Counter(data['sums'])
+        state.words = decode(data['words'])
+        state.lemmas = decode(data['lemmas'])
+        state.head = [tuple(token) for token in data['head']]
+        state.tail = [tuple(token) for token in data['tail']]
+        state.noun_lead, state.noun_trail, *state.noun_inner = data['noun_runs']
+        if data['nouns'] is not None:
+            state.first_nouns, state.last_nouns = (set(nouns) for nouns in data['nouns'])
+        state.first_aspect, state.last_aspect = data['aspect']
+        state.texts = {field: list(value) for field, value in data['texts'].items()}
+        state.phrases = {name: set(ids) for name, ids in data['phrases'].items()}
+        return state
+
+
+def _counter_statistics(counts):
+    # Same shape as VocabularySketch.estimate()
+    return {
+        'distinct': len(counts),
+        'spectrum': Counter(counts.values()),
+        'length': sum(len(token) for token in counts),
+        'moment': None,
+    }
+
+
+def vocabulary_statistics(words, lemmas):
+    """Vocabulary statistics in the form ``finalize`` expects.
+
+    ``words`` and ``lemmas`` are ``VocabularySketch.estimate()`` results.
+    """
+    vocab = {
+        'V_word': words['distinct'],
+        'V_lemma': lemmas['distinct'],
+        'N_lemma': lemmas['length'],
+        'hapax1': lemmas['spectrum'].get(1, 0),
+        'hapax2': lemmas['spectrum'].get(2, 0),
+    }
+    for kind, stats in (('word', words), ('lemma', lemmas)):
+        # The legacy Yule sums run over frequencies ``range(V)`` only; so does an estimated moment.
+        if stats['moment'] is None:
+            vocab[f'{kind}_spectrum'] = sorted((c, n) for c, n in stats['spectrum'].items() if c < stats['distinct'])
+        else:
+            vocab[f'{kind}_moment'] = stats['moment']
+    return vocab
+
+
+def vocabulary(state):
+    if state.approximate:
+        return vocabulary_statistics(state.words.estimate(), state.lemmas.estimate())
+    return vocabulary_statistics(_counter_statistics(state.words), _counter_statistics(state.lemmas))
+
+
+def _ratio(numerator, denominator):
+    try:
+        return numerator / denominator
+    except ZeroDivisionError:
+        return math.nan
+
+
+def _square_sum(vocab, kind, n):
+    # sum of (frequency / n) ** 2 over the vocabulary
+    if f'{kind}_moment' in vocab:
+        return vocab[f'{kind}_moment'] / n**2
+    return sum([count*((c/n)**2) for c, count in vocab[f'{kind}_spectrum']])
+
+
+def vocabulary_metrics(vocab, n_word):
+    m = {}
+    m['V_word'] = vocab['V_word']
+    m['N_lemma'] = vocab['N_lemma']
+    m['V_lemma'] = vocab['V_lemma']
+    m['TTR_word'] = _ratio(vocab['V_word'], n_word)
+    m['TTR_lemma'] = _ratio(vocab['V_lemma'], vocab['N_lemma'])
+    for name, kind, n in (('YulesK_word', 'word', n_word), ('YulesK_lemma', 'lemma', vocab['N_lemma'])):
+        try:
+            m[name] = (10**4)*((-1/n) + _square_sum(vocab, kind, n))
+        except ZeroDivisionError:
+            m[name] = math.nan
+    for name, key, kind in (('YulesI_word', 'V_word', 'word'), ('YulesI_lemma', 'V_lemma', 'lemma')):
+        v = vocab[key]
+        if f'{kind}_moment' in vocab:
+            moment = vocab[f'{kind}_moment']
+        else:
+            moment = sum([count*(c**2) for c, count in vocab[f'{kind}_spectrum']])
+        m[name] = (v**2)/(moment-v) if moment - v != 0 else 0
+    m['hapax1_pr'] = _ratio(vocab['hapax1'], n_word)
+    m['hapax2_pr'] = _ratio(vocab['hapax2'], n_word)
+    return m
+
+
+def finalize(state, lexicons, vocab=None):
+    """Metric values of a state, keyed by the ``features.txt`` names."""
+    s = state.sums
+    vocab = vocab or vocabulary(state)
+    n_word = s['tokens']
+    n_sent = s['sents']
+    word_sents = s['word_sents']
+    m = vocabulary_metrics(vocab, n_word)
+
+    def safe(name, compute):
+        try:
+            m[name] = compute()
+        except (ZeroDivisionError, ValueError):
+            m[name] = math.nan
+
+    m['N_word'] = n_word
+    m['C'] = s['chars']
+    m['punct'] = s['punct']
+    m['let'] = s['letters']
+    m['N'] = s['digits']
+    m['syl'] = s['syllables']
+    m['sent'] = n_sent
+    m['word_long'] = s['word_long']
+    m['word_long_pr'] = s['word_long'] / n_word if n_word > 0 else 0
+    m['lemma_long'] = s['lemma_long']
+    m['lemma_long_pr'] = s['lemma_long'] / n_word if n_word > 0 else 0
+    # parse_csv tokens are five-field records, hence the legacy denominator
+    m['comma_pr'] = _ratio(s['comma'], 5 * n_word)
+    asl = n_word / word_sents if word_sents > 0 else 0
+    m['ASL'] = asl
+    m['ASS'] = _ratio(s['word_syllables'], word_sents)
+    m['ASW'] = _ratio(s['word_syllables'], n_word)
+    m['ACW'] = _ratio(s['word_chars'], n_word)
+    m['L'] = m['ACW'] * 100
+    m['S'] = _ratio(100, asl)
+    m['FRE_GL'] = 0.5*asl + 8.4*m['ASW'] - 15.59
+    safe('SMOG', lambda: 1.1 * math.sqrt(64.6 / n_sent * s['word_long']) + 0.05)
+    safe('ARI', lambda: 6.26 * (s['chars'] / n_word) + 0.2805 * (n_word / n_sent) - 31.04)
+    safe('DCI', lambda: 0.552 * (100.0 * s['word_long'] / n_word) + 0.273 * (n_word / n_sent))
+    m['CLI'] = 0.055*m['L'] - 0.35*m['S'] - 20.33
+
+    for name, tags in POS_GROUPS.items():
+        m[name] = _ratio(sum(s[f'pos:{tag}'] for tag in tags), n_word)
+    nouns = s['pos:NOUN'] + s['pos:PROPN']
+    verbs = s['pos:VERB'] + s['pos:AUX']
+    m['NVR'] = nouns / verbs if verbs != 0 else 0
+    for name, tag in MORPH_TAGS.items():
+        m[name] = _ratio(s[f'tag:{tag}'], n_word)
+
+    if n_word and state.noun_lead == n_word:
+        noun_pairs, noun_triples = n_word // 2, n_word // 3
+    else:
+        noun_pairs = state.noun_inner[0] + state.noun_lead // 2 + state.noun_trail // 2
+        noun_triples = state.noun_inner[1] + state.noun_lead // 3 + state.noun_trail // 3
+    b = {bigram: s[f'bigram:{bigram}'] for bigram in BIGRAMS}
+    m['Pos_ngrams_1_pr'] = _ratio(b['VERB+NOUN'], n_word)
+    m['Pos_ngrams_2_pr'] = _ratio(b['NOUN+VERB'], n_word)
+    m['Pos_ngrams_3_pr'] = _ratio(b['ADVB+VERB'], n_word)
+    m['Pos_ngrams_4_pr'] = _ratio(b['ADJF+NOUN'], n_word)
+    m['Pos_ngrams_5_pr'] = _ratio(noun_pairs, n_word)
+    m['Pos_ngrams_6_pr'] = _ratio(noun_triples, n_word)
+    m['Pos_ngrams_7_pr'] = _ratio(s['noun_gent'], n_word)
+    m['Pos_ngrams_8_pr'] = _ratio(b['GRND+NOUN'], n_word)
+    m['Pos_ngrams_9_pr'] = _ratio(b['ADVB+GRND'], n_word)
+    m['Pos_ngrams_10_pr'] = _ratio(b['PRTF+NOUN'], n_word)
+    m['Pos_ngrams_11_pr'] = _ratio(s['noun_prtf'], n_word)
+    m['Pos_ngrams_12_pr'] = _ratio(b['PRTF+ADVB'] + b['PRTS+ADVB'], n_word)
+    dynamic = b['VERB+NOUN'] + b['NOUN+VERB'] + b['ADVB+VERB'] + b['GRND+NOUN'] + b['ADVB+GRND']
+    static = noun_pairs + b['ADJF+VERB']
+    m['Dyn_Stat'] = dynamic / static if static != 0 else 0
+
+    for band in range(ZIPF_BANDS):
+        m[f'Zipf_{band}_pr'] = _ratio(s[f'zipf:{band}'], n_word)
+    m['Word_form'] = _ratio(s['word_form'], n_word)
+    m['Adjif_pr'] = _ratio(s['adjf'], n_word)
+    m['Pssv_prtf_pr'] = _ratio(s['pssv_prtf'], n_word)
+    m['Pssv_prts_pr'] = _ratio(s['pssv_prts'], n_word)
+    m['Sja_verb_pr'] = _ratio(s['sja_verb'], n_word)
+    m['Yavl_pr'] = _ratio(s['yavl'], n_word)
+    m['Textdeixis_pr'] = _ratio(s['textdeixis'], n_word)
+    for metric, (name, _) in WORD_LISTS.items():
+        m[metric] = _ratio(s[f'list:{name}'], n_word)
+    m['FZ_pr'] = _ratio(s['fz'], n_word)
+    for metric, (name, _, mode) in PHRASE_LISTS.items():
+        patterns = lexicons.phrase_list(name)
+        if mode == 'count':
+            hits = s[f'phrase:{name}']
+        else:
+            hits = patterns.empty_multiplicity + sum(int(patterns.multiplicity[i]) for i in state.phrases[name])
+        m[metric] = _ratio(hits, n_word)
+
+    for name, relation in DEP_RELATIONS.items():
+        m[name] = _ratio(s[f'dep:{relation}'], n_sent)
+
+    m['Cohes_1'] = s['cohes1']
+    m['Cohes_2'] = 2 * s['aspect'] - state.first_aspect - state.last_aspect
+    return m
+
+
+def aggregate(states, lexicons):
+    merged = DocumentState()
+    for state in states:
+        merged.update(state, lexicons)
+    return merged
+
+
+def read_states(path):
+    with open(path, encoding='utf-8') as fp:
+        for line in fp:
+            record = json.loads(line)
+            yield record['fname'], DocumentState.from_dict(record['state'])
+
+
+def main():
+    from feature_extractor import lexicons, read_feature_list
+
+    parser = argparse.ArgumentParser(description="Aggregate per-document metric states into group metrics")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    aggregate_parser = subparsers.add_parser('aggregate', help="merge states per group and compute metrics")
+    aggregate_parser.add_argument("--states-path", required=True, help="JSON lines written by feature_extractor.py --states-path")
+    aggregate_parser.add_argument("--output-path", default="group_metrics.csv", help="output file name")
+    aggregate_parser.add_argument("--groups", default=None, help="CSV file mapping fname to a group column")
+    aggregate_parser.add_argument("--group-column", default="group", help="group column of --groups")
+
+    args = parser.parse_args()
+
+    group_of = None
+    if args.groups:
+        with open(args.groups, newline='', encoding='utf-8') as f:
+            group_of = {row['fname']: row[args.group_column] for row in csv.DictReader(f)}
+
+    groups = {}
+    for fname, state in read_states(args.states_path):
+        group = group_of.get(fname) if group_of is not None else 'all'
+        if group is None:
+            continue
+        groups.setdefault(group, DocumentState()).update(state, lexicons)
+
+    function_list, _ = read_feature_list()
+    with open(args.output_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(['group'] + function_list)
+        for group, state in groups.items():
+            metrics = finalize(state, lexicons)
+            writer.writerow([group] + [metrics[name] for name in function_list])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+"""
+Metric series over sliding windows of a document.
+
+A window covers ``size`` sentences or tokens, and consecutive windows start
+``stride`` sentences or tokens apart. Every window gets the metrics that
+``feature_extractor.py`` would report for a file holding just that part of
+the document:
+
+* sentence windows hold whole sentences (rows of the annotated file),
+* token windows hold the tokens in the range, with the sentences cut at the
+  window edges. A sentence text (``sent``, ``C``, ``syl``, ...) belongs to
+  the window that holds its first token.
+
+The last window ends at the end of the document. Windows never reach past
+it, so a remainder shorter than ``stride`` starts no window of its own. A
+document shorter than one window is a single window.
+
+The window state is updated as the window moves, instead of being rebuilt
+for every window. Counts of the entering sentences and tokens are added,
+and those of the leaving ones are subtracted, the word and lemma counters
+and their frequency spectra included. The few values that depend on
+context (adjacent-token pairs at the end of the window, noun runs and
+cohesion across the window edges, the aspect of the first and last
+sentence, phrase matches) come from indexes built once per document. The
+cost is linear in the document length and does not grow with the number of
+windows. The values are then computed by ``metric_state.finalize``.
+
+The one difference from a separate file per window: ``parse_csv`` folds a
+repeated sentence into the preceding one even if its first occurrence is
+outside the window.
+
+    python metric_windows.py --input-path=data --output-path=windows.csv --unit=sentences --size=5 --stride=1
+"""
+
+import argparse
+import bisect
+import csv
+import glob
+import os
+from collections import Counter
+from itertools import accumulate
+
+from feature_extractor import FeatureExtractor, lexicons, prepare_lexicons, read_feature_list
+from metric_state import (
+    PHRASE_LISTS, WORD_LISTS, ZIPF_BANDS, DocumentState, _aspect_tense, _position_counts,
+    count_sentence, count_token, finalize, vocabulary_statistics,
+)
+
+
+UNITS = ('sentences', 'tokens')
+
+
+def window_bounds(length, size, stride):
+    """``(start, end)`` of the windows over ``length`` units."""
+    if size < 1 or stride < 1:
+        raise ValueError('window size and stride must be positive')
+    if length <= size:
+        return [(0, length)]
+    return [(start, start + size) for start in range(0, length - size + 1, stride)]
+
+
+class _Vocabulary:
+    """A frequency counter with its spectrum and the length of its distinct keys."""
+
+    def __init__(self):
+        self.counts = Counter()
+        self.spectrum = Counter()
+        self.length = 0
+
+    def add(self, key, sign):
+        old = self.counts[key]
+        new = old + sign
+        if old:
+            self.spectrum[old] -= 1
+            if not self.spectrum[old]:
+                del self.spectrum[old]
+        if new:
+            self.counts[key] = new
+            self.spectrum[new] += 1
+        else:
+            del self.counts[key]
+        if not old or not new:
+            self.length += sign * len(key)
+
+    def statistics(self):
+        # Same shape as VocabularySketch.estimate()
+        return {'distinct': len(self.counts), 'spectrum': self.spectrum, 'length': self.length, 'moment': None}
+
+
+class DocumentWindows:
+    """Indexes of one document for ``WindowState``.
+
+    ``units`` are ``(sentence, tokens)`` pairs as ``FeatureExtractor.parse_units`` returns them.
+    """
+
+    def __init__(self, units, lexicons):
+        self.lexicons = lexicons
+        self.sentences = [sentence for sentence, _ in units]
+        self.tokens = [token for _, tokens in units for token in tokens]
+        self.tags = [token['morph'].split(',') for token in self.tokens]
+        n = len(self.tokens)
+
+        # First token of every unit, and the sentence (among those with
+        # tokens) of every token
+        self.unit_start = list(accumulate((len(tokens) for _, tokens in units), initial=0))
+        self.sentence_of = []
+        self.sentence_start = []
+        for _, tokens in units:
+            if tokens:
+                self.sentence_start.append(len(self.sentence_of))
+                self.sentence_of.extend([len(self.sentence_start) - 1] * len(tokens))
+        self.sentence_start.append(n)
+
+        pairs = [(tags[0], tags) for tags in self.tags]
+        self.lookahead = [_position_counts(pairs, i) for i in range(n)]
+        self.pairs = pairs
+        self.aspect = list(accumulate((_aspect_tense(tags) for tags in self.tags), initial=0))
+        lemmas = [token['lemma'] for token in self.tokens]
+        self.zipf = lexicons.frozen('zipf_dict').lookup(lemmas).tolist() if n else []
+        self.lists = {}
+        for name, field in WORD_LISTS.values():
+            self.lists[name] = lexicons.word_list(name).contains([token[field].lower() for token in self.tokens]).tolist() if n else []
+
+        # Maximal noun runs as (start, end) token ranges
+        self.runs = []
+        for i, (first, _) in enumerate(pairs):
+            if first == 'NOUN':
+                if self.runs and self.runs[-1][1] == i:
+                    self.runs[-1][1] = i + 1
+                else:
+                    self.runs.append([i, i + 1])
+        self.run_starts = [start for start, _ in self.runs]
+        self.run_ends = [end for _, end in self.runs]
+        self.run_pairs = list(accumulate(((end - start) // 2 for start, end in self.runs), initial=0))
+        self.run_triples = list(accumulate(((end - start) // 3 for start, end in self.runs), initial=0))
+
+        # Shared NOUN lemmas of whole adjacent sentences (Cohes_1)
+        nouns = [self.nouns(start, end) for start, end in zip(self.sentence_start, self.sentence_start[1:])]
+        self.cohesion = list(accumulate((len(nouns[k] & nouns[k + 1]) for k in range(len(nouns) - 1)), initial=0))
+
+        # Phrase matches as character spans of the joined lowered texts;
+        # token i spans [offset[i], offset[i] + len) of them
+        self.offsets = {}
+        self.matches = {}
+        self.overlapping = {}
+        for name, field, mode in PHRASE_LISTS.values():
+            if field not in self.offsets:
+                lowered = [token[field].lower() for token in self.tokens]
+                self.offsets[field] = (list(accumulate((len(text) + 1 for text in lowered), initial=0)), ' '.join(lowered))
+            patterns = lexicons.phrase_list(name)
+            matches = []
+            overlapping = set()
+            for pattern_id, positions in patterns.find(self.offsets[field][1]).items():
+                length = len(patterns.pattern(pattern_id))
+                matches.extend((position, position + length, pattern_id) for position in positions)
+                if any(b < a + length for a, b in zip(positions, positions[1:])):
+                    overlapping.add(pattern_id)
+            self.matches[name] = matches
+            self.overlapping[name] = overlapping
+
+    def nouns(self, start, end):
+        return {self.tokens[i]['lemma'] for i in range(start, end) if self.tokens[i]['pos'] == 'NOUN'}
+
+    def span(self, field, start, end):
+        """Character range of tokens ``start`` to ``end`` in the joined text of ``field``."""
+        offsets = self.offsets[field][0]
+        return offsets[start], offsets[end] - 1 if end > start else offsets[start]
+
+
+class WindowState:
+    """Counts of the tokens ``[start, end)`` and the sentence texts ``[first, last)`` of a document."""
+
+    def __init__(self, document):
+        self.document = document
+        self.textdeixis = document.lexicons.prefixes('Textdeixis')
+        self.sums = Counter()
+        self.words = _Vocabulary()
+        self.lemmas = _Vocabulary()
+        self.start = self.end = 0
+        # tokens whose lookahead counts are in sums: those at least two
+        # tokens before the end of the window
+        self.lookahead = [0, 0]
+        self.first = self.last = 0
+        self.phrases = {}
+        for name, field, mode in PHRASE_LISTS.values():
+            # matches ordered by end (to enter) and by start (to leave)
+            matches = document.matches[name]
+            self.phrases[name] = {
+                'entering': sorted(range(len(matches)), key=lambda m: matches[m][1]),
+                'leaving': sorted(range(len(matches)), key=lambda m: matches[m][0]),
+                'next_in': 0, 'next_out': 0, 'inside': set(), 'ids': Counter(),
+            }
+
+    def _token(self, i, sign):
+        d = self.document
+        token = d.tokens[i]
+        count_token(self.sums, token['word'], token['lemma'], token['pos'], token['morph'], token['dep'],
+                    d.tags[i], self.textdeixis, sign)
+        self.sums['aspect'] += sign * (d.aspect[i + 1] - d.aspect[i])
+        if 0 <= d.zipf[i] < ZIPF_BANDS:
+            self.sums[f'zipf:{d.zipf[i]}'] += sign
+        for name in d.lists:
+            self.sums[f'list:{name}'] += sign * d.lists[name][i]
+        self.words.add(token['word'], sign)
+        self.lemmas.add(token['lemma'], sign)
+
+    def _lookahead(self, start, end):
+        # Move the range of tokens with lookahead counts to [start, end)
+        old_start, old_end = self.lookahead
+        for i in range(old_start, min(old_end, start)):
+            self.sums.subtract(self.document.lookahead[i])
+        for i in range(max(old_end, start), end):
+            self.sums.update(self.document.lookahead[i])
+        self.lookahead = [start, max(start, end)]
+
+    def _phrases(self, start, end):
+        d = self.document
+        for name, field, mode in PHRASE_LISTS.values():
+            low, high = d.span(field, start, end)
+            matches = d.matches[name]
+            phrase = self.phrases[name]
+            entering, leaving = phrase['entering'], phrase['leaving']
+            while phrase['next_out'] < len(leaving) and matches[leaving[phrase['next_out']]][0] < low:
+                m = leaving[phrase['next_out']]
+                if m in phrase['inside']:
+                    phrase['inside'].discard(m)
+                    phrase['ids'][matches[m][2]] -= 1
+                phrase['next_out'] += 1
+            while phrase['next_in'] < len(entering) and matches[entering[phrase['next_in']]][1] <= high:
+                m = entering[phrase['next_in']]
+                if matches[m][0] >= low:
+                    phrase['inside'].add(m)
+                    phrase['ids'][matches[m][2]] += 1
+                phrase['next_in'] += 1
+
+    def move(self, start, end, first, last):
+        """Move the window forward to tokens ``[start, end)`` and sentence texts ``[first, last)``."""
+        d = self.document
+        for i in range(self.start, min(self.end, start)):
+            self._token(i, -1)
+        for i in range(max(self.end, start), end):
+            self._token(i, 1)
+        for u in range(self.first, min(self.last, first)):
+            count_sentence(self.sums, d.sentences[u], -1)
+        for u in range(max(self.last, first), last):
+            count_sentence(self.sums, d.sentences[u], 1)
+        self.start, self.end, self.first, self.last = start, end, first, last
+        self._lookahead(start, end - 2)
+        self._phrases(start, end)
+
+    def state(self):
+        """A ``DocumentState`` of the window, for ``finalize``."""
+        d = self.document
+        start, end = self.start, self.end
+        state = DocumentState()
+        # + drops the keys that went back to zero
+        sums = state.sums = self.sums + Counter()
+        for i in range(max(start, end - 2), end):
+            sums.update(_position_counts(d.pairs[max(start, end - 2):end], i - max(start, end - 2)))
+
+        if start < end:
+            first_sentence, last_sentence = d.sentence_of[start], d.sentence_of[end - 1]
+            sums['word_sents'] = last_sentence - first_sentence + 1
+            first_end = min(end, d.sentence_start[first_sentence + 1])
+            last_start = max(start, d.sentence_start[last_sentence])
+            state.first_aspect = d.aspect[first_end] - d.aspect[start]
+            state.last_aspect = d.aspect[end] - d.aspect[last_start]
+            sums['cohes1'] = self._cohesion(first_sentence, last_sentence)
+            state.noun_lead, state.noun_trail, state.noun_inner = self._noun_runs()
+
+        for name, field, mode in PHRASE_LISTS.values():
+            phrase = self.phrases[name]
+            if mode == 'present':
+                state.phrases[name] = {pattern_id for pattern_id, count in phrase['ids'].items() if count > 0}
+                continue
+            patterns = d.lexicons.phrase_list(name)
+            low, high = d.span(field, start, end)
+            hits = patterns.empty_multiplicity * (high - low + 1)
+            overlapping = {}
+            for pattern_id, count in phrase['ids'].items():
+                if pattern_id in d.overlapping[name]:
+                    overlapping[pattern_id] = []
+                else:
+                    hits += count * int(patterns.multiplicity[pattern_id])
+            if overlapping:
+                # Non-overlapping occurrences, counted from the window start
+                for m in sorted(phrase['inside']):
+                    position, stop, pattern_id = d.matches[name][m]
+                    if pattern_id in overlapping:
+                        overlapping[pattern_id].append((position, stop))
+                for pattern_id, spans in overlapping.items():
+                    count, free = 0, 0
+                    for position, stop in sorted(spans):
+                        if position >= free:
+                            count += 1
+                            free = stop
+                    hits += count * int(patterns.multiplicity[pattern_id])
+            sums[f'phrase:{name}'] = hits
+        return state
+
+    def _cohesion(self, first, last):
+        # Sentences first and last may be cut by the window edges
+        d = self.document
+        if first == last:
+            return 0
+        cut_first = d.sentence_start[first] < self.start
+        cut_last = d.sentence_start[last + 1] > self.end
+
+        def nouns(k):
+            return d.nouns(max(self.start, d.sentence_start[k]), min(self.end, d.sentence_start[k + 1]))
+
+        total = d.cohesion[last - 1] - d.cohesion[first + 1] if last - 1 > first + 1 else 0
+        for k in sorted({first, last - 1}):
+            if (k == first and cut_first) or (k + 1 == last and cut_last):
+                total += len(nouns(k) & nouns(k + 1))
+            else:
+                total += d.cohesion[k + 1] - d.cohesion[k]
+        return total
+
+    def _noun_runs(self):
+        d = self.document
+        start, end = self.start, self.end
+        lead = trail = 0
+        r = bisect.bisect_right(d.run_starts, start) - 1
+        if r >= 0 and d.run_ends[r] > start:
+            lead = min(end, d.run_ends[r]) - start
+        r = bisect.bisect_right(d.run_starts, end - 1) - 1
+        if r >= 0 and d.run_ends[r] > end - 1:
+            trail = end - max(start, d.run_starts[r])
+        # Runs strictly inside the window
+        first = bisect.bisect_right(d.run_starts, start)
+        last = bisect.bisect_left(d.run_ends, end)
+        inner = [0, 0]
+        if last > first:
+            inner = [d.run_pairs[last] - d.run_pairs[first], d.run_triples[last] - d.run_triples[first]]
+        return lead, trail, inner
+
+    def vocabulary(self):
+        return vocabulary_statistics(self.words.statistics(), self.lemmas.statistics())
+
+
+def document_windows(units, lexicons, unit='sentences', size=10, stride=1):
+    """``(start, end, metrics)`` per window; start and end count sentences or tokens."""
+    document = DocumentWindows(units, lexicons)
+    if unit == 'sentences':
+        bounds = window_bounds(len(units), size, stride)
+        ranges = [(document.unit_start[first], document.unit_start[last], first, last) for first, last in bounds]
+    elif unit == 'tokens':
+        bounds = window_bounds(len(document.tokens), size, stride)
+        # A sentence text goes with the window of its first token
+        ranges = [(start, end, bisect.bisect_left(document.unit_start, start, hi=len(units)),
+                   bisect.bisect_left(document.unit_start, end, hi=len(units)) if end < len(document.tokens) else len(units))
+                  for start, end in bounds]
+    else:
+        raise ValueError(f'unknown window unit {unit!r} (known: {", ".join(UNITS)})')
+
+    window = WindowState(document)
+    for (start, end, first, last), bound in zip(ranges, bounds):
+        window.move(start, end, first, last)
+        yield bound[0], bound[1], finalize(window.state(), lexicons, window.vocabulary())
+
+
+def read_units(file_path):
+    with open(file_path, newline='', encoding='utf-8') as csvfile:
+        return FeatureExtractor.parse_units(csv.DictReader(csvfile))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute metric series over sliding windows of every document")
+    parser.add_argument("--input-path", default="./data", help="folder of annotated documents")
+    parser.add_argument("--output-path", default="windows.csv", help="one row per document window")
+    parser.add_argument("--unit", default="sentences", choices=UNITS, help="what a window counts")
+    parser.add_argument("--size", default=10, type=int, help="sentences or tokens per window")
+    parser.add_argument("--stride", default=1, type=int, help="sentences or tokens between window starts")
+    parser.add_argument("--features", default="features.txt", help="metrics to compute")
+
+    args = parser.parse_args()
+    if args.size < 1 or args.stride < 1:
+        parser.error("--size and --stride must be positive")
+    if not os.path.isdir(args.input_path):
+        parser.error(f"--input-path: no such folder: {args.input_path}")
+
+    prepare_lexicons()
+    function_list, _ = read_feature_list(args.features)
+    file_list = sorted(glob.glob(args.input_path + "/*.csv"))
+    windows = 0
+    with open(args.output_path, "w", newline="", encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['fname', 'window', 'start', 'end'] + function_list)
+        for file_path in file_list:
+            fname = os.path.basename(file_path)
+            for number, (start, end, metrics) in enumerate(document_windows(read_units(file_path), lexicons, args.unit, args.size, args.stride)):
+                writer.writerow([fname, number, start, end] + [metrics[name] for name in function_list])
+                windows += 1
+    print(f'{args.output_path}: {windows} windows of {len(file_list)} documents')
+
+
+if __name__ == "__main__":
+    main()
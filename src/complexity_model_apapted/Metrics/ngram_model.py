@@ -0,0 +1,446 @@
+"""
+Kneser-Ney smoothed n-gram language model over lemmas or POS tags.
+
+The ``LM_*`` metrics of ``feature_extractor`` measure how predictable a
+document is under a model built from a reference corpus of human reviews:
+
+    python ngram_model.py build --input-path=human_docs --unit=lemma --order=4 --output=./Dictionaries/lm_lemma.ngram
+    python ngram_model.py build --store=human.tokens --unit=pos --output=./Dictionaries/lm_pos.ngram
+    python ngram_model.py info --model=./Dictionaries/lm_lemma.ngram
+
+The model is interpolated Kneser-Ney (Chen and Goodman) with one discount per
+order, ``D = n1 / (n1 + 2 n2)``. Lower orders use continuation counts, except
+for n-grams that start at ``<s>``, which keep their raw counts as in KenLM.
+Every sentence is padded with ``<s>`` and ``</s>``. Unknown units get the
+uniform share of the unigram distribution.
+
+An n-gram is identified by a 64-bit hash. The hash of an n-gram is computed
+from the hash of its first ``n - 1`` units, so the context and the suffix of
+every n-gram are themselves keys of the next lower order. Each order is stored
+as a sorted ``uint64`` key array with parallel count arrays, in one
+``arrayfile`` container that all workers map read-only. A document is scored
+with one ``searchsorted`` per order. With 10^9 n-grams of one order, there
+is about a 3% chance that any two of them share a key; such a collision only
+merges two counts.
+
+The build reads the corpus once. n-grams are collected into runs of
+``RUN_RECORDS``. Each run is sorted, reduced and written to a temporary folder,
+then the runs are merged block by block, ``MERGE_FAN_IN`` runs at a time; more
+runs are merged in several passes. A merge step reads ``MERGE_BYTES`` of
+records in total, so the block of each run shrinks with the number of runs
+merged. Memory therefore stays at a few hundred MB whatever the size of the
+corpus. The model takes about 18 bytes
+per distinct n-gram, and the build needs up to about 100 bytes per n-gram of
+temporary disk space (``--tmp-dir``).
+"""
+
+import argparse
+import glob
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+from arrayfile import map_arrays, write_arrays
+
+
+MAGIC = b'NGLM0001'
+ORDER = 4
+UNITS = ('lemma', 'pos')
+RUN_RECORDS = 1 << 20
+MERGE_FAN_IN = 32
+MERGE_BYTES = 1 << 25
+CHUNK = 1 << 20
+COUNT_MAX = np.iinfo(np.uint32).max
+
+NGRAM = np.dtype([('key', '<u8'), ('prefix', '<u8'), ('suffix', '<u8'), ('count', '<u8'), ('bos', 'u1')])
+# Counts per key: continuation counts, or context totals and types
+STAT = np.dtype([('key', '<u8'), ('total', '<u8'), ('types', '<u8')])
+
+MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+MIX_2 = np.uint64(0x94D049BB133111EB)
+
+
+def unit_hash(unit):
+    return int.from_bytes(hashlib.blake2b(unit.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+# Sentence boundaries; no unit of a parsed document is an empty string after a NUL
+BOS = np.uint64(unit_hash('\x00<s>'))
+EOS = np.uint64(unit_hash('\x00</s>'))
+
+
+def _mix(x):
+    # splitmix64 finalizer
+    x = x ^ (x >> np.uint64(30))
+    x = x * MIX_1
+    x = x ^ (x >> np.uint64(27))
+    x = x * MIX_2
+    return x ^ (x >> np.uint64(31))
+
+
+def sequence(sentences):
+    """Unit hashes of padded sentences (lists of strings) and the sentence of every position."""
+    cache = {}
+    hashes = []
+    lengths = []
+    for sentence in sentences:
+        hashes.append(int(BOS))
+        for unit in sentence:
+            value = cache.get(unit)
+            if value is None:
+                value = cache[unit] = unit_hash(unit)
+            hashes.append(value)
+        hashes.append(int(EOS))
+        lengths.append(len(sentence) + 2)
+    return np.array(hashes, dtype=np.uint64), np.repeat(np.arange(len(lengths)), lengths)
+
+
+def ngram_keys(hashes, order):
+    """``keys[n - 1][i]`` is the key of the n-gram ``hashes[i:i + n]``."""
+    keys = [hashes]
+    with np.errstate(over='ignore'):
+        for n in range(2, order + 1):
+            keys.append(_mix(keys[-1][:-1] * MULTIPLIER ^ hashes[n - 1:]))
+    return keys
+
+
+def document_units(words, unit):
+    return [[item[unit] for item in sentence] for sentence in words]
+
+
+def _reduce(records, summed):
+    # Sort by key and merge equal keys, summing the given fields
+    if not len(records):
+        return records
+    records = records[np.argsort(records['key'], kind='stable')]
+    starts = np.flatnonzero(np.r_[True, records['key'][1:] != records['key'][:-1]])
+    reduced = records[starts]
+    for field in summed:
+        reduced[field] = np.add.reduceat(records[field], starts)
+    return reduced
+
+
+def _map(path, dtype):
+    if not os.path.getsize(path):
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class _Runs:
+    """Records collected into sorted runs on disk and merged into one file of distinct keys."""
+
+    def __init__(self, folder, name, dtype, summed):
+        self.folder = folder
+        self.name = name
+        self.dtype = dtype
+        self.summed = summed
+        self.pending = []
+        self.pending_size = 0
+        self.paths = []
+
+    def add(self, records):
+        self.pending.append(records)
+        self.pending_size += len(records)
+        if self.pending_size >= RUN_RECORDS:
+            self.spill()
+
+    def spill(self):
+        if not self.pending:
+            return
+        path = os.path.join(self.folder, f'{self.name}.run{len(self.paths)}')
+        _reduce(np.concatenate(self.pending), self.summed).tofile(path)
+        self.paths.append(path)
+        self.pending = []
+        self.pending_size = 0
+
+    def merge(self):
+        self.spill()
+        paths = self.paths
+        passes = 0
+        while len(paths) > MERGE_FAN_IN:
+            merged = []
+            for start in range(0, len(paths), MERGE_FAN_IN):
+                merged.append(os.path.join(self.folder, f'{self.name}.pass{passes}.{len(merged)}'))
+                self._merge(paths[start:start + MERGE_FAN_IN], merged[-1])
+            paths = merged
+            passes += 1
+        path = os.path.join(self.folder, f'{self.name}.sorted')
+        self._merge(paths, path)
+        return _map(path, self.dtype)
+
+    def _merge(self, paths, path):
+        """Merge the sorted runs at ``paths`` into ``path`` and remove them."""
+        runs = [_map(run_path, self.dtype) for run_path in paths]
+        positions = [0] * len(runs)
+        block_size = max(1, MERGE_BYTES // (max(1, len(runs)) * self.dtype.itemsize))
+        with open(path, 'wb') as output:
+            while True:
+                blocks = [run[position:position + block_size] for run, position in zip(runs, positions)]
+                live = [block for block in blocks if len(block)]
+                if not live:
+                    break
+                # Every key up to the smallest last key of a block is complete
+                bound = min(block['key'][-1] for block in live)
+                parts = []
+                for i, block in enumerate(blocks):
+                    end = int(np.searchsorted(block['key'], bound, 'right'))
+                    parts.append(block[:end])
+                    positions[i] += end
+                _reduce(np.concatenate(parts), self.summed).tofile(output)
+        del runs, blocks, parts
+        for run_path in paths:
+            os.remove(run_path)
+
+
+def _chunks(array):
+    for start in range(0, len(array), CHUNK):
+        yield start, array[start:start + CHUNK]
+
+
+def _lookup(keys, queries):
+    """Index of every query in the sorted ``keys`` and whether it is there."""
+    if not len(keys):
+        return np.zeros(len(queries), dtype=np.int64), np.zeros(len(queries), dtype=bool)
+    index = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+    return index, keys[index] == queries
+
+
+def _discount(counts):
+    n1 = int((counts == 1).sum())
+    n2 = int((counts == 2).sum())
+    if not n1 or not n2:
+        return 0.5
+    return n1 / (n1 + 2 * n2)
+
+
+def _column(folder, name, dtype, length):
+    path = os.path.join(folder, name)
+    if not length:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='w+', shape=(length,))
+
+
+def build_model(path, documents, order=ORDER, unit='lemma', tmp_dir=None):
+    """Build a model from ``(name, words, sents)`` documents; return the number of n-grams per order."""
+    folder = tempfile.mkdtemp(prefix='ngram-', dir=tmp_dir)
+    try:
+        # One pass over the corpus: distinct n-grams of every order with their raw counts
+        runs = [_Runs(folder, f'order{n}', NGRAM, ('count',)) for n in range(1, order + 1)]
+        sentences = 0
+        for _, words, _ in documents:
+            units = document_units(words, unit)
+            sentences += len(units)
+            if not units:
+                continue
+            hashes, sentence = sequence(units)
+            keys = ngram_keys(hashes, order)
+            for n in range(1, order + 1):
+                # n-grams inside one padded sentence
+                positions = np.flatnonzero(sentence[:len(keys[n - 1])] == sentence[n - 1:])
+                if not len(positions):
+                    continue
+                records = np.zeros(len(positions), dtype=NGRAM)
+                records['key'] = keys[n - 1][positions]
+                if n > 1:
+                    records['prefix'] = keys[n - 2][positions]
+                    records['suffix'] = keys[n - 2][positions + 1]
+                records['count'] = 1
+                records['bos'] = hashes[positions] == BOS
+                runs[n - 1].add(records)
+        tables = [run.merge() for run in runs]
+
+        # Adjusted counts: raw counts for the highest order and for n-grams
+        # starting at <s>, continuation counts otherwise; <s> is never predicted
+        adjusted = []
+        for n in range(1, order + 1):
+            table = tables[n - 1]
+            counts = _column(folder, f'counts{n}', np.uint32, len(table))
+            if n < order:
+                continuation = _Runs(folder, f'continuation{n}', STAT, ('total',))
+                for _, block in _chunks(tables[n]):
+                    records = np.zeros(len(block), dtype=STAT)
+                    records['key'] = block['suffix']
+                    records['total'] = 1
+                    continuation.add(records)
+                continuation = continuation.merge()
+            for start, block in _chunks(table):
+                values = block['count'].copy()
+                if n < order:
+                    index, found = _lookup(continuation['key'], block['key'])
+                    continued = np.where(found, continuation['total'][index], 0)
+                    values = np.where(block['bos'] != 0, values, continued)
+                if n == 1:
+                    values[block['bos'] != 0] = 0
+                counts[start:start + len(block)] = np.minimum(values, COUNT_MAX)
+            adjusted.append(counts)
+
+        # Context statistics: the sum and the number of nonzero adjusted
+        # counts of the n-grams that continue every (n - 1)-gram
+        totals, types = [], []
+        for n in range(1, order):
+            contexts = _Runs(folder, f'contexts{n}', STAT, ('total', 'types'))
+            for start, block in _chunks(tables[n]):
+                counts = np.asarray(adjusted[n][start:start + len(block)], dtype=np.uint64)
+                records = np.zeros(len(block), dtype=STAT)
+                records['key'] = block['prefix']
+                records['total'] = counts
+                records['types'] = counts > 0
+                contexts.add(records)
+            contexts = contexts.merge()
+            table = tables[n - 1]
+            total = _column(folder, f'totals{n}', np.uint64, len(table))
+            kinds = _column(folder, f'types{n}', np.uint32, len(table))
+            for start, block in _chunks(table):
+                index, found = _lookup(contexts['key'], block['key'])
+                total[start:start + len(block)] = np.where(found, contexts['total'][index], 0)
+                kinds[start:start + len(block)] = np.minimum(np.where(found, contexts['types'][index], 0), COUNT_MAX)
+            totals.append(total)
+            types.append(kinds)
+
+        keys = []
+        for n in range(1, order + 1):
+            column = _column(folder, f'keys{n}', np.uint64, len(tables[n - 1]))
+            for start, block in _chunks(tables[n - 1]):
+                column[start:start + len(block)] = block['key']
+            keys.append(column)
+
+        unigrams = np.asarray(adjusted[0], dtype=np.uint64)
+        meta = {
+            'order': order,
+            'unit': unit,
+            'sentences': sentences,
+            'discounts': [_discount(np.asarray(counts)) for counts in adjusted],
+            'unigram_total': int(unigrams.sum()),
+            'unigram_types': int((unigrams > 0).sum()),
+            'ngrams': [len(table) for table in tables],
+        }
+        arrays = {}
+        for n in range(1, order + 1):
+            arrays[f'keys{n}'] = keys[n - 1]
+            arrays[f'counts{n}'] = adjusted[n - 1]
+            if n < order:
+                arrays[f'totals{n}'] = totals[n - 1]
+                arrays[f'types{n}'] = types[n - 1]
+        write_arrays(path, MAGIC, arrays, meta)
+        return meta['ngrams']
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+class NgramModel:
+    """A model written by ``build_model``, mapped read-only."""
+
+    def __init__(self, path):
+        arrays, meta = map_arrays(path, MAGIC)
+        self.path = path
+        self.meta = meta
+        self.order = meta['order']
+        self.unit = meta['unit']
+        self.discounts = meta['discounts']
+        self.keys = [arrays[f'keys{n}'] for n in range(1, self.order + 1)]
+        self.counts = [arrays[f'counts{n}'] for n in range(1, self.order + 1)]
+        self.totals = [arrays[f'totals{n}'] for n in range(1, self.order)]
+        self.types = [arrays[f'types{n}'] for n in range(1, self.order)]
+        # Every unit but <s>, and one for all unknown units
+        self.vocabulary = meta['unigram_types'] + 1
+
+    def surprisals(self, sentences):
+        """Surprisal in bits of every unit and ``</s>``, and whether the unit is unknown."""
+        if not sentences:
+            return np.zeros(0), np.zeros(0, dtype=bool)
+        hashes, sentence = sequence(sentences)
+        keys = ngram_keys(hashes, self.order)
+        targets = np.flatnonzero(hashes != BOS)
+
+        index, known = _lookup(self.keys[0], hashes[targets])
+        counts = np.where(known, self.counts[0][index], 0).astype(np.float64)
+        discount = self.discounts[0]
+        total = max(self.meta['unigram_total'], 1)
+        backoff = discount * self.meta['unigram_types'] / total if self.meta['unigram_total'] else 1.0
+        p = np.maximum(counts - discount, 0) / total + backoff / self.vocabulary
+
+        for n in range(2, self.order + 1):
+            starts = targets - (n - 1)
+            inside = starts >= 0
+            inside[inside] = sentence[starts[inside]] == sentence[targets[inside]]
+            if not inside.any():
+                break
+            starts = starts[inside]
+            index, found = _lookup(self.keys[n - 1], keys[n - 1][starts])
+            counts = np.where(found, self.counts[n - 1][index], 0).astype(np.float64)
+            index, found = _lookup(self.keys[n - 2], keys[n - 2][starts])
+            totals = np.where(found, self.totals[n - 2][index], 0).astype(np.float64)
+            types = np.where(found, self.types[n - 2][index], 0).astype(np.float64)
+            # Contexts never seen in the corpus keep the lower-order probability
+            seen = totals > 0
+            lower = p[inside]
+            discount = self.discounts[n - 1]
+            lower[seen] = (np.maximum(counts[seen] - discount, 0) + discount * types[seen] * lower[seen]) / totals[seen]
+            p[inside] = lower
+
+        return -np.log2(p), ~known[hashes[targets] != EOS]
+
+    def document_statistics(self, words):
+        """Perplexity and surprisal statistics of a document (``parse_csv`` words)."""
+        surprisal, unknown = self.surprisals(document_units(words, self.unit))
+        if not len(surprisal):
+            return {'ppl': 0, 'surprisal_mean': 0, 'surprisal_sd': 0, 'surprisal_p90': 0, 'oov_pr': 0}
+        mean = float(surprisal.mean())
+        return {
+            'ppl': 2 ** mean,
+            'surprisal_mean': mean,
+            'surprisal_sd': float(surprisal.std()),
+            'surprisal_p90': float(np.percentile(surprisal, 90)),
+            'oov_pr': float(unknown.mean()) if len(unknown) else 0,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and inspect n-gram language models for the LM_* metrics")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help="build a model from a folder of annotated reference documents")
+    build_parser.add_argument("--input-path", default="./data", help="folder of annotated documents")
+    build_parser.add_argument("--store", default=None, help="read the documents from a token store instead")
+    build_parser.add_argument("--unit", default="lemma", choices=UNITS, help="model lemmas or POS tags")
+    build_parser.add_argument("--order", default=ORDER, type=int, help="highest n-gram order")
+    build_parser.add_argument("--output", default=None, help="model file (default: ./Dictionaries/lm_<unit>.ngram)")
+    build_parser.add_argument("--tmp-dir", default=None, help="folder for the sorted runs (default: the system temp folder)")
+
+    info_parser = subparsers.add_parser('info', help="print the size and the discounts of a model")
+    info_parser.add_argument("--model", required=True, help="model file")
+
+    args = parser.parse_args()
+    if args.command == 'info':
+        model = NgramModel(args.model)
+        for name, value in model.meta.items():
+            print(f'{name}\t{value}')
+        return
+
+    if args.order < 1:
+        parser.error("--order must be at least 1")
+    if args.store is None and not os.path.isdir(args.input_path):
+        parser.error(f"--input-path: no such folder: {args.input_path}")
+    output = args.output or os.path.join('.', 'Dictionaries', f'lm_{args.unit}.ngram')
+
+    # Imported here: feature_extractor scores documents with this module
+    from feature_extractor import FeatureExtractor, Token
+    from token_store import TokenStore
+
+    if args.store is not None:
+        store = TokenStore(args.store)
+        documents = ((name, *store.document(name, Token)) for name in store.names)
+    else:
+        file_list = sorted(glob.glob(args.input_path + "/*.csv"))
+        documents = ((os.path.basename(path), *FeatureExtractor.parse_csv(path)) for path in file_list)
+    ngrams = build_model(output, documents, args.order, args.unit, args.tmp_dir)
+    print(f'{output}: ' + ', '.join(f'{count} {n}-grams' for n, count in enumerate(ngrams, 1)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
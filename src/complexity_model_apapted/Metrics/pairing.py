@@ -0,0 +1,271 @@
+"""
+Pairs of generated reviews and the actual reviews they were seeded with.
+
+Generated reviews start with the opening of a real review. ``link`` finds
+that source in one pass over each file: every actual review is indexed by a
+hash of its first ``--prefix-words`` words (lowercased, punctuation
+dropped), and every generated review looks up the hash of its own opening.
+A review shorter than that is indexed by all its words, and generated
+reviews also try the shorter openings down to ``MIN_WORDS``, so a seed that
+was a whole short review is found too. When several actual reviews share an
+opening, the one with the longest common beginning wins. A source id column
+of the generated file (``--source-column``), where the generator kept it,
+takes precedence over the opening.
+
+``deltas`` joins the pairs with per-review metrics (``pipeline.py`` output,
+keyed by ``fname``) and writes generated minus actual for every pair. The
+summary gives, per metric, the mean delta with a bootstrap confidence
+interval and a sign-flip permutation test. Both resample source reviews
+rather than pairs, as several generated reviews may share one source.
+
+    python pairing.py link --actual=actual.csv --generated=generated.csv --column-name=review --id-column=id --output=pairs.csv
+    python pairing.py deltas --pairs=pairs.csv --actual-metrics=actual_metrics.csv --generated-metrics=gen_metrics.csv --output=paired_deltas.csv --summary=paired_summary.csv
+"""
+
+import argparse
+import csv
+import hashlib
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+from annotation_layers import feature_names
+from group_compare import BOOTSTRAP, CHUNK_ELEMENTS, CONFIDENCE, CORRECTIONS, PERMUTATIONS, UNITS, bootstrap_means
+
+
+PREFIX_WORDS = 8
+MIN_WORDS = 3
+
+PAIR_COLUMNS = ('generated_id', 'source_id', 'method', 'shared_words', 'candidates')
+SUMMARY_COLUMNS = (
+    'column', 'pairs', 'sources', 'mean_actual', 'mean_generated', 'mean_delta', 'sd_delta', 'ci_low', 'ci_high',
+    'positive_share', 'p_value', 'p_adjusted', 'significant',
+)
+
+_WORDS = re.compile(r'\w+')
+
+
+def opening_words(text):
+    return _WORDS.findall(str(text).lower())
+
+
+def opening_key(words):
+    return hashlib.blake2b(' '.join(words).encode('utf-8'), digest_size=8).digest()
+
+
+def _shared_words(a, b):
+    shared = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        shared += 1
+    return shared
+
+
+class OpeningIndex:
+    """Actual reviews by the hash of their opening words."""
+
+    def __init__(self, prefix_words=PREFIX_WORDS, min_words=MIN_WORDS):
+        self.prefix_words = prefix_words
+        self.min_words = min_words
+        self.ids = set()
+        self.buckets = {}
+
+    def add(self, review_id, text):
+        words = opening_words(text)
+        self.ids.add(review_id)
+        if len(words) >= self.min_words:
+            self.buckets.setdefault(opening_key(words[:self.prefix_words]), []).append((review_id, words))
+
+    def find(self, text):
+        """``(source_id, shared_words, candidates)`` of a generated review, or ``None``."""
+        words = opening_words(text)
+        for size in range(min(self.prefix_words, len(words)), self.min_words - 1, -1):
+            candidates = self.buckets.get(opening_key(words[:size]))
+            if not candidates:
+                continue
+            # Shorter openings only match reviews that have no more words
+            candidates = [(review_id, source) for review_id, source in candidates if size == self.prefix_words or len(source) == size]
+            if candidates:
+                shared = [_shared_words(words, source) for _, source in candidates]
+                best = shared.index(max(shared))
+                return candidates[best][0], shared[best], len(candidates)
+        return None
+
+
+def link(actual, generated, prefix_words=PREFIX_WORDS, min_words=MIN_WORDS):
+    """Pairs (``PAIR_COLUMNS``) of ``generated`` and ``actual`` reviews, both ``(id, text, source_id or None)``.
+
+    Returns the pairs and the ids of the generated reviews without a source.
+    """
+    index = OpeningIndex(prefix_words, min_words)
+    for review_id, text, _ in actual:
+        index.add(review_id, text)
+    pairs, unmatched = [], []
+    for review_id, text, source_id in generated:
+        if source_id and source_id in index.ids:
+            pairs.append((review_id, source_id, 'id', '', 1))
+            continue
+        found = index.find(text)
+        if found is None:
+            unmatched.append(review_id)
+        else:
+            pairs.append((review_id, found[0], 'prefix', found[1], found[2]))
+    return pairs, unmatched
+
+
+def read_reviews(path, column_name, id_column=None, source_column=None):
+    with open(path, newline='', encoding='utf-8') as f:
+        for index, row in enumerate(csv.DictReader(f)):
+            yield (row[id_column] if id_column else str(index)), row[column_name], (row[source_column] or None) if source_column else None
+
+
+def paired_deltas(pairs, actual_metrics, generated_metrics, columns=None):
+    """``(pairs, actual, generated, columns)``: the pairs joined with the metrics of both reviews.
+
+    ``actual`` and ``generated`` hold one row of metric values per pair. Pairs
+    whose reviews have no metrics row are left out.
+    """
+    if columns is None:
+        columns = [name for name in generated_metrics.columns if name != 'fname']
+    columns = [name for name in columns if name in actual_metrics and name in generated_metrics]
+    if not columns:
+        raise ValueError('the metrics tables have no metric column in common')
+
+    def metrics(table, key):
+        values = table[columns].apply(pd.to_numeric, errors='coerce')
+        values.insert(0, key, table['fname'].astype(str))
+        return values.drop_duplicates(key)
+
+    joined = pairs.astype({'generated_id': str, 'source_id': str})
+    joined = joined.merge(metrics(generated_metrics, 'generated_id'), on='generated_id', how='inner')
+    joined = joined.merge(metrics(actual_metrics, 'source_id'), on='source_id', how='inner', suffixes=('', '_actual'))
+    actual = joined[[f'{name}_actual' for name in columns]].to_numpy(dtype=np.float64)
+    generated = joined[columns].to_numpy(dtype=np.float64)
+    return joined[list(PAIR_COLUMNS)].reset_index(drop=True), actual, generated, columns
+
+
+def _source_units(sources, deltas, units, rng):
+    # Delta sums and counts per source, or per random bucket of sources
+    codes, uniques = pd.factorize(sources)
+    count = len(uniques)
+    if count > units:
+        codes = rng.permutation(count)[codes] % units
+        count = units
+    present = ~np.isnan(deltas)
+    sums = np.stack([np.bincount(codes, weights=np.where(present[:, j], deltas[:, j], 0.0), minlength=count)
+                     for j in range(deltas.shape[1])])
+    counts = np.stack([np.bincount(codes, weights=present[:, j], minlength=count) for j in range(deltas.shape[1])])
+    return sums, counts
+
+
+def sign_flip_p(sums, counts, permutations, rng):
+    """Two-sided p-values of zero mean delta, flipping the signs of whole units."""
+    total = counts.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        observed = np.abs(sums.sum(axis=1) / total) * (1 - 1e-12)
+    extreme = np.zeros(sums.shape[0])
+    step = max(1, CHUNK_ELEMENTS // sums.shape[1])
+    for start in range(0, permutations, step):
+        signs = rng.choice((-1.0, 1.0), size=(sums.shape[1], min(step, permutations - start)))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            extreme += np.sum(np.abs((sums @ signs) / total[:, None]) >= observed[:, None], axis=1)
+    return np.where(total > 0, (1 + extreme) / (1 + permutations), np.nan)
+
+
+def summarize(pairs, actual, generated, columns, bootstrap=BOOTSTRAP, permutations=PERMUTATIONS,
+              confidence=CONFIDENCE, correction='bh', alpha=0.05, units=UNITS, seed=0):
+    """One ``SUMMARY_COLUMNS`` row per metric column."""
+    rng = np.random.default_rng(seed)
+    deltas = generated - actual
+    sums, counts = _source_units(pairs['source_id'].to_numpy(), deltas, units, rng)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        present = ~np.isnan(deltas)
+        n = present.sum(axis=0)
+        mean = np.where(present, deltas, 0.0).sum(axis=0) / n
+        sd = np.sqrt(np.where(present, (deltas - mean) ** 2, 0.0).sum(axis=0) / (n - 1))
+        positive = np.sum(deltas > 0, axis=0) / n
+        ci_low = ci_high = np.full(len(columns), np.nan)
+        if bootstrap:
+            tail = (1 - confidence) / 2 * 100
+            ci_low, ci_high = np.nanpercentile(bootstrap_means(sums, counts, bootstrap, rng), [tail, 100 - tail], axis=1)
+        p_values = sign_flip_p(sums, counts, permutations, rng) if permutations else np.full(len(columns), np.nan)
+    adjusted = CORRECTIONS[correction](p_values)
+    sources = (counts > 0).sum(axis=1)
+    rows = []
+    for j, name in enumerate(columns):
+        rows.append([name, int(n[j]), int(sources[j]), np.nanmean(actual[:, j]) if n[j] else np.nan,
+                     np.nanmean(generated[:, j]) if n[j] else np.nan, mean[j], sd[j], ci_low[j], ci_high[j],
+                     positive[j], p_values[j], adjusted[j], bool(adjusted[j] <= alpha)])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pair generated reviews with their source reviews and compare their metrics")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    link_parser = subparsers.add_parser('link', help="find the source review of every generated review")
+    link_parser.add_argument("--actual", required=True, help="CSV file of actual reviews")
+    link_parser.add_argument("--generated", required=True, help="CSV file of generated reviews")
+    link_parser.add_argument("--column-name", required=True, help="review text column of both files")
+    link_parser.add_argument("--id-column", default=None, help="column identifying a review, as passed to pipeline.py (default: row number)")
+    link_parser.add_argument("--source-column", default=None, help="column of the generated file holding the id of its source review")
+    link_parser.add_argument("--prefix-words", default=PREFIX_WORDS, type=int, help="opening words shared by a generated review and its source")
+    link_parser.add_argument("--output", default="pairs.csv", help="pairs file")
+
+    deltas_parser = subparsers.add_parser('deltas', help="per-pair metric differences and their summary")
+    deltas_parser.add_argument("--pairs", default="pairs.csv", help="pairs file of link")
+    deltas_parser.add_argument("--actual-metrics", required=True, help="per-review metrics of the actual reviews")
+    deltas_parser.add_argument("--generated-metrics", required=True, help="per-review metrics of the generated reviews (may be the same file)")
+    deltas_parser.add_argument("--features", default="features.txt", help="metric columns (default: features.txt)")
+    deltas_parser.add_argument("--output", default="paired_deltas.csv", help="generated minus actual, one row per pair")
+    deltas_parser.add_argument("--summary", default="paired_summary.csv", help="per-metric summary")
+    deltas_parser.add_argument("--bootstrap", default=BOOTSTRAP, type=int, help="bootstrap replicates (0 to skip)")
+    deltas_parser.add_argument("--permutations", default=PERMUTATIONS, type=int, help="sign flips per test (0 to skip)")
+    deltas_parser.add_argument("--confidence", default=CONFIDENCE, type=float, help="confidence level of the intervals")
+    deltas_parser.add_argument("--correction", default="bh", choices=sorted(CORRECTIONS), help="multiple-comparison correction")
+    deltas_parser.add_argument("--alpha", default=0.05, type=float, help="significance level of the adjusted p-values")
+    deltas_parser.add_argument("--units", default=UNITS, type=int, help="resample more sources as this many random buckets")
+    deltas_parser.add_argument("--seed", default=0, type=int, help="random seed")
+
+    args = parser.parse_args()
+    csv.field_size_limit(sys.maxsize)
+
+    if args.command == 'link':
+        pairs, unmatched = link(read_reviews(args.actual, args.column_name, args.id_column),
+                                read_reviews(args.generated, args.column_name, args.id_column, args.source_column),
+                                args.prefix_words)
+        with open(args.output, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(PAIR_COLUMNS)
+            writer.writerows(pairs)
+        by_id = sum(pair[2] == 'id' for pair in pairs)
+        print(f'{args.output}: {len(pairs)} pairs ({by_id} by source id, {len(pairs) - by_id} by opening), {len(unmatched)} generated reviews without a source')
+        return
+
+    columns = feature_names(args.features) if os.path.exists(args.features) else None
+    pairs = pd.read_csv(args.pairs, dtype={'generated_id': str, 'source_id': str, 'shared_words': 'Int64'})
+    actual_metrics = pd.read_csv(args.actual_metrics, dtype={'fname': str}, low_memory=False)
+    generated_metrics = actual_metrics if args.generated_metrics == args.actual_metrics else \
+        pd.read_csv(args.generated_metrics, dtype={'fname': str}, low_memory=False)
+    try:
+        joined, actual, generated, columns = paired_deltas(pairs, actual_metrics, generated_metrics, columns)
+    except ValueError as error:
+        sys.exit(str(error))
+    if not len(joined):
+        sys.exit(f'no pair of {args.pairs} has metrics for both reviews')
+
+    deltas = pd.DataFrame(generated - actual, columns=columns)
+    pd.concat([joined, deltas], axis=1).to_csv(args.output, index=False)
+    rows = summarize(joined, actual, generated, columns, args.bootstrap, args.permutations, args.confidence,
+                     args.correction, args.alpha, args.units, args.seed)
+    pd.DataFrame(rows, columns=SUMMARY_COLUMNS).to_csv(args.summary, index=False)
+    significant = sum(row[-1] for row in rows)
+    print(f'{args.output}: {len(joined)} of {len(pairs)} pairs; {significant}/{len(columns)} columns differ ({args.correction}, alpha {args.alpha})')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,576 @@
+"""
+Streaming review -> annotation -> metrics pipeline.
+
+Instead of annotating a whole reviews file with ``extract_characteristics.py``
+and only then computing metrics with ``feature_extractor.py``, the stages run
+concurrently and hand reviews to each other through bounded queues:
+
+* a reader thread streams reviews from the input files, CSV, JSON lines or
+  Parquet, compressed or not, with ``--read-workers`` processes
+  decompressing several shards at once (see ``review_sources.py``),
+* ``--annotate-workers`` processes run natasha and pymorphy2
+  (``extract_characteristics.process_review``),
+* ``--metric-workers`` processes evaluate the ``features.txt`` metrics of
+  every review,
+* the main process writes each result as soon as it and all reviews before
+  it are done, so rows come out in input order.
+
+At most ``--max-in-flight`` reviews are between the reader and the writer at
+any time, so a slow stage holds the reader back instead of letting queues or
+the reorder buffer grow.
+
+A review that cannot be annotated gets a row of ``nan`` (and one empty
+sentence in ``--annotated-path``, as in ``extract_characteristics.py``), a
+metric that raises gets ``nan``, and both are written to ``--errors-path``,
+as in ``feature_extractor.py``; the run goes on. Like
+``fault_isolation.WorkerPool``, the main process supervises the workers:
+every worker notes the review it is working on, and a worker that dies is
+replaced and its review is handed to the annotators again, up to
+``MAX_ATTEMPTS`` attempts; after that the review gets a row of ``nan`` and a
+``worker`` error. A worker that dies while starting, or a reader that fails,
+aborts the run, and no partial output is left behind.
+
+Repeated reviews (identical texts) are annotated and evaluated once: a pass
+over the texts before the run finds them, only the first occurrence goes
+through the workers, and the writer keeps its result until the last copy
+has been written with it.
+
+The per-review metrics table has one row per review. The annotated rows can
+also be written in the ``extract_characteristics.py`` layout
+(``--annotated-path``), together with mergeable states (``--states-path``, see
+``metric_state.py``), from which per-corpus metrics are obtained without
+another pass over the data.
+
+    python pipeline.py --data-path=reviews.csv --column-name=review --output-path=review_metrics.csv --annotated-path=annotated.csv
+    python pipeline.py --data-path='dumps/part-*.jsonl.zst' --column-name=meta.text --id-column=id --read-workers=4
+
+``--sample`` processes only a stratified sample and summarizes it per group,
+see ``sampling.py``. ``--monitor-baseline`` feeds every written row to a drift
+monitor that compares time windows of the output with a baseline of human
+reviews, see ``drift_monitor.py``.
+"""
+
+import argparse
+import collections
+import csv
+import json
+import math
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+
+from tqdm import tqdm
+
+from annotation_layers import LAYERS, required_layers
+from batch_metrics import load_plugins
+from dedup import THRESHOLD, find_duplicates, summary, text_key
+from drift_monitor import DriftMonitor, ReportWriter, parse_window, read_baseline
+from fault_isolation import MAX_ATTEMPTS, SHUTDOWN_SECONDS, ErrorLog
+from feature_extractor import FeatureExtractor, evaluate_metrics, lexicons, metric_function, prepare_lexicons, read_feature_list
+from metric_state import DocumentState
+from review_sources import expand_inputs, missing_fields, read_records
+import sampling
+
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+FIELDS = ('word', 'lemma', 'pos', 'morph', 'dep')
+DONE = None
+# Seconds the writer waits for a result before it checks on the workers
+POLL_SECONDS = 1.0
+# Slot values of a worker that is not working on a review
+STARTING = -2
+IDLE = -1
+
+
+def _extract_characteristics():
+    if SRC_DIR not in sys.path:
+        sys.path.insert(0, SRC_DIR)
+    import extract_characteristics
+    return extract_characteristics
+
+
+def read_reviews(path, column_name, id_column=None, workers=1):
+    fields = [column_name] + ([id_column] if id_column else [])
+    for index, values in enumerate(read_records(expand_inputs(path), fields, workers)):
+        # A missing text is an empty review, like an empty CSV cell
+        text = '' if values[0] is None else str(values[0])
+        yield (str(values[1]) if id_column else str(index)), text
+
+
+def annotated_rows(processed):
+    # As written by convert_to_csv_format; missing tags (None) become empty cells
+    extract_characteristics = _extract_characteristics()
+    return [['' if value is None else str(value) for value in extract_characteristics.sentence_row(sentence)] for sentence in processed]
+
+
+def row_mappings(rows):
+    for row in rows:
+        mapping = {'sentence': row[0]}
+        for position, value in enumerate(row[1:]):
+            mapping[f'{FIELDS[position % len(FIELDS)]}{position // len(FIELDS) + 1}'] = value
+        yield mapping
+
+
+def _annotate_worker(tasks, results, layers, slot):
+    extract_characteristics = _extract_characteristics()
+    components = extract_characteristics.initialize_analysis_components(layers)
+    slot.value = IDLE
+    while True:
+        task = tasks.get()
+        if task is DONE:
+            break
+        index, review_id, text = task
+        slot.value = index
+        try:
+            results.put((index, review_id, annotated_rows(extract_characteristics.process_review(text, *components)), []))
+        except Exception as error:
+            errors = ErrorLog()
+            errors.add(review_id, 'annotate', error)
+            results.put((index, review_id, None, errors.records))
+        slot.value = IDLE
+
+
+def _evaluate(task, function_list, functions, arglist, with_states):
+    # ``(index, review_id, row, rows, state, errors)``, with ``ErrorLog``
+    # records; row is None if the review could not be evaluated
+    index, review_id, rows, records = task
+    if rows is None:
+        return index, review_id, None, None, None, records
+    errors = ErrorLog()
+    try:
+        words, sents = FeatureExtractor.parse_rows(row_mappings(rows))
+    except Exception as error:
+        errors.add(review_id, 'read', error)
+        return index, review_id, None, rows, None, errors.records
+    failures = []
+    values = evaluate_metrics(words, sents, functions, arglist, errors=failures)
+    for position, error in failures:
+        errors.add(review_id, 'metric', error, function_list[position])
+    state = None
+    if with_states:
+        try:
+            state = DocumentState.from_document(words, sents, lexicons).to_dict()
+        except Exception as error:
+            errors.add(review_id, 'state', error)
+    return index, review_id, [review_id] + values, rows, state, errors.records
+
+
+def _metric_worker(tasks, results, features_path, with_states, slot):
+    function_list, arglist = read_feature_list(features_path)
+    functions = [metric_function(name) for name in function_list]
+    slot.value = IDLE
+    while True:
+        task = tasks.get()
+        if task is DONE:
+            break
+        slot.value = task[0]
+        results.put(_evaluate(task, function_list, functions, arglist, with_states))
+        slot.value = IDLE
+
+
+class _Workers:
+    """The processes of one stage, replaced when they die.
+
+    Every worker gets ``target(*args, slot)``; the shared ``slot`` holds the
+    index of the review the worker is working on, ``IDLE`` between reviews
+    and ``STARTING`` until it is initialized.
+    """
+
+    def __init__(self, stage, count, target, args):
+        self.stage = stage
+        self.target = target
+        self.args = args
+        self.slots = [multiprocessing.RawValue('q', STARTING) for _ in range(count)]
+        self.processes = [self._start(slot) for slot in self.slots]
+
+    def _start(self, slot):
+        slot.value = STARTING
+        process = multiprocessing.Process(target=self.target, args=self.args + (slot,), daemon=True)
+        process.start()
+        return process
+
+    def replace_dead(self):
+        """Start new workers for the dead ones; ``[(index, exit code)]`` of the reviews they held."""
+        lost = []
+        for position, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            held = self.slots[position].value
+            if held == STARTING:
+                raise RuntimeError(f'{self.stage} worker died during initialization (exit code {process.exitcode})')
+            if held != IDLE:
+                lost.append((held, process.exitcode))
+            self.processes[position] = self._start(self.slots[position])
+        return lost
+
+    def idle(self):
+        return all(slot.value == IDLE for slot in self.slots)
+
+    def stop(self, tasks):
+        for _ in self.processes:
+            tasks.put(DONE)
+        for process in self.processes:
+            process.join(SHUTDOWN_SECONDS)
+            if process.is_alive():
+                process.terminate()
+
+    def terminate(self):
+        for process in self.processes:
+            process.terminate()
+
+
+class Pipeline:
+
+    def __init__(self, data_path, column_name, output_path, annotated_path=None, states_path=None, id_column=None,
+                 annotate_workers=None, metric_workers=1, max_in_flight=64, features_path='features.txt',
+                 drop_duplicates=False, duplicate_threshold=THRESHOLD, rows=None, read_workers=1, monitor=None,
+                 errors_path=None):
+        self.data_path = data_path
+        self.column_name = column_name
+        self.output_path = output_path
+        self.annotated_path = annotated_path
+        self.states_path = states_path
+        self.errors_path = errors_path or f'{output_path}.errors.jsonl'
+        self.id_column = id_column
+        self.annotate_workers = annotate_workers or max(1, multiprocessing.cpu_count() - metric_workers)
+        self.metric_workers = metric_workers
+        self.max_in_flight = max_in_flight
+        self.read_workers = read_workers
+        # A drift_monitor.DriftMonitor that sees every row as it is written
+        self.monitor = monitor
+        self.drop_duplicates = drop_duplicates
+        self.duplicate_threshold = duplicate_threshold
+        # Row numbers to process (a sample); None processes every review
+        self.rows = rows
+        self.features_path = features_path
+        self.function_list, _ = read_feature_list(features_path)
+        # States cover every metric, so they need every layer
+        self.layers = required_layers(self.function_list) if states_path is None else LAYERS
+
+    def _selected(self, row, skip):
+        return row not in skip and (self.rows is None or row in self.rows)
+
+    def _duplicate_rows(self):
+        # A pass over the texts before any annotation starts
+        duplicates = find_duplicates((text for _, text in read_reviews(self.data_path, self.column_name, workers=self.read_workers)),
+                                     self.duplicate_threshold)
+        print(summary(duplicates), file=sys.stderr)
+        return {row for row, (_, kind, _) in enumerate(duplicates) if kind != 'unique'}
+
+    def _copies(self, skip):
+        # A pass over the texts before any annotation starts: the index of
+        # every review whose text came before -> (index of the first
+        # occurrence, review id)
+        first = {}
+        copies = {}
+        index = 0
+        for row, (review_id, text) in enumerate(read_reviews(self.data_path, self.column_name, self.id_column, self.read_workers)):
+            if not self._selected(row, skip):
+                continue
+            copies_of = first.setdefault(text_key(text), index)
+            if copies_of != index:
+                copies[index] = (copies_of, review_id)
+            index += 1
+        if copies:
+            print(f'{len(copies)} repeated reviews reuse the result of their first occurrence', file=sys.stderr)
+        return copies
+
+    def _read(self, annotate_queue, in_flight, stop, skip, copies, outstanding, read):
+        # Every review handed to the workers is in ``outstanding`` until its
+        # result comes back; ``read`` gets 'done' once all are handed over,
+        # or the 'error' that stopped the reader
+        index = 0
+        try:
+            for row, (review_id, text) in enumerate(read_reviews(self.data_path, self.column_name, self.id_column, self.read_workers)):
+                if not self._selected(row, skip):
+                    continue
+                # Copies are written from their first occurrence's result
+                if index not in copies:
+                    in_flight.acquire()
+                    if stop.is_set():
+                        return
+                    outstanding[index] = [review_id, text, 0]
+                    annotate_queue.put((index, review_id, text))
+                index += 1
+        except BaseException as error:
+            read['error'] = error
+            return
+        read['done'] = True
+
+    def _results(self, result_queue, annotate_queue, metric_queue, stages, outstanding, read):
+        """Results of the metric workers until every review read has one.
+
+        Between results, dead workers are replaced and the reviews they held
+        are requeued, or get a ``worker`` error once they used up their
+        attempts. Raises if the reader failed.
+        """
+        while 'done' not in read or outstanding:
+            try:
+                result = result_queue.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                result = None
+            if result is not None:
+                # A review requeued after its worker died may come back twice
+                if outstanding.pop(result[0], None) is not None:
+                    yield result
+                continue
+            if 'error' in read:
+                raise read['error']
+            lost = [held for stage in stages for held in stage.replace_dead()]
+            if not lost and outstanding and all(stage.idle() for stage in stages) \
+                    and annotate_queue.empty() and metric_queue.empty():
+                # Nothing is queued or worked on, so a worker died before it
+                # noted its review or before its result was sent
+                lost = [(index, None) for index in list(outstanding)]
+            for index, exitcode in lost:
+                if index not in outstanding:
+                    continue
+                review_id, text, attempts = outstanding[index]
+                if attempts + 1 < MAX_ATTEMPTS:
+                    outstanding[index][2] += 1
+                    annotate_queue.put((index, review_id, text))
+                    continue
+                del outstanding[index]
+                errors = ErrorLog()
+                errors.add(review_id, 'worker', 'no result from the workers' if exitcode is None
+                           else f'worker died (exit code {exitcode})')
+                yield index, review_id, None, None, None, errors.records
+
+    def run(self):
+        prepare_lexicons()
+        # Long reviews and the rows of long sentences exceed the default limit
+        csv.field_size_limit(sys.maxsize)
+        skip = self._duplicate_rows() if self.drop_duplicates else set()
+        # With --drop-duplicates no repeated review is left
+        copies = self._copies(skip) if not self.drop_duplicates else {}
+        # Queues only need room for what may be in flight; the semaphore is
+        # what bounds the pipeline.
+        annotate_queue = multiprocessing.Queue(self.max_in_flight)
+        metric_queue = multiprocessing.Queue(self.max_in_flight)
+        result_queue = multiprocessing.Queue(self.max_in_flight)
+        in_flight = threading.Semaphore(self.max_in_flight)
+        stop = threading.Event()
+
+        annotators = _Workers('annotation', self.annotate_workers, _annotate_worker,
+                              (annotate_queue, metric_queue, self.layers))
+        calculators = _Workers('metric', self.metric_workers, _metric_worker,
+                               (metric_queue, result_queue, self.features_path, self.states_path is not None))
+        # index -> [review id, text, attempts] of the reviews the workers hold,
+        # at most --max-in-flight
+        outstanding = {}
+        read = {}
+        reader = threading.Thread(target=self._read, args=(annotate_queue, in_flight, stop, skip, copies, outstanding, read),
+                                  daemon=True)
+        reader.start()
+
+        try:
+            results = self._results(result_queue, annotate_queue, metric_queue, (annotators, calculators), outstanding, read)
+            written = self._write(results, in_flight, copies)
+        except BaseException:
+            stop.set()
+            in_flight.release()
+            annotators.terminate()
+            calculators.terminate()
+            raise
+        # Every review is written, so the workers are idle
+        annotators.stop(annotate_queue)
+        calculators.stop(metric_queue)
+        return written
+
+    def _write(self, results, in_flight, copies):
+        pid = os.getpid()
+        tmp_path = f'{self.output_path}.tmp{pid}'
+        body_path = f'{self.annotated_path}.rows{pid}' if self.annotated_path else None
+        annotated_tmp = f'{self.annotated_path}.tmp{pid}' if self.annotated_path else None
+        states_tmp = f'{self.states_path}.tmp{pid}' if self.states_path else None
+        pending = {}
+        next_index = 0
+        width = 0
+        # Results kept for copies still to be written, and how many those are
+        kept = {}
+        copies_left = collections.Counter(first for first, _ in copies.values())
+        error_log = ErrorLog()
+
+        try:
+            with open(tmp_path, 'w', newline='', encoding='utf-8') as out, \
+                    (open(body_path, 'w', newline='', encoding='utf-8') if body_path else open(os.devnull, 'w')) as body, \
+                    (open(states_tmp, 'w', encoding='utf-8') if states_tmp else open(os.devnull, 'w')) as states, \
+                    tqdm(unit='review') as progress:
+                writer = csv.writer(out)
+                writer.writerow(['fname'] + self.function_list)
+                body_writer = csv.writer(body)
+
+                def emit(review_id, row, rows, state, errors):
+                    nonlocal width
+                    error_log.extend(errors)
+                    if row is None:
+                        # Not annotated or not readable: no values and no state
+                        row = [review_id] + [math.nan] * len(self.function_list)
+                    if rows is None:
+                        rows = [['']]
+                    writer.writerow(row)
+                    if self.monitor is not None:
+                        self.monitor.add(time.time(), 'all', dict(zip(self.function_list, row[1:])))
+                    if body_path:
+                        body_writer.writerows(rows)
+                        width = max([width] + [(len(r) - 1) // len(FIELDS) for r in rows])
+                    if states_tmp and state is not None:
+                        states.write(json.dumps({'fname': review_id, 'state': state}, ensure_ascii=False) + '\n')
+                    progress.update()
+
+                for result in results:
+                    pending[result[0]] = result
+                    while next_index in pending or next_index in copies:
+                        if next_index in copies:
+                            first, review_id = copies[next_index]
+                            row, rows, state, errors = kept[first]
+                            copies_left[first] -= 1
+                            if not copies_left[first]:
+                                del kept[first], copies_left[first]
+                            emit(review_id, None if row is None else [review_id] + row[1:], rows, state,
+                                 [{**record, 'fname': review_id} for record in errors])
+                        else:
+                            _, review_id, row, rows, state, errors = pending.pop(next_index)
+                            if copies_left[next_index]:
+                                kept[next_index] = row, rows, state, errors
+                            emit(review_id, row, rows, state, errors)
+                            in_flight.release()
+                        next_index += 1
+                if pending:
+                    raise RuntimeError(f'{len(pending)} reviews are not written: no result for review {next_index}')
+
+            if self.monitor is not None:
+                self.monitor.close(time.time())
+            if body_path:
+                self._finish_annotated(body_path, annotated_tmp, width)
+            if states_tmp:
+                os.replace(states_tmp, self.states_path)
+            os.replace(tmp_path, self.output_path)
+            error_log.write(self.errors_path)
+        except BaseException:
+            # An aborted run leaves its previous outputs and no partial files
+            for path in (tmp_path, body_path, annotated_tmp, states_tmp):
+                if path and os.path.exists(path):
+                    os.remove(path)
+            raise
+        if error_log.records:
+            print(f'{error_log.summary()}, see {self.errors_path}', file=sys.stderr)
+        return next_index
+
+    def _finish_annotated(self, body_path, tmp_path, width):
+        # The header depends on the longest sentence, known only at the end;
+        # rows are padded to it like convert_to_csv_format does.
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as f, open(body_path, newline='', encoding='utf-8') as body:
+            writer = csv.writer(f)
+            writer.writerow(['sentence'] + [f'{field}{i}' for i in range(1, width + 1) for field in FIELDS])
+            size = 1 + len(FIELDS) * width
+            for row in csv.reader(body):
+                writer.writerow(row + [''] * (size - len(row)))
+        os.remove(body_path)
+        os.replace(tmp_path, self.annotated_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Annotate reviews and compute their metrics in one streaming pass")
+    parser.add_argument("--data-path", required=True, help="reviews: a CSV, JSON lines or Parquet file (also .gz, .bz2, .xz, .zst), a folder or a glob pattern of such shards")
+    parser.add_argument("--column-name", required=True, help="review text column, or field path such as meta.text")
+    parser.add_argument("--id-column", default=None, help="column or field path identifying a review (default: row number)")
+    parser.add_argument("--read-workers", default=1, type=int, help="processes that decompress and parse input shards in parallel")
+    parser.add_argument("--output-path", default="review_metrics.csv", help="per-review metrics")
+    parser.add_argument("--annotated-path", default=None, help="also write the annotated rows (extract_characteristics.py layout)")
+    parser.add_argument("--states-path", default=None, help="also write mergeable per-review states for metric_state.py aggregate")
+    parser.add_argument("--errors-path", default=None, help="JSON lines of the reviews and metrics that failed (default: the output path + .errors.jsonl)")
+    parser.add_argument("--annotate-workers", default=None, type=int, help="annotation processes (default: CPUs minus metric workers)")
+    parser.add_argument("--metric-workers", default=1, type=int, help="metric processes")
+    parser.add_argument("--max-in-flight", default=64, type=int, help="reviews between reader and writer at most")
+    parser.add_argument("--features", default="features.txt", help="metrics to compute; only the annotation layers they read are produced")
+    parser.add_argument("--drop-duplicates", action="store_true", help="skip all but the first review of every exact or near-duplicate cluster (see dedup.py)")
+    parser.add_argument("--duplicate-threshold", default=THRESHOLD, type=float, help="estimated Jaccard similarity of near duplicates")
+    parser.add_argument("--plugins", default="", help="comma-separated modules that register batch metrics (see batch_metrics.py)")
+    parser.add_argument("--sample", default=None, type=float, help="process only this fraction of every --group-column group (see sampling.py)")
+    parser.add_argument("--group-column", default=None, help="column whose groups are sampled separately and summarized")
+    parser.add_argument("--seed", default=0, type=int, help="seed of --sample")
+    parser.add_argument("--target-width", default=None, type=float, help="enlarge the sample until every confidence interval is at most this wide relative to its mean")
+    parser.add_argument("--target-metrics", default=None, help="comma-separated metrics that --target-width applies to (default: all)")
+    parser.add_argument("--max-rounds", default=sampling.MAX_ROUNDS, type=int, help="rounds of --target-width at most")
+    parser.add_argument("--confidence", default=sampling.CONFIDENCE, type=float, help="confidence level of the intervals")
+    parser.add_argument("--summary-path", default="sample_summary.csv", help="per-group means and confidence intervals of --sample")
+    parser.add_argument("--monitor-baseline", default=None, help="metrics table of human reviews; monitor the output for shifts against it (see drift_monitor.py)")
+    parser.add_argument("--monitor-window", action="append", type=parse_window, default=None,
+                        help="SECONDS or SECONDS/STEP windows of --monitor-baseline; repeat for several (default: 3600)")
+    parser.add_argument("--monitor-output", default="drift.csv", help="window statistics of --monitor-baseline")
+
+    args = parser.parse_args()
+    # Before the workers start, so that they inherit the registered metrics
+    load_plugins(module for module in args.plugins.split(',') if module)
+    if args.sample is not None:
+        if not 0 < args.sample <= 1:
+            parser.error("--sample must be a fraction in (0, 1]")
+        if args.group_column is None:
+            parser.error("--sample needs --group-column")
+        if args.annotated_path or args.states_path or args.drop_duplicates or args.monitor_baseline:
+            parser.error("--sample does not combine with --annotated-path, --states-path, --drop-duplicates or --monitor-baseline")
+    elif args.group_column or args.target_width is not None:
+        parser.error("--group-column and --target-width need --sample")
+    paths = expand_inputs(args.data_path)
+    if not paths:
+        parser.error(f"--data-path: no input files: {args.data_path}")
+    missing = missing_fields(paths, [field for field in (args.column_name, args.id_column, args.group_column) if field])
+    if missing:
+        parser.error(f"{paths[0]} has no field {', '.join(map(repr, missing))}")
+
+    monitor = report = None
+    if args.monitor_baseline:
+        function_list, _ = read_feature_list(args.features)
+        try:
+            baseline = read_baseline(args.monitor_baseline, columns=set(function_list))
+        except ValueError as error:
+            parser.error(str(error))
+        report = ReportWriter(args.monitor_output)
+        monitor = DriftMonitor(function_list, baseline, args.monitor_window or [(3600.0, 3600.0)], report=report)
+
+    def make_pipeline(rows=None, output_path=args.output_path):
+        return Pipeline(
+            data_path=args.data_path,
+            column_name=args.column_name,
+            output_path=output_path,
+            annotated_path=args.annotated_path,
+            states_path=args.states_path,
+            id_column=args.id_column,
+            annotate_workers=args.annotate_workers,
+            metric_workers=args.metric_workers,
+            max_in_flight=args.max_in_flight,
+            features_path=args.features,
+            drop_duplicates=args.drop_duplicates,
+            duplicate_threshold=args.duplicate_threshold,
+            rows=rows,
+            read_workers=args.read_workers,
+            monitor=monitor,
+            errors_path=args.errors_path,
+        )
+
+    if args.sample is not None:
+        target_metrics = set(args.target_metrics.split(',')) if args.target_metrics else None
+        summary = sampling.run_sample(
+            make_pipeline, args.data_path, args.group_column, args.sample, args.output_path, args.summary_path,
+            id_column=args.id_column, seed=args.seed, target_width=args.target_width, target_metrics=target_metrics,
+            max_rounds=args.max_rounds, confidence=args.confidence, read_workers=args.read_workers,
+        )
+        print(f'{args.summary_path}: {len(summary)} group metrics')
+        return
+
+    try:
+        written = make_pipeline().run()
+    finally:
+        if report is not None:
+            report.close()
+    print(f'{args.output_path}: {written} reviews')
+    if report is not None:
+        print(f'{args.monitor_output}: {report.flagged} shifts flagged')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+Reading reviews from CSV, JSON lines and Parquet files, compressed or not.
+
+An input is a file, a folder (every supported file in it) or a glob pattern
+such as ``dumps/part-*.jsonl.zst``. The format comes from the file name:
+
+* ``.csv`` and ``.tsv``,
+* ``.jsonl``, ``.ndjson`` and ``.json`` (one JSON object per line),
+* ``.parquet`` (needs ``pyarrow``),
+
+optionally followed by ``.gz``, ``.bz2``, ``.xz`` or ``.zst`` (needs
+``zstandard``). Files are decompressed while they are read, never to disk.
+
+Fields are selected by path: ``review`` is a column or a top-level key,
+``meta.text`` or ``reviews.0.text`` walk into nested objects and lists of
+JSON lines and Parquet structs. A missing field gives ``None``.
+
+``read_records`` reads several files (shards) at once with ``workers``
+processes, each decompressing and parsing whole shards and handing on
+chunks of records through a bounded queue; records still come out in input
+order. ``annotated_documents`` lists the annotated document files of a
+folder, which ``feature_extractor.py`` also reads compressed. This module has
+no sibling imports, so that it can be used from the package as well.
+"""
+
+import bz2
+import csv
+import glob
+import gzip
+import io
+import json
+import lzma
+import os
+import sys
+import traceback
+
+
+COMPRESSIONS = ('.gz', '.bz2', '.xz', '.zst')
+FORMATS = {'.csv': 'csv', '.tsv': 'tsv', '.jsonl': 'jsonl', '.ndjson': 'jsonl', '.json': 'jsonl', '.parquet': 'parquet'}
+CHUNK_RECORDS = 2000
+# Chunks a reading process may be ahead of the consumer
+QUEUED_CHUNKS = 8
+# Records that missing_fields looks at
+CHECKED_RECORDS = 100
+
+
+def split_suffixes(path):
+    """``(format, compression)`` of a file name; compression is '' for plain files."""
+    name = path.lower()
+    compression = next((suffix for suffix in COMPRESSIONS if name.endswith(suffix)), '')
+    name = name[:len(name) - len(compression)]
+    return FORMATS.get(os.path.splitext(name)[1]), compression
+
+
+def open_text(path):
+    """A text stream of a possibly compressed file."""
+    _, compression = split_suffixes(path)
+    if compression == '.gz':
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    if compression == '.bz2':
+        return bz2.open(path, 'rt', encoding='utf-8', newline='')
+    if compression == '.xz':
+        return lzma.open(path, 'rt', encoding='utf-8', newline='')
+    if compression == '.zst':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(f'{path}: reading .zst files needs the zstandard package') from None
+        binary = open(path, 'rb')
+        reader = zstandard.ZstdDecompressor().stream_reader(binary, read_across_frames=True, closefd=True)
+        return io.TextIOWrapper(reader, encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def expand_inputs(spec):
+    """Files of an input: the file itself, the supported files of a folder, or the matches of a glob pattern."""
+    if os.path.isfile(spec):
+        return [spec]
+    paths = sorted(glob.glob(os.path.join(spec, '*')) if os.path.isdir(spec) else glob.glob(spec))
+    return [path for path in paths if os.path.isfile(path) and split_suffixes(path)[0] is not None]
+
+
+def annotated_documents(folder):
+    """Annotated document files of a folder: ``*.csv``, also compressed."""
+    return [path for path in glob.glob(os.path.join(folder, '*')) if split_suffixes(path)[0] == 'csv']
+
+
+def field_getter(field, default=None):
+    """Function of a record that returns the value at ``field`` (``a.b.0.c``), or ``default``."""
+    parts = field.split('.')
+
+    def get(record):
+        # A column or key may itself contain dots
+        if field in record:
+            return record[field]
+        value = record
+        for part in parts:
+            if isinstance(value, dict) and part in value:
+                value = value[part]
+            elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+                value = value[int(part)]
+            else:
+                return default
+        return value
+
+    return get
+
+
+def _records(path):
+    # Records of one file as mappings, in file order
+    kind, _ = split_suffixes(path)
+    if kind == 'parquet':
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError(f'{path}: reading Parquet files needs the pyarrow package') from None
+        if split_suffixes(path)[1]:
+            raise ValueError(f'{path}: Parquet files are compressed internally and cannot be read compressed')
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=CHUNK_RECORDS):
+            yield from batch.to_pylist()
+        return
+    with open_text(path) as f:
+        if kind in ('csv', 'tsv'):
+            csv.field_size_limit(sys.maxsize)
+            yield from csv.DictReader(f, delimiter='\t' if kind == 'tsv' else ',')
+            return
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as error:
+                raise ValueError(f'{path}:{number}: not a JSON object ({error})') from None
+
+
+def read_file(path, fields):
+    """Tuples of the ``fields`` of every record of one file."""
+    getters = [field_getter(field) for field in fields]
+    for record in _records(path):
+        yield tuple(get(record) for get in getters)
+
+
+def missing_fields(paths, fields, records=CHECKED_RECORDS):
+    """The ``fields`` that none of the first ``records`` records of ``paths`` has, to catch misspelt names early."""
+    missing = object()
+    getters = {field: field_getter(field, missing) for field in fields}
+    absent = set(fields)
+    for path in paths:
+        for number, record in enumerate(_records(path)):
+            absent = {field for field in absent if getters[field](record) is missing}
+            if not absent or number + 1 >= records:
+                return [field for field in fields if field in absent]
+        break
+    return [field for field in fields if field in absent]
+
+
+def _read_shards(paths, fields, queue):
+    # One reading process: its shards one after another, in chunks
+    for path in paths:
+        try:
+            chunk = []
+            for values in read_file(path, fields):
+                chunk.append(values)
+                if len(chunk) == CHUNK_RECORDS:
+                    queue.put(('records', chunk))
+                    chunk = []
+            queue.put(('records', chunk))
+            queue.put(('done', None))
+        except Exception:
+            queue.put(('failed', f'{path}:\n{traceback.format_exc()}'))
+            return
+
+
+def read_records(paths, fields, workers=1):
+    """Tuples of the ``fields`` of every record of ``paths``, in order.
+
+    With several files and ``workers > 1``, reading process ``i`` reads
+    files ``i``, ``i + workers``, ... so that the files are taken from the
+    processes in turn.
+    """
+    workers = max(1, min(workers, len(paths)))
+    if workers == 1:
+        for path in paths:
+            yield from read_file(path, fields)
+        return
+
+    # Only parallel reading needs multiprocessing
+    import multiprocessing
+
+    queues = [multiprocessing.Queue(QUEUED_CHUNKS) for _ in range(workers)]
+    processes = [
+        multiprocessing.Process(target=_read_shards, args=(paths[i::workers], fields, queues[i]), daemon=True)
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for number in range(len(paths)):
+            queue = queues[number % workers]
+            while True:
+                kind, payload = queue.get()
+                if kind == 'records':
+                    yield from payload
+                elif kind == 'done':
+                    break
+                else:
+                    raise ValueError(f'reading {payload}')
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
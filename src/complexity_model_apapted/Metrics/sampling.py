@@ -0,0 +1,194 @@
+"""
+Stratified samples of a reviews file, for quick group-level estimates.
+
+Every review gets a priority, a hash of ``--seed`` and its id. Each group
+(``--group-column``, e.g. actual against generated) takes its reviews in
+priority order. The sample is therefore reproducible, and a larger sample
+always contains the smaller one. ``pipeline.py --sample`` annotates and
+scores only the sampled reviews, then reports the mean of every metric in
+every group with a confidence interval (a normal interval with the finite
+population correction).
+
+With ``--target-width``, the sample grows in rounds until every interval is
+at most that wide relative to its mean, or until the groups are exhausted.
+Metrics with a zero or undefined mean do not count towards the target.
+Only the reviews added in a round are annotated. The size of the next round
+comes from the widest interval of each group, between ``MIN_GROWTH`` and
+``GROWTH`` times the current size.
+
+    python pipeline.py --data-path=reviews.csv --column-name=review --group-column=source --sample=0.01 --target-width=0.05 --output-path=sample_metrics.csv --summary-path=sample_summary.csv
+"""
+
+import collections
+import csv
+import hashlib
+import math
+import os
+import sys
+from statistics import NormalDist
+
+from review_sources import expand_inputs, read_records
+
+
+CONFIDENCE = 0.95
+MIN_PER_GROUP = 30
+GROWTH = 4
+# Every round restarts the annotation models, so a group that grows grows by at least this factor
+MIN_GROWTH = 1.25
+MAX_ROUNDS = 8
+
+
+def priority(seed, review_id):
+    digest = hashlib.blake2b(f'{seed}\x00{review_id}'.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def read_strata(path, group_column, id_column=None, seed=0, workers=1):
+    """Row numbers of every group, in priority order, and the review id of every row number."""
+    groups = {}
+    ids = []
+    fields = [group_column] + ([id_column] if id_column else [])
+    # Rows are numbered and identified as in pipeline.read_reviews
+    for row, values in enumerate(read_records(expand_inputs(path), fields, workers)):
+        review_id = str(values[1]) if id_column else str(row)
+        ids.append(review_id)
+        groups.setdefault(values[0], []).append((priority(seed, review_id), row))
+    return {group: [row for _, row in sorted(rows)] for group, rows in groups.items()}, ids
+
+
+def initial_sizes(strata, fraction, minimum=MIN_PER_GROUP):
+    # Proportional allocation, with at least ``minimum`` reviews per group
+    return {group: min(len(rows), max(minimum, math.ceil(fraction * len(rows)))) for group, rows in strata.items()}
+
+
+def interval(values, population, confidence=CONFIDENCE):
+    """``(n, mean, low, high)`` of the mean of the finite values out of ``population`` reviews."""
+    values = [value for value in values if not math.isnan(value)]
+    n = len(values)
+    if not n:
+        return 0, math.nan, math.nan, math.nan
+    mean = sum(values) / n
+    if n < 2:
+        return n, mean, math.nan, math.nan
+    variance = sum((value - mean) ** 2 for value in values) / (n - 1)
+    correction = (population - n) / (population - 1) if population > 1 else 0.0
+    half = NormalDist().inv_cdf(0.5 + confidence / 2) * math.sqrt(variance / n * max(correction, 0.0))
+    return n, mean, mean - half, mean + half
+
+
+def relative_width(mean, low, high):
+    if math.isnan(low):
+        return math.inf
+    if high == low:
+        return 0.0
+    return (high - low) / abs(mean) if mean else math.inf
+
+
+def summarize(strata, sizes, values, function_list, confidence=CONFIDENCE):
+    """One summary row per group and metric; ``values`` maps row numbers to metric values."""
+    summary = []
+    for group, rows in strata.items():
+        sampled = [values[row] for row in rows[:sizes[group]]]
+        for position, name in enumerate(function_list):
+            n, mean, low, high = interval([sample[position] for sample in sampled], len(rows), confidence)
+            summary.append({
+                'group': group, 'metric': name, 'population': len(rows), 'sampled': sizes[group], 'n': n,
+                'mean': mean, 'ci_low': low, 'ci_high': high, 'relative_width': relative_width(mean, low, high),
+            })
+    return summary
+
+
+def next_sizes(strata, sizes, summary, target_width, metrics=None):
+    """Sample size of every group for the next round; equal to ``sizes`` when nothing needs to grow."""
+    grown = dict(sizes)
+    for group, rows in strata.items():
+        size, population = sizes[group], len(rows)
+        if size >= population:
+            continue
+        # The half width shrinks with sqrt(1/n - 1/N)
+        required = size
+        for entry in summary:
+            if entry['group'] != group or (metrics and entry['metric'] not in metrics):
+                continue
+            width = entry['relative_width']
+            # Intervals without a relative width (a zero or undefined mean) cannot reach any target
+            if width <= target_width or math.isinf(width):
+                continue
+            shrink = (target_width / width) ** 2
+            required = max(required, math.ceil(1 / (1 / population + shrink * (1 / size - 1 / population))))
+        if required > size:
+            grown[group] = min(population, GROWTH * size, max(required, math.ceil(MIN_GROWTH * size)))
+    return grown
+
+
+def read_round(path, rows, ids):
+    """Metrics records of a round table, keyed by the row numbers ``rows`` that the round sampled.
+
+    Records are matched to rows by their review id (``fname``), in input
+    order for reviews that share an id. Raises if the table has a record of a
+    review that was not sampled or misses one that was.
+    """
+    expected = {}
+    for row in rows:
+        expected.setdefault(ids[row], collections.deque()).append(row)
+    records = {}
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        for record in reader:
+            waiting = expected.get(record[0])
+            if not waiting:
+                raise RuntimeError(f'{path}: review {record[0]!r} was not sampled')
+            records[waiting.popleft()] = record
+    if len(records) != len(rows):
+        raise RuntimeError(f'{path}: {len(rows) - len(records)} of {len(rows)} sampled reviews have no metrics')
+    return header, records
+
+
+def run_sample(pipeline_factory, data_path, group_column, fraction, output_path, summary_path, id_column=None, seed=0,
+               target_width=None, target_metrics=None, max_rounds=MAX_ROUNDS, confidence=CONFIDENCE, read_workers=1):
+    """Score a stratified sample with pipelines from ``pipeline_factory(rows, output_path)``; return the summary."""
+    strata, ids = read_strata(data_path, group_column, id_column, seed, read_workers)
+    sizes = {group: 0 for group in strata}
+    wanted = initial_sizes(strata, fraction)
+    values = {}
+    function_list = None
+    round_path = f'{output_path}.round{os.getpid()}'
+    tmp_path = f'{output_path}.tmp{os.getpid()}'
+    try:
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as out:
+            writer = csv.writer(out)
+            for number in range(1, max_rounds + 1):
+                rows = sorted(row for group, order in strata.items() for row in order[sizes[group]:wanted[group]])
+                pipeline = pipeline_factory(set(rows), round_path)
+                pipeline.run()
+                header, records = read_round(round_path, rows, ids)
+                if function_list is None:
+                    function_list = header[1:]
+                    writer.writerow(header)
+                for row in rows:
+                    writer.writerow(records[row])
+                    values[row] = [float(value) if value else math.nan for value in records[row][1:]]
+                os.remove(round_path)
+                sizes = wanted
+                summary = summarize(strata, sizes, values, function_list, confidence)
+                print(f'round {number}: ' + ', '.join(f'{group} {sizes[group]}/{len(order)}' for group, order in strata.items()), file=sys.stderr)
+                if target_width is None:
+                    break
+                wanted = next_sizes(strata, sizes, summary, target_width, target_metrics)
+                if wanted == sizes:
+                    break
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        # An aborted run leaves its previous output and no partial files
+        for path in (tmp_path, round_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    fields = ['group', 'metric', 'population', 'sampled', 'n', 'mean', 'ci_low', 'ci_high', 'relative_width']
+    with open(summary_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(summary)
+    return summary
@@ -0,0 +1,229 @@
+"""
+Deterministic sharding of a document folder across independent processes.
+
+Every document (an input CSV file, identified by its file name) is assigned
+to shard ``blake2b(name) mod N``. The assignment is frozen in a manifest so
+that all hosts agree on the document set even if files are added while the
+run is in progress. Shards only communicate through files on a shared
+filesystem: each shard writes its metrics table and then a ``.done`` marker,
+and ``merge`` refuses to combine anything until every marker is present and
+matches the manifest.
+
+    python feature_extractor.py --input-path=data --output-path=out/metrics.csv --shard=0/4
+    ...
+    python feature_extractor.py --input-path=data --output-path=out/metrics.csv --shard=3/4
+    python sharding.py merge --output-path=out/metrics.csv
+
+``merge`` also combines the shards' ``--states-path`` files, skipping the
+documents that failed and so have no state, and their error logs. Inverted
+indexes (``--index-path``) stay one per shard; ``merge --index-path`` only
+checks that every shard wrote its index, and ``inverted_index.py query``
+takes all of them with a repeated ``--index``.
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+
+from fault_isolation import ErrorLog
+from inverted_index import InvertedIndex
+from review_sources import annotated_documents
+
+
+def shard_of(name, num_shards):
+    digest = hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') % num_shards
+
+
+def parse_shard(value):
+    try:
+        index, num_shards = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected a shard like 0/8, got {value!r}')
+    if num_shards < 1 or not 0 <= index < num_shards:
+        raise argparse.ArgumentTypeError(f'shard index must be in [0, {num_shards}), got {value!r}')
+    return index, num_shards
+
+
+def _stem(output_path):
+    root, ext = os.path.splitext(output_path)
+    return root, ext or '.csv'
+
+
+def default_manifest_path(output_path):
+    return f'{_stem(output_path)[0]}.manifest.json'
+
+
+def shard_output_path(output_path, index, num_shards):
+    root, ext = _stem(output_path)
+    return f'{root}.shard-{index:05d}-of-{num_shards:05d}{ext}'
+
+
+def _done_path(shard_path):
+    return f'{shard_path}.done'
+
+
+def _digest(names):
+    return hashlib.blake2b('\n'.join(names).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _write_json(path, payload):
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'w', encoding='utf-8') as fp:
+        json.dump(payload, fp, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+def build_manifest(input_path, num_shards):
+    names = sorted(os.path.basename(f) for f in annotated_documents(input_path))
+    return {
+        'num_shards': num_shards,
+        'documents': [{'name': name, 'shard': shard_of(name, num_shards)} for name in names],
+    }
+
+
+def load_or_create_manifest(manifest_path, input_path, num_shards):
+    # Concurrent creators produce byte-identical manifests and replace the
+    # file atomically, so no coordination between hosts is required.
+    if not os.path.exists(manifest_path):
+        _write_json(manifest_path, build_manifest(input_path, num_shards))
+    with open(manifest_path, encoding='utf-8') as fp:
+        manifest = json.load(fp)
+    if manifest['num_shards'] != num_shards:
+        raise ValueError(f"{manifest_path} was planned for {manifest['num_shards']} shards, not {num_shards}")
+    return manifest
+
+
+def shard_documents(manifest, index):
+    return [doc['name'] for doc in manifest['documents'] if doc['shard'] == index]
+
+
+def mark_shard_done(shard_path, index, num_shards, names):
+    _write_json(_done_path(shard_path), {
+        'shard': index,
+        'num_shards': num_shards,
+        'documents': len(names),
+        'digest': _digest(sorted(names)),
+    })
+
+
+def shard_errors_path(output_path, errors_path, index, num_shards):
+    """Error log of a shard, as feature_extractor.py writes it with or without ``--errors-path``."""
+    if errors_path:
+        return shard_output_path(errors_path, index, num_shards)
+    return f'{shard_output_path(output_path, index, num_shards)}.errors.jsonl'
+
+
+def merge(manifest_path, output_path, states_path=None, errors_path=None, index_path=None):
+    """Combine the shard outputs; returns the numbers of documents, of documents without a state and of error records."""
+    with open(manifest_path, encoding='utf-8') as fp:
+        manifest = json.load(fp)
+    num_shards = manifest['num_shards']
+
+    problems = []
+    for index in range(num_shards):
+        shard_path = shard_output_path(output_path, index, num_shards)
+        names = shard_documents(manifest, index)
+        if not os.path.exists(_done_path(shard_path)):
+            problems.append(f'shard {index}/{num_shards} has not finished ({shard_path})')
+            continue
+        with open(_done_path(shard_path), encoding='utf-8') as fp:
+            done = json.load(fp)
+        if done['digest'] != _digest(sorted(names)):
+            problems.append(f'shard {index}/{num_shards} processed a different document set than the manifest')
+        if index_path and not os.path.exists(shard_output_path(index_path, index, num_shards)):
+            problems.append(f'shard {index}/{num_shards} has no index ({shard_output_path(index_path, index, num_shards)})')
+    if problems:
+        raise RuntimeError('\n'.join(problems))
+
+    order = {doc['name']: position for position, doc in enumerate(manifest['documents'])}
+    header = None
+    rows = []
+    for index in range(num_shards):
+        with open(shard_output_path(output_path, index, num_shards), newline='', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            shard_header = next(reader)
+            if header is None:
+                header = shard_header
+            elif shard_header != header:
+                raise RuntimeError(f'shard {index}/{num_shards} has different columns')
+            shard_rows = list(reader)
+        if index_path:
+            # Documents that failed have a row but no postings
+            indexed = InvertedIndex(shard_output_path(index_path, index, num_shards))
+            unknown = {indexed.name(document) for document in range(len(indexed))} - {row[0] for row in shard_rows}
+            if unknown:
+                raise RuntimeError(f'shard {index}/{num_shards} index has documents that are not in its table, e.g. {min(unknown)}')
+        rows.extend(shard_rows)
+
+    rows.sort(key=lambda row: order[row[0]])
+    with open(output_path, "w", newline="", encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+    missing = 0
+    if states_path:
+        states = {}
+        for index in range(num_shards):
+            with open(shard_output_path(states_path, index, num_shards), encoding='utf-8') as f:
+                for line in f:
+                    states[json.loads(line)['fname']] = line
+        with open(states_path, "w", encoding='utf-8') as f:
+            for row in rows:
+                # Documents whose reading, metrics or state failed have none
+                if row[0] in states:
+                    f.write(states[row[0]])
+                else:
+                    missing += 1
+
+    errors = ErrorLog()
+    for index in range(num_shards):
+        path = shard_errors_path(output_path, errors_path, index, num_shards)
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                errors.extend(json.loads(line) for line in f)
+    errors.write(errors_path or f'{output_path}.errors.jsonl')
+    return len(rows), missing, len(errors.records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plan and merge sharded feature_extractor.py runs")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    plan_parser = subparsers.add_parser('plan', help="write the shard manifest ahead of the run")
+    plan_parser.add_argument("--input-path", default="./data", help="input path")
+    plan_parser.add_argument("--output-path", default="metrics.csv", help="final output file name")
+    plan_parser.add_argument("--num-shards", type=int, required=True, help="number of shards")
+    plan_parser.add_argument("--manifest", default=None, help="manifest path (default: next to the output)")
+
+    merge_parser = subparsers.add_parser('merge', help="combine finished shard outputs")
+    merge_parser.add_argument("--output-path", default="metrics.csv", help="final output file name")
+    merge_parser.add_argument("--manifest", default=None, help="manifest path (default: next to the output)")
+    merge_parser.add_argument("--states-path", default=None, help="also merge the shards' --states-path files")
+    merge_parser.add_argument("--errors-path", default=None, help="--errors-path of the shards, if given (default: the output path + .errors.jsonl)")
+    merge_parser.add_argument("--index-path", default=None, help="check that every shard wrote its --index-path index (indexes stay per shard)")
+
+    args = parser.parse_args()
+    manifest_path = args.manifest or default_manifest_path(args.output_path)
+
+    if args.command == 'plan':
+        manifest = load_or_create_manifest(manifest_path, args.input_path, args.num_shards)
+        print(f"{manifest_path}: {len(manifest['documents'])} documents in {args.num_shards} shards")
+    else:
+        try:
+            size, missing, errors = merge(manifest_path, args.output_path, args.states_path, args.errors_path, args.index_path)
+        except RuntimeError as error:
+            sys.exit(str(error))
+        print(f'{args.output_path}: {size} documents')
+        if missing:
+            print(f'{args.states_path}: {missing} documents without a state', file=sys.stderr)
+        if errors:
+            print(f'{errors} error records, see {args.errors_path or args.output_path + ".errors.jsonl"}', file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
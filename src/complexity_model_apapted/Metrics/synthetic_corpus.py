@@ -0,0 +1,259 @@
+"""
+Synthetic annotated Russian reviews for benchmarks and equivalence checks.
+
+Documents are written in the layout produced by
+``extract_characteristics.py`` (``sentence, word1, lemma1, pos1, morph1,
+dep1, ...``) with pymorphy2-style POS and morph tags and natasha-style
+dependency relations. Tokens are drawn from part-of-speech frequencies of
+Russian prose: function words and frequent forms come from a fixed list,
+open-class words are inflected from a stem list, and a small share of rare
+stems is invented so that the vocabulary keeps growing with document size
+like real text does. Every document is accompanied by its raw text so that
+the annotation step can be benchmarked too.
+
+    python synthetic_corpus.py --output-dir=bench_corpus --sizes=10,100,1000,10000,100000
+"""
+
+import argparse
+import csv
+import math
+import os
+import random
+
+
+FIELDS = ('word', 'lemma', 'pos', 'morph', 'dep')
+DEFAULT_SIZES = (10, 100, 1000, 10000, 100000)
+
+# category -> share of tokens
+CATEGORY_WEIGHTS = {
+    'NOUN': 0.25, 'ADJF': 0.10, 'VERB': 0.12, 'INFN': 0.03, 'PREP': 0.10, 'CONJ': 0.07,
+    'PRCL': 0.05, 'ADVB': 0.06, 'NPRO': 0.07, 'APRO': 0.04, 'PRED': 0.01, 'NUMR': 0.01,
+    'COMP': 0.005, 'PRTF': 0.015, 'GRND': 0.01, 'ADJS': 0.01, 'COMMA': 0.05,
+}
+
+# category -> dependency relation shares
+DEPENDENCIES = {
+    'NOUN': {'nsubj': 0.25, 'obj': 0.2, 'obl': 0.2, 'nmod': 0.2, 'conj': 0.05, 'root': 0.05, 'appos': 0.02, 'nsubj:pass': 0.03},
+    'ADJF': {'amod': 0.85, 'root': 0.05, 'conj': 0.05, 'acl': 0.05},
+    'VERB': {'root': 0.55, 'conj': 0.1, 'advcl': 0.08, 'ccomp': 0.07, 'xcomp': 0.05, 'acl:relcl': 0.1, 'parataxis': 0.05},
+    'INFN': {'xcomp': 0.7, 'csubj': 0.1, 'advcl': 0.2},
+    'PREP': {'case': 1.0},
+    'CONJ': {'cc': 0.6, 'mark': 0.4},
+    'PRCL': {'advmod': 0.7, 'discourse': 0.3},
+    'ADVB': {'advmod': 1.0},
+    'NPRO': {'nsubj': 0.6, 'obj': 0.2, 'obl': 0.2},
+    'APRO': {'det': 1.0},
+    'PRED': {'root': 0.7, 'parataxis': 0.3},
+    'NUMR': {'nummod': 1.0},
+    'COMP': {'advmod': 1.0},
+    'PRTF': {'acl': 0.6, 'amod': 0.4},
+    'GRND': {'advcl': 1.0},
+    'ADJS': {'root': 0.6, 'conj': 0.3, 'csubj:pass': 0.1},
+    'COMMA': {'punct': 1.0},
+    'END': {'punct': 1.0},
+}
+
+# Frequent forms: category -> [(word, lemma, morph)], most frequent first.
+FORMS = {
+    'PREP': [(w, w, 'PREP') for w in ('в', 'на', 'с', 'по', 'о', 'для', 'из', 'к', 'от', 'у', 'за', 'про', 'после', 'без')],
+    'CONJ': [(w, w, 'CONJ') for w in ('и', 'но', 'что', 'а', 'как', 'если', 'или', 'когда', 'потому', 'хотя', 'чтобы')],
+    'PRCL': [(w, w, 'PRCL') for w in ('не', 'же', 'бы', 'даже', 'только', 'ли', 'вот', 'ведь', 'уж')],
+    'ADVB': [(w, w, 'ADVB') for w in ('очень', 'просто', 'тоже', 'ещё', 'уже', 'так', 'здесь', 'потом', 'действительно', 'немного', 'совсем', 'вообще')],
+    'NPRO': [
+        ('я', 'я', 'NPRO,1per sing,nomn'), ('это', 'это', 'NPRO,neut sing,nomn'), ('он', 'он', 'NPRO,masc,3per,Anph sing,nomn'),
+        ('мне', 'я', 'NPRO,1per sing,datv'), ('всё', 'всё', 'NPRO,neut sing,nomn'), ('они', 'они', 'NPRO,3per,Anph plur,nomn'),
+        ('мы', 'мы', 'NPRO,1per plur,nomn'), ('его', 'он', 'NPRO,masc,3per,Anph sing,gent'), ('она', 'она', 'NPRO,femn,3per,Anph sing,nomn'),
+        ('ничего', 'ничто', 'NPRO,neut sing,gent'),
+    ],
+    'APRO': [
+        ('этот', 'этот', 'ADJF,Apro,Subx,Anph masc,sing,nomn'), ('который', 'который', 'ADJF,Apro,Subx masc,sing,nomn'),
+        ('свой', 'свой', 'ADJF,Apro,Anph masc,sing,nomn'), ('весь', 'весь', 'ADJF,Apro,Subx masc,sing,nomn'),
+        ('эта', 'этот', 'ADJF,Apro,Subx,Anph femn,sing,nomn'), ('такой', 'такой', 'ADJF,Apro,Subx masc,sing,nomn'),
+        ('каждый', 'каждый', 'ADJF,Apro masc,sing,nomn'),
+    ],
+    'PRED': [('можно', 'можно', 'PRED,pres'), ('нужно', 'нужно', 'PRED,pres'), ('жаль', 'жаль', 'PRED,pres'), ('нельзя', 'нельзя', 'PRED,pres')],
+    'NUMR': [('два', 'два', 'NUMR,masc,nomn'), ('три', 'три', 'NUMR,inan,nomn'), ('пять', 'пять', 'NUMR,nomn'), ('десять', 'десять', 'NUMR,nomn')],
+    'COMP': [('лучше', 'хороший', 'COMP,Qual'), ('больше', 'большой', 'COMP,Qual'), ('интереснее', 'интересный', 'COMP,Qual'), ('меньше', 'маленький', 'COMP,Qual')],
+    'VERB': [
+        ('был', 'быть', 'VERB,impf,intr masc,sing,past,indc'), ('есть', 'быть', 'VERB,impf,intr sing,3per,pres,indc'),
+        ('является', 'являться', 'VERB,impf,intr sing,3per,pres,indc'), ('понравился', 'понравиться', 'VERB,perf,intr masc,sing,past,indc'),
+        ('стоит', 'стоить', 'VERB,impf,intr sing,3per,pres,indc'), ('советую', 'советовать', 'VERB,impf,intr sing,1per,pres,indc'),
+        ('смотрел', 'смотреть', 'VERB,impf,tran masc,sing,past,indc'), ('будет', 'быть', 'VERB,impf,intr sing,3per,futr,indc'),
+        ('получился', 'получиться', 'VERB,perf,intr masc,sing,past,indc'), ('хочется', 'хотеться', 'VERB,impf,intr sing,3per,pres,indc'),
+    ],
+    'INFN': [('посмотреть', 'посмотреть', 'INFN,perf,tran'), ('сказать', 'сказать', 'INFN,perf,tran'), ('понять', 'понять', 'INFN,perf,tran')],
+    'PRTF': [('снятый', 'снять', 'PRTF,perf,tran,past,pssv masc,sing,nomn'), ('написанный', 'написать', 'PRTF,perf,tran,past,pssv masc,sing,nomn')],
+    'ADJS': [('интересно', 'интересный', 'ADJS,Qual neut,sing'), ('понятно', 'понятный', 'ADJS,Qual neut,sing'), ('жаль', 'жалкий', 'ADJS,Qual neut,sing')],
+    'COMMA': [(',', ',', 'PNCT')],
+    'END': [('.', '.', 'PNCT'), ('!', '!', 'PNCT'), ('...', '...', 'PNCT'), ('?', '?', 'PNCT')],
+}
+
+# Share of tokens of a category taken from FORMS; the rest is inflected.
+FORM_SHARE = {'VERB': 0.4, 'INFN': 0.3, 'PRTF': 0.3, 'ADJS': 0.5}
+RARE_SHARE = 0.08
+
+MASC_STEMS = [
+    ('фильм', 'inan'), ('сюжет', 'inan'), ('момент', 'inan'), ('характер', 'inan'), ('диалог', 'inan'), ('кадр', 'inan'),
+    ('эпизод', 'inan'), ('сезон', 'inan'), ('образ', 'inan'), ('финал', 'inan'), ('актер', 'anim'), ('режиссер', 'anim'),
+    ('сериал', 'inan'), ('звук', 'inan'), ('взгляд', 'inan'), ('поворот', 'inan'), ('конфликт', 'inan'), ('роман', 'inan'),
+    ('рассказ', 'inan'), ('мир', 'inan'), ('город', 'inan'), ('вечер', 'inan'), ('вопрос', 'inan'), ('ответ', 'inan'),
+    ('талант', 'inan'), ('результат', 'inan'), ('эффект', 'inan'), ('жанр', 'inan'), ('сценарист', 'anim'), ('оператор', 'anim'),
+    ('композитор', 'anim'), ('закон', 'inan'), ('договор', 'inan'), ('бюджет', 'inan'), ('зал', 'inan'),
+]
+MASC_ENDINGS = [
+    ('', 'sing,nomn'), ('а', 'sing,gent'), ('у', 'sing,datv'), ('ом', 'sing,ablt'), ('е', 'sing,loct'),
+    ('ы', 'plur,nomn'), ('ов', 'plur,gent'), ('ам', 'plur,datv'), ('ами', 'plur,ablt'), ('ах', 'plur,loct'),
+]
+FEMN_STEMS = [
+    'картин', 'сцен', 'работ', 'игр', 'тем', 'минут', 'драм', 'сторон', 'глав', 'актрис', 'атмосфер', 'режиссур',
+    'камер', 'команд', 'форм', 'проблем', 'систем', 'норм', 'награ', 'половин', 'дорог', 'рецензи',
+]
+FEMN_ENDINGS = [
+    ('а', 'sing,nomn'), ('ы', 'sing,gent'), ('е', 'sing,datv'), ('у', 'sing,accs'), ('ой', 'sing,ablt'), ('е', 'sing,loct'),
+    ('ы', 'plur,nomn'), ('', 'plur,gent'), ('ам', 'plur,datv'), ('ами', 'plur,ablt'), ('ах', 'plur,loct'),
+]
+ADJ_STEMS = [
+    'нов', 'стар', 'добр', 'интересн', 'скучн', 'красив', 'главн', 'сильн', 'слаб', 'умн', 'точн', 'полн', 'важн',
+    'ясн', 'сложн', 'прост', 'известн', 'смешн', 'страшн', 'честн', 'отличн', 'прекрасн', 'обычн', 'странн',
+]
+ADJ_ENDINGS = [
+    ('ый', 'masc,sing,nomn'), ('ого', 'masc,sing,gent'), ('ому', 'masc,sing,datv'), ('ым', 'masc,sing,ablt'), ('ом', 'masc,sing,loct'),
+    ('ая', 'femn,sing,nomn'), ('ой', 'femn,sing,gent'), ('ую', 'femn,sing,accs'), ('ое', 'neut,sing,nomn'),
+    ('ые', 'plur,nomn'), ('ых', 'plur,gent'), ('ыми', 'plur,ablt'),
+]
+VERB_STEMS = [
+    'понима', 'дума', 'чита', 'дела', 'игра', 'зна', 'ожида', 'рассказыва', 'показыва', 'снима', 'слуша', 'обсужда',
+    'получа', 'начина', 'вспомина', 'разочарова', 'удивля', 'объясня', 'сочета', 'повторя',
+]
+VERB_ENDINGS = [
+    ('ть', 'INFN', 'INFN,impf,tran'), ('ю', 'VERB', 'VERB,impf,tran sing,1per,pres,indc'),
+    ('ет', 'VERB', 'VERB,impf,tran sing,3per,pres,indc'), ('ют', 'VERB', 'VERB,impf,tran plur,3per,pres,indc'),
+    ('л', 'VERB', 'VERB,impf,tran masc,sing,past,indc'), ('ла', 'VERB', 'VERB,impf,tran femn,sing,past,indc'),
+    ('ли', 'VERB', 'VERB,impf,tran plur,past,indc'), ('ется', 'VERB', 'VERB,impf,intr sing,3per,pres,indc'),
+    ('лся', 'VERB', 'VERB,impf,intr masc,sing,past,indc'), ('ющий', 'PRTF', 'PRTF,impf,tran,pres,actv masc,sing,nomn'),
+    ('емый', 'PRTF', 'PRTF,impf,tran,pres,pssv masc,sing,nomn'), ('я', 'GRND', 'GRND,impf,tran pres'),
+]
+SYLLABLES = ['ба', 'ве', 'го', 'да', 'же', 'зи', 'ка', 'ло', 'ми', 'но', 'пу', 'ра', 'се', 'то', 'фу', 'хо', 'ча', 'ше']
+FINALS = ['т', 'р', 'н', 'л', 'к', 'м', 'с', 'д']
+
+
+def _choice(rng, items):
+    # Zipf-like preference for the first items of a list.
+    index = min(int(rng.paretovariate(1.1)) - 1, len(items) - 1)
+    return items[index]
+
+
+def _weighted(rng, weights):
+    return rng.choices(list(weights), weights=list(weights.values()))[0]
+
+
+def _rare_stem(rng):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))) + rng.choice(FINALS)
+
+
+def _open_class(rng, category):
+    rare = rng.random() < RARE_SHARE
+    if category == 'NOUN':
+        if rng.random() < 0.6:
+            stem, animacy = (_rare_stem(rng), 'inan') if rare else _choice(rng, MASC_STEMS)
+            ending, tags = rng.choice(MASC_ENDINGS)
+            return stem + ending, stem, f'NOUN,{animacy},masc {tags}'
+        stem = _rare_stem(rng) if rare else _choice(rng, FEMN_STEMS)
+        ending, tags = rng.choice(FEMN_ENDINGS)
+        return stem + ending, stem + 'а', f'NOUN,inan,femn {tags}'
+    if category == 'ADJF':
+        stem = _rare_stem(rng) if rare else _choice(rng, ADJ_STEMS)
+        ending, tags = rng.choice(ADJ_ENDINGS)
+        return stem + ending, stem + 'ый', f'ADJF,Qual {tags}'
+    stem = (_rare_stem(rng) + 'а') if rare else _choice(rng, VERB_STEMS)
+    endings = [e for e in VERB_ENDINGS if e[1] == category] or [e for e in VERB_ENDINGS if e[1] == 'VERB']
+    ending, _, morph = rng.choice(endings)
+    return stem + ending, stem + 'ть', morph
+
+
+def _token(rng, category):
+    if category in FORMS and rng.random() < FORM_SHARE.get(category, 1.0):
+        word, lemma, morph = _choice(rng, FORMS[category])
+    else:
+        word, lemma, morph = _open_class(rng, category)
+    # pymorphy2 reports no POS for punctuation; the POS of a form is the
+    # first grammeme of its tag.
+    pos = '' if morph == 'PNCT' else morph.split(',')[0].split(' ')[0]
+    return {'word': word, 'lemma': lemma, 'pos': pos, 'morph': morph, 'dep': _weighted(rng, DEPENDENCIES[category])}
+
+
+def generate_sentences(rng, num_tokens):
+    """Annotated sentences with ``num_tokens`` tokens in total, punctuation included."""
+    sentences = []
+    remaining = num_tokens
+    while remaining > 0:
+        length = max(2, int(rng.lognormvariate(math.log(12), 0.5)))
+        length = min(length, remaining)
+        sentence = [_token(rng, _weighted(rng, CATEGORY_WEIGHTS)) for _ in range(length - 1)]
+        sentence.append(_token(rng, 'END'))
+        sentences.append(sentence)
+        remaining -= length
+    return sentences
+
+
+def raw_text(sentences):
+    text = []
+    for sentence in sentences:
+        for token in sentence:
+            if token['morph'] == 'PNCT' or not text:
+                text.append(token['word'])
+            else:
+                text.append(' ' + token['word'])
+        text.append(' ')
+    return ''.join(text).strip()
+
+
+def write_document(sentences, path):
+    # Same layout as extract_characteristics.convert_to_csv_format
+    max_length = max(len(sentence) for sentence in sentences)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['sentence'] + [f'{field}{i}' for i in range(1, max_length + 1) for field in FIELDS])
+        for sentence in sentences:
+            row = [' '.join(token['word'] for token in sentence)]
+            row += [token[field] for token in sentence for field in FIELDS]
+            writer.writerow(row + [''] * (len(FIELDS) * (max_length - len(sentence))))
+
+
+def document_name(size):
+    return f'doc_{size:06d}.csv'
+
+
+def generate_corpus(output_dir, sizes=DEFAULT_SIZES, seed=0):
+    """Write one document per size to ``output_dir/docs`` and their texts to ``output_dir/reviews.csv``."""
+    os.makedirs(os.path.join(output_dir, 'docs'), exist_ok=True)
+    reviews = []
+    for size in sizes:
+        rng = random.Random(f'{seed}:{size}')
+        sentences = generate_sentences(rng, size)
+        write_document(sentences, os.path.join(output_dir, 'docs', document_name(size)))
+        reviews.append((document_name(size), size, raw_text(sentences)))
+    with open(os.path.join(output_dir, 'reviews.csv'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['fname', 'tokens', 'review'])
+        writer.writerows(reviews)
+    return [name for name, _, _ in reviews]
+
+
+def parse_sizes(value):
+    return tuple(int(size) for size in value.split(','))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic annotated review corpus")
+    parser.add_argument("--output-dir", default="bench_corpus", help="output folder")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, type=parse_sizes, help="comma-separated document sizes in tokens")
+    parser.add_argument("--seed", default=0, type=int, help="random seed")
+
+    args = parser.parse_args()
+    names = generate_corpus(args.output_dir, args.sizes, args.seed)
+    print(f'{args.output_dir}: {len(names)} documents')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""
+Memory-mapped store of an annotated corpus with random access by document.
+
+``build`` parses every annotated CSV document once and writes a single
+``arrayfile`` container holding:
+
+* a string table: the UTF-8 bytes of every distinct token string and of
+  every sentence text (``strings``) and their offsets (``string_offsets``),
+* one ``uint32`` column of string ids per token field (``word``, ``lemma``,
+  ``pos``, ``morph``, ``dep``), the tokens of all documents one after the
+  other, as ``FeatureExtractor.parse_csv`` returns them,
+* the sentence texts as string ids (``sents``),
+* offsets: tokens per word sentence (``sentence_offsets``), word sentences
+  per document (``document_sentences``) and sentence texts per document
+  (``document_sents``).
+
+``TokenStore`` maps the file read-only, so every worker process shares the
+same pages, and slices the columns of one document without copying them
+(``columns``). ``document`` rebuilds the ``(words, sents)`` pair the metric
+functions take, at a cost proportional to the document rather than to its
+source file.
+
+    python token_store.py build --input-path=data --output=corpus.tokens
+    python token_store.py metrics --store=corpus.tokens --document=doc_000010.csv
+    python token_store.py show --store=corpus.tokens --document=doc_000010.csv
+"""
+
+import argparse
+import csv
+import os
+import random
+import shutil
+import sys
+from array import array
+
+import numpy as np
+
+from arrayfile import map_arrays, write_array_files
+from review_sources import annotated_documents
+
+
+MAGIC = b'TOKSTOR1'
+FIELDS = ('word', 'lemma', 'pos', 'morph', 'dep')
+
+
+# Column -> ``array`` typecode of the id and offset columns
+COLUMNS = {
+    **dict.fromkeys(FIELDS, 'I'), 'sents': 'I',
+    'sentence_offsets': 'q', 'document_sentences': 'q', 'document_sents': 'q',
+}
+DTYPES = {'I': np.uint32, 'q': np.int64}
+# Column elements build_store buffers before appending them to its files
+FLUSH_ELEMENTS = 1 << 20
+
+
+class _Encoder:
+    """Appends documents to the columns of the store layout.
+
+    ``take`` hands over what was appended since the last call, so the
+    columns can go to disk in pieces. Token strings are interned; sentence
+    texts, which hardly ever repeat, only are with ``intern_sents``.
+    """
+
+    def __init__(self, intern_sents=True):
+        self.intern_sents = intern_sents
+        self.names = []
+        self.string_ids = {}
+        self.strings = []
+        self.columns = self._empty()
+        for name in ('sentence_offsets', 'document_sentences', 'document_sents'):
+            self.columns[name].append(0)
+        self.tokens = self.sentences = self.sents = 0
+        # Strings that have an id
+        self.count = 0
+
+    @staticmethod
+    def _empty():
+        return {name: array(typecode) for name, typecode in COLUMNS.items()}
+
+    def _new_string(self, text):
+        self.strings.append(text)
+        self.count += 1
+        return self.count - 1
+
+    def _string_id(self, text):
+        index = self.string_ids.get(text)
+        if index is None:
+            index = self.string_ids[text] = self._new_string(text)
+        return index
+
+    def add(self, name, words, sents):
+        self.names.append(name)
+        columns = self.columns
+        for sentence in words:
+            for token in sentence:
+                for field in FIELDS:
+                    columns[field].append(self._string_id(token[field]))
+            self.tokens += len(sentence)
+            columns['sentence_offsets'].append(self.tokens)
+        columns['sents'].extend(map(self._string_id if self.intern_sents else self._new_string, sents))
+        self.sentences += len(words)
+        self.sents += len(sents)
+        columns['document_sentences'].append(self.sentences)
+        columns['document_sents'].append(self.sents)
+
+    @property
+    def buffered(self):
+        return sum(len(column) for column in self.columns.values())
+
+    def take(self):
+        """``(columns, strings)`` appended since the last call; ``strings`` are the new ones in id order."""
+        columns, strings = self.columns, self.strings
+        self.columns, self.strings = self._empty(), []
+        return columns, strings
+
+
+def encode_documents(documents):
+    """``(names, strings, arrays)`` of ``documents``, an iterable of ``(name, words, sents)``.
+
+    ``arrays`` holds the token, sentence and offset columns of the store
+    layout; the ids index ``strings``.
+    """
+    encoder = _Encoder()
+    for document in documents:
+        encoder.add(*document)
+    columns, strings = encoder.take()
+    arrays = {name: np.frombuffer(column, dtype=DTYPES[column.typecode]) for name, column in columns.items()}
+    return encoder.names, strings, arrays
+
+
+def build_store(path, documents):
+    """Write ``documents``, an iterable of ``(name, words, sents)``, to ``path``.
+
+    The columns and the string table are appended to one file each in a
+    temporary folder next to ``path`` while the documents are encoded, and
+    then copied into the store in chunks, so memory holds the distinct token
+    strings and the document names but not the corpus. The folder needs as
+    much space as the store.
+    """
+    folder = f'{path}.tmp{os.getpid()}.columns'
+    os.makedirs(folder, exist_ok=True)
+    names = (*COLUMNS, 'strings', 'string_offsets')
+    files = {}
+    try:
+        files = {name: open(os.path.join(folder, name), 'wb') for name in names}
+        array('q', [0]).tofile(files['string_offsets'])
+        encoder = _Encoder(intern_sents=False)
+        string_end = 0
+
+        def flush():
+            nonlocal string_end
+            columns, strings = encoder.take()
+            for name, column in columns.items():
+                column.tofile(files[name])
+            offsets = array('q')
+            for text in strings:
+                data = text.encode('utf-8')
+                files['strings'].write(data)
+                string_end += len(data)
+                offsets.append(string_end)
+            offsets.tofile(files['string_offsets'])
+
+        for document in documents:
+            encoder.add(*document)
+            if encoder.buffered >= FLUSH_ELEMENTS:
+                flush()
+        flush()
+        for f in files.values():
+            f.close()
+
+        dtypes = {**{name: DTYPES[typecode] for name, typecode in COLUMNS.items()}, 'strings': np.uint8, 'string_offsets': np.int64}
+        write_array_files(path, MAGIC, {name: (os.path.join(folder, name), dtypes[name]) for name in ('strings', 'string_offsets', *COLUMNS)},
+                          {'documents': encoder.names, 'fields': list(FIELDS)})
+        return len(encoder.names), encoder.tokens
+    finally:
+        for f in files.values():
+            f.close()
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+class TokenStore:
+
+    def __init__(self, path):
+        self.path = path
+        self.arrays, meta = map_arrays(path, MAGIC)
+        self.names = meta['documents']
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def _position(self, document):
+        return document if isinstance(document, int) else self.index[document]
+
+    def string(self, string_id):
+        offsets = self.arrays['string_offsets']
+        return bytes(self.arrays['strings'][offsets[string_id]:offsets[string_id + 1]]).decode('utf-8')
+
+    def columns(self, document):
+        """``({field: ids}, sentence_offsets, sents)`` of a document, by name or position.
+
+        The id arrays are views of the mapped file; ``sentence_offsets`` are
+        relative to the first token of the document.
+        """
+        i = self._position(document)
+        first, last = self.arrays['document_sentences'][i:i + 2]
+        offsets = self.arrays['sentence_offsets'][first:last + 1]
+        start, end = offsets[0], offsets[-1]
+        sents_start, sents_end = self.arrays['document_sents'][i:i + 2]
+        return (
+            {field: self.arrays[field][start:end] for field in FIELDS},
+            offsets - start,
+            self.arrays['sents'][sents_start:sents_end],
+        )
+
+    def document(self, document, token):
+        """``(words, sents)`` as ``FeatureExtractor.parse_csv`` returns them.
+
+        ``token`` builds a token from its five field strings (``Token``).
+        """
+        columns, offsets, sents = self.columns(document)
+        ids = np.concatenate([columns[field] for field in FIELDS] + [sents])
+        table = {int(string_id): self.string(string_id) for string_id in np.unique(ids)}
+        rows = list(zip(*[[table[string_id] for string_id in columns[field].tolist()] for field in FIELDS]))
+        words = [[token(*row) for row in rows[offsets[j]:offsets[j + 1]]] for j in range(len(offsets) - 1)]
+        return words, [table[string_id] for string_id in sents.tolist()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and query a memory-mapped annotated corpus")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help="parse a folder of annotated documents into a store")
+    build_parser.add_argument("--input-path", default="./data", help="folder of annotated documents")
+    build_parser.add_argument("--output", default="corpus.tokens", help="store file")
+
+    metrics_parser = subparsers.add_parser('metrics', help="compute the metrics of some documents of a store")
+    metrics_parser.add_argument("--store", required=True, help="store file")
+    metrics_parser.add_argument("--document", action="append", default=[], help="document name (repeatable)")
+    metrics_parser.add_argument("--sample", default=0, type=int, help="also pick this many random documents")
+    metrics_parser.add_argument("--seed", default=None, type=int, help="seed of --sample")
+    metrics_parser.add_argument("--features", default="features.txt", help="metrics to compute")
+    metrics_parser.add_argument("--output", default=None, help="CSV file (default: standard output)")
+
+    show_parser = subparsers.add_parser('show', help="print the tokens of one document")
+    show_parser.add_argument("--store", required=True, help="store file")
+    show_parser.add_argument("--document", required=True, help="document name")
+
+    args = parser.parse_args()
+
+    # Imported here: feature_extractor itself reads documents from stores
+    from feature_extractor import FeatureExtractor, Token, evaluate_metrics, metric_function, prepare_lexicons, read_feature_list
+
+    if args.command == 'build':
+        file_list = sorted(annotated_documents(args.input_path))
+        documents = ((os.path.basename(path), *FeatureExtractor.parse_csv(path)) for path in file_list)
+        count, tokens = build_store(args.output, documents)
+        print(f'{args.output}: {count} documents, {tokens} tokens')
+        return
+
+    store = TokenStore(args.store)
+    if args.command == 'show':
+        words, sents = store.document(args.document, Token)
+        writer = csv.writer(sys.stdout, delimiter='\t')
+        for number, sentence in enumerate(words):
+            for token in sentence:
+                writer.writerow([number] + [token[field] for field in FIELDS])
+        return
+
+    names = list(args.document)
+    missing = [name for name in names if name not in store]
+    if missing:
+        parser.error(f'not in {args.store}: {", ".join(missing)}')
+    if args.sample:
+        names += random.Random(args.seed).sample(store.names, min(args.sample, len(store)))
+    prepare_lexicons()
+    function_list, arglist = read_feature_list(args.features)
+    functions = [metric_function(name) for name in function_list]
+    output = open(args.output, 'w', newline='', encoding='utf-8') if args.output else sys.stdout
+    try:
+        writer = csv.writer(output)
+        writer.writerow(['fname'] + function_list)
+        for name in names:
+            words, sents = store.document(name, Token)
+            writer.writerow([name] + evaluate_metrics(words, sents, functions, arglist))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,46 @@
+import time
+
+# Taken before any other import, for the startup time of --report
+STARTED = time.perf_counter()
+
 import typing as t
 import argparse
-import pandas as pd
-import pymorphy2
-import natasha
+import contextlib
+import random
+import sys
+
+# pandas, pymorphy2 and natasha take seconds to import; they are imported
+# where they are first used, so --help and argument errors return at once
+if t.TYPE_CHECKING:
+    import pandas as pd
+
+from complexity_model_apapted.Metrics.annotation_layers import LAYERS, feature_names, parse_layers, required_layers
+from complexity_model_apapted.Metrics.dedup import THRESHOLD, find_duplicates, summary, text_key, write_report
+from complexity_model_apapted.Metrics.fault_isolation import ErrorLog, TaskTimeout, time_limit
+from complexity_model_apapted.Metrics.instrumentation import Instrumentation, peak_rss_bytes, profile_call
+from complexity_model_apapted.Metrics.review_sources import expand_inputs, missing_fields, read_records, split_suffixes
+
+
+# lemma, pos and morph all come from one pymorphy2 parse
+PYMORPHY2_LAYERS = {"lemma", "pos", "morph"}
+
 
+def initialize_analysis_components(
+    layers: t.Collection[str] = LAYERS,
+    instrumentation: t.Optional[Instrumentation] = None,
+):
+    # Only the models of the requested layers are imported and loaded
+    stage = instrumentation.timer if instrumentation is not None else contextlib.nullcontext
+    with stage("import_models"):
+        import natasha
 
-def initialize_analysis_components():
-    morph_analyzer = pymorphy2.MorphAnalyzer()
-    segmenter = natasha.Segmenter()
-    embedding = natasha.NewsEmbedding()
-    morph_tagger = natasha.NewsMorphTagger(embedding)
-    syntax_parser = natasha.NewsSyntaxParser(embedding)
-    return morph_analyzer, segmenter, morph_tagger, syntax_parser
+        if PYMORPHY2_LAYERS & set(layers):
+            import pymorphy2
+    with stage("load_models"):
+        morph_analyzer = pymorphy2.MorphAnalyzer() if PYMORPHY2_LAYERS & set(layers) else None
+        segmenter = natasha.Segmenter()
+        syntax_parser = natasha.NewsSyntaxParser(natasha.NewsEmbedding()) if "dep" in layers else None
+    return morph_analyzer, segmenter, syntax_parser
 
 
 def get_dependency_relations(
@@ -26,49 +55,100 @@ def process_review(
     text: str,
     morph_analyzer,
     segmenter,
-    morph_tagger,
     syntax_parser,
+    instrumentation: t.Optional[Instrumentation] = None,
 ) -> t.Sequence[t.Sequence[t.Mapping[str, str]]]:
+    """Annotated sentences of ``text``; a layer whose component is ``None`` is left out."""
+    import natasha
+
+    stage = instrumentation.timer if instrumentation is not None else contextlib.nullcontext
     doc = natasha.Doc(text)
-    doc.segment(segmenter)
-    doc.tag_morph(morph_tagger)
-    doc.parse_syntax(syntax_parser)
+    with stage("segment"):
+        doc.segment(segmenter)
+    if syntax_parser is not None:
+        with stage("parse_syntax"):
+            doc.parse_syntax(syntax_parser)
 
     processed_sentences = []
-    for sentence in doc.sents:
-        processed_words = []
-        for token in sentence.tokens:
-            parsed_word = morph_analyzer.parse(token.text)[0]
-            processed_words.append(
-                {
-                    "word": token.text,
-                    "lemma": parsed_word.normal_form,
-                    "pos": parsed_word.tag.POS,
-                    "morph": str(parsed_word.tag),
-                    "dep": token.rel,
-                }
-            )
-        processed_sentences.append(processed_words)
+    with stage("pymorphy2"):
+        for sentence in doc.sents:
+            processed_words = []
+            for token in sentence.tokens:
+                word = {"word": token.text}
+                if morph_analyzer is not None:
+                    parsed_word = morph_analyzer.parse(token.text)[0]
+                    word["lemma"] = parsed_word.normal_form
+                    word["pos"] = parsed_word.tag.POS
+                    word["morph"] = str(parsed_word.tag)
+                if syntax_parser is not None:
+                    word["dep"] = token.rel
+                processed_words.append(word)
+            processed_sentences.append(processed_words)
 
     return processed_sentences
 
 
+def sentence_row(sentence: t.Sequence[t.Mapping[str, str]]) -> t.List[str]:
+    sentence_text = " ".join(word["word"] for word in sentence)
+    return [sentence_text] + [
+        word.get(attr, "")
+        for word in sentence
+        for attr in ["word", "lemma", "pos", "morph", "dep"]
+    ]
+
+
+def annotate_distinct(
+    reviews: t.Sequence[str],
+    annotate: t.Callable[[str], t.Sequence[t.Sequence[t.Mapping[str, str]]]],
+) -> t.List[t.Sequence[t.Sequence[t.Mapping[str, str]]]]:
+    # Repeated reviews share the annotation of their first occurrence; a
+    # missing value is not a text and is annotated (and fails) on its own
+    annotated = {}
+    keys = [text_key(review) if isinstance(review, str) else review for review in reviews]
+    return [annotated[key] if key in annotated else annotated.setdefault(key, annotate(review)) for key, review in zip(keys, reviews)]
+
+
+def isolate_failures(
+    annotate: t.Callable[[str], t.Sequence[t.Sequence[t.Mapping[str, str]]]],
+    reviews: t.Sequence[str],
+    names: t.Sequence[str],
+    errors: ErrorLog,
+    timeout: t.Optional[float] = None,
+) -> t.Callable[[str], t.Sequence[t.Sequence[t.Mapping[str, str]]]]:
+    # A review that raises (e.g. a missing value) or runs out of time gets
+    # one empty sentence and an error record under the name of its first
+    # occurrence, instead of aborting the whole file
+    first_names = {}
+    for name, review in zip(names, reviews):
+        first_names.setdefault(review, name)
+
+    def annotate_review(review):
+        try:
+            with time_limit(timeout):
+                return annotate(review)
+        except Exception as error:
+            errors.add(first_names[review], "timeout" if isinstance(error, TaskTimeout) else "annotate", error)
+            return [[]]
+
+    return annotate_review
+
+
 def convert_to_csv_format(
-    processed_texts: t.Sequence[t.Sequence[t.Sequence[t.Mapping[str, str]]]]
-) -> pd.DataFrame:
+    processed_texts: t.Sequence[t.Sequence[t.Sequence[t.Mapping[str, str]]]],
+    review_ids: t.Optional[t.Sequence[str]] = None,
+) -> "pd.DataFrame":
+    import pandas as pd
+
+    # With review_ids every sentence row also names its review (review_id
+    # column); the metric scripts read columns by name and ignore it
     rows = []
-    for text in processed_texts:
+    for position, text in enumerate(processed_texts):
         for sentence in text:
-            sentence_text = " ".join(word["word"] for word in sentence)
-            row = [sentence_text] + [
-                word.get(attr, "")
-                for word in sentence
-                for attr in ["word", "lemma", "pos", "morph", "dep"]
-            ]
-            rows.append(row)
+            row = sentence_row(sentence)
+            rows.append(row if review_ids is None else [review_ids[position]] + row)
 
     max_length = max(len(sentence) for text in processed_texts for sentence in text)
-    columns = ["sentence"] + [
+    columns = ([] if review_ids is None else ["review_id"]) + ["sentence"] + [
         f"{attr}{i}"
         for i in range(1, max_length + 1)
         for attr in ["word", "lemma", "pos", "morph", "dep"]
@@ -77,22 +157,214 @@ def convert_to_csv_format(
     return pd.DataFrame(rows, columns=columns)
 
 
-def main(data_path: str, column_name: str, output_path: str):
-    df = pd.read_csv(data_path)
-    components = initialize_analysis_components()
-    process_function = lambda review: process_review(review, *components)
-    preprocessed_data = df[column_name].apply(process_function).tolist()
-    processed_df = convert_to_csv_format(preprocessed_data)
-    processed_df.to_csv(output_path, index=False)
+def read_reviews(data_path: str, column_name: str, id_column: t.Optional[str] = None, read_workers: int = 1):
+    import pandas as pd
+
+    paths = expand_inputs(data_path)
+    if paths == [data_path] and split_suffixes(data_path) == ("csv", ""):
+        return pd.read_csv(data_path)
+    fields = [column_name] + ([id_column] if id_column else [])
+    missing = missing_fields(paths, fields)
+    if missing:
+        sys.exit(f"{data_path} has no column {missing[0]!r}")
+    # Missing values and empty CSV cells are NaN, as with pd.read_csv
+    records = ([None if value == "" else value for value in values] for values in read_records(paths, fields, read_workers))
+    return pd.DataFrame(records, columns=fields)
+
+
+def main(
+    data_path: str,
+    column_name: str,
+    output_path: str,
+    report_path: t.Optional[str] = None,
+    report_format: t.Optional[str] = None,
+    profile_path: t.Optional[str] = None,
+    layers: t.Collection[str] = LAYERS,
+    duplicates_path: t.Optional[str] = None,
+    drop_duplicates: bool = False,
+    duplicate_threshold: float = THRESHOLD,
+    id_column: t.Optional[str] = None,
+    timeout: t.Optional[float] = None,
+    errors_path: t.Optional[str] = None,
+    read_workers: int = 1,
+):
+    instrumentation = Instrumentation(started=STARTED) if report_path is not None else None
+    stage = instrumentation.timer if instrumentation is not None else contextlib.nullcontext
+    with stage("import_pandas"):
+        import pandas as pd
+
+    with stage("read_input"):
+        df = read_reviews(data_path, column_name, id_column, read_workers)
+    # Checked before the models are loaded, which takes much longer
+    if column_name not in df:
+        sys.exit(f"{data_path} has no column {column_name!r}")
+    if id_column and id_column not in df:
+        sys.exit(f"{data_path} has no column {id_column!r}")
+    if duplicates_path or drop_duplicates:
+        duplicates = find_duplicates(df[column_name].tolist(), duplicate_threshold)
+        print(summary(duplicates), file=sys.stderr)
+        if duplicates_path:
+            write_report(duplicates, duplicates_path)
+        if drop_duplicates:
+            df = df[[kind == "unique" for _, kind, _ in duplicates]]
+    review_ids = df[id_column].astype(str).tolist() if id_column else None
+    components = initialize_analysis_components(layers, instrumentation)
+    if instrumentation is not None:
+        instrumentation.ready()
+
+    if profile_path and len(df):
+        review = random.choice(df[column_name].tolist())
+        profile_call(profile_path, process_review, review, *components)
+        print(f"{profile_path}: cProfile stats for one sampled review", file=sys.stderr)
+
+    reviews = df[column_name].tolist()
+    errors = ErrorLog()
+    names = review_ids if review_ids is not None else [str(index) for index in df.index]
+    errors_path = errors_path or f"{output_path}.errors.jsonl"
+
+    if report_path is None:
+        process_function = lambda review: process_review(review, *components)
+        preprocessed_data = annotate_distinct(reviews, isolate_failures(process_function, reviews, names, errors, timeout))
+        processed_df = convert_to_csv_format(preprocessed_data, review_ids)
+        processed_df.to_csv(output_path, index=False)
+        write_errors(errors, errors_path)
+        return
+
+    def process_function(review):
+        start = time.perf_counter()
+        processed = process_review(review, *components, instrumentation=instrumentation)
+        tokens = sum(len(sentence) for sentence in processed)
+        instrumentation.add_document("main", tokens, time.perf_counter() - start, peak_rss_bytes())
+        return processed
+
+    preprocessed_data = annotate_distinct(reviews, isolate_failures(process_function, reviews, names, errors, timeout))
+    with instrumentation.timer("convert_to_csv_format"):
+        processed_df = convert_to_csv_format(preprocessed_data, review_ids)
+    with instrumentation.timer("to_csv"):
+        processed_df.to_csv(output_path, index=False)
+    write_errors(errors, errors_path)
+    instrumentation.write(report_path, report_format)
+
+
+def write_errors(errors: ErrorLog, errors_path: str):
+    errors.write(errors_path)
+    if errors.records:
+        print(f"{errors.summary()}, see {errors_path}", file=sys.stderr)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process data file.")
-    parser.add_argument("--data_path", type=str, help="Path to the data file.")
     parser.add_argument(
-        "--column_name", type=str, help="Name of the column to process."
+        "--data_path",
+        type=str,
+        help="Path to the data file: CSV, JSON lines or Parquet, also .gz, .bz2, .xz or .zst; or a folder or glob pattern of such shards.",
+    )
+    parser.add_argument(
+        "--column_name", type=str, help="Name of the column to process, or a field path such as meta.text."
     )
     parser.add_argument("--output_path", type=str, help="Path for the output CSV file.")
+    parser.add_argument(
+        "--id-column",
+        type=str,
+        default=None,
+        help="Carry this column into a review_id column of the output, for pairing.py and per-review grouping.",
+    )
+    parser.add_argument(
+        "--read-workers",
+        type=int,
+        default=1,
+        help="Processes that decompress and parse input shards in parallel.",
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="Write run statistics (time per annotation step, throughput, peak RSS) to this file.",
+    )
+    parser.add_argument(
+        "--report-format",
+        type=str,
+        default=None,
+        choices=("json", "prometheus"),
+        help="Format of --report (default: prometheus for *.prom files, json otherwise).",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Dump cProfile stats (pstats format) for one randomly sampled review to this file.",
+    )
+    layers_group = parser.add_mutually_exclusive_group()
+    layers_group.add_argument(
+        "--features",
+        type=str,
+        default=None,
+        help="Annotate only the layers that the metrics of this features.txt file read.",
+    )
+    layers_group.add_argument(
+        "--layers",
+        type=str,
+        default=None,
+        help=f"Comma-separated annotation layers to fill ({','.join(LAYERS)}; default: all).",
+    )
+
+    parser.add_argument(
+        "--duplicates-report",
+        type=str,
+        default=None,
+        help="Write exact and near-duplicate reviews (MinHash over character shingles) to this CSV file.",
+    )
+    parser.add_argument(
+        "--drop-duplicates",
+        action="store_true",
+        help="Annotate only the first review of every exact or near-duplicate cluster.",
+    )
+    parser.add_argument(
+        "--duplicate-threshold",
+        type=float,
+        default=THRESHOLD,
+        help=f"Estimated Jaccard similarity from which reviews are near duplicates (default: {THRESHOLD}).",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="Seconds the annotation of one review may take; a review over the limit gets an empty sentence and an error log entry.",
+    )
+    parser.add_argument(
+        "--errors-path",
+        type=str,
+        default=None,
+        help="JSON lines of the reviews that could not be annotated (default: the output path + .errors.jsonl).",
+    )
 
     args = parser.parse_args()
-    main(args.data_path, args.column_name, args.output_path)
+    if args.timeout is not None and args.timeout <= 0:
+        parser.error("--timeout must be positive")
+    if not expand_inputs(args.data_path or ""):
+        parser.error(f"--data_path: no input files: {args.data_path}")
+    if args.features:
+        layers = required_layers(feature_names(args.features))
+    elif args.layers is not None:
+        try:
+            layers = parse_layers(args.layers)
+        except ValueError as error:
+            parser.error(str(error))
+    else:
+        layers = LAYERS
+    main(
+        args.data_path,
+        args.column_name,
+        args.output_path,
+        report_path=args.report,
+        report_format=args.report_format,
+        profile_path=args.profile,
+        layers=layers,
+        duplicates_path=args.duplicates_report,
+        drop_duplicates=args.drop_duplicates,
+        duplicate_threshold=args.duplicate_threshold,
+        id_column=args.id_column,
+        timeout=args.timeout,
+        errors_path=args.errors_path,
+        read_workers=args.read_workers,
+    )